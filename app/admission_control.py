@@ -0,0 +1,137 @@
+"""
+This file contains the AdmissionControl class.
+
+It limits the number of websocket connections globally, per group and per client name, the number
+of spectator streams per group and the rate of inbound frames per connection with a token bucket. Every extra socket multiplies the
+broadcast cost, so connections and frames are rejected before any parsing or database work.
+"""
+
+import os
+from collections import Counter
+from time import monotonic
+
+# a limit of 0 disables the check
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "1000"))
+MAX_GROUP_CONNECTIONS = int(os.getenv("MAX_GROUP_CONNECTIONS", "100"))
+MAX_CLIENT_CONNECTIONS = int(os.getenv("MAX_CLIENT_CONNECTIONS", "5"))
+# groups a single multiplexed connection may subscribe to
+MAX_SUBSCRIPTIONS = int(os.getenv("MAX_SUBSCRIPTIONS", "20"))
+# read-only spectator streams of a single group, they only cost a queue each
+MAX_GROUP_SPECTATORS = int(os.getenv("MAX_GROUP_SPECTATORS", "1000"))
+FRAME_RATE = float(os.getenv("FRAME_RATE", "20"))
+FRAME_BURST = int(os.getenv("FRAME_BURST", "40"))
+
+
+class TokenBucket:
+    """Allows burst frames at once and refills with rate frames per second"""
+
+    rate: float
+    burst: int
+    tokens: float
+    updated: float
+    dropped: int
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        # frames refused since the bucket last had a token
+        self.dropped = 0
+
+    def take(self):
+        """Takes one token, returns False if the bucket is empty"""
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+        self.dropped = 0
+        self.tokens -= 1
+        return True
+
+
+class AdmissionControl:
+    """Class that decides whether a connection or frame is admitted and counts the rejections"""
+
+    max_connections: int
+    max_group_connections: int
+    max_client_connections: int
+    max_subscriptions: int
+    max_group_spectators: int
+    frame_rate: float
+    frame_burst: int
+    rejections: Counter
+
+    def __init__(
+        self,
+        max_connections: int = MAX_CONNECTIONS,
+        max_group_connections: int = MAX_GROUP_CONNECTIONS,
+        max_client_connections: int = MAX_CLIENT_CONNECTIONS,
+        max_subscriptions: int = MAX_SUBSCRIPTIONS,
+        max_group_spectators: int = MAX_GROUP_SPECTATORS,
+        frame_rate: float = FRAME_RATE,
+        frame_burst: int = FRAME_BURST,
+    ):
+        self.max_connections = max_connections
+        self.max_group_connections = max_group_connections
+        self.max_client_connections = max_client_connections
+        self.max_subscriptions = max_subscriptions
+        self.max_group_spectators = max_group_spectators
+        self.frame_rate = frame_rate
+        self.frame_burst = frame_burst
+        self.rejections = Counter()
+
+    def check_connection(self, connections: int):
+        """Returns the reason a new connection is rejected with the given number of open connections, None if it is admitted"""
+        return self._check(("max_connections", connections, self.max_connections))
+
+    def check_subscription(self, group_connections: int, client_connections: int, subscriptions: int = 0):
+        """Returns the reason a connection may not join a group with the given counts of the group, the client
+        and the groups the connection already joined, None if it is admitted"""
+        return self._check(
+            ("max_group_connections", group_connections, self.max_group_connections),
+            ("max_client_connections", client_connections, self.max_client_connections),
+            ("max_subscriptions", subscriptions, self.max_subscriptions),
+        )
+
+    def check_spectator(self, group_spectators: int):
+        """Returns the reason a new spectator stream of a group with the given number of spectators is rejected, None if it is admitted"""
+        return self._check(("max_group_spectators", group_spectators, self.max_group_spectators))
+
+    def _check(self, *checks: tuple[str, int, int]):
+        for reason, count, limit in checks:
+            if limit and count >= limit:
+                self.rejections[reason] += 1
+                return reason
+        return None
+
+    def create_bucket(self):
+        """Returns the frame rate limit of a new connection, None if frames are not limited"""
+        if self.frame_rate <= 0:
+            return None
+        return TokenBucket(self.frame_rate, max(self.frame_burst, 1))
+
+    def check_frame(self, bucket: TokenBucket | None):
+        """Returns False and counts the rejection if the connection sent frames faster than allowed"""
+        if bucket is None or bucket.take():
+            return True
+        self.rejections["frame_rate"] += 1
+        return False
+
+    def report(self):
+        """Returns the limits and the rejection counts by reason"""
+        return {
+            "limits": {
+                "max_connections": self.max_connections,
+                "max_group_connections": self.max_group_connections,
+                "max_client_connections": self.max_client_connections,
+                "max_subscriptions": self.max_subscriptions,
+                "max_group_spectators": self.max_group_spectators,
+                "frame_rate": self.frame_rate,
+                "frame_burst": self.frame_burst,
+            },
+            "total": sum(self.rejections.values()),
+            "by_reason": dict(self.rejections),
+        }
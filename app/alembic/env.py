@@ -14,11 +14,19 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
-# add your model's MetaData object here
-# for 'autogenerate' support
-# from myapp import mymodel
-# target_metadata = mymodel.Base.metadata
-target_metadata = None
+# the database is configured by the app, see SQL_FILE_NAME in app/models.py,
+# importing the models registers their tables for 'autogenerate' support
+from sqlmodel import SQLModel
+
+from app.models import HISTORY_SEARCH_TABLE, sqlite_url
+
+config.set_main_option("sqlalchemy.url", sqlite_url)
+target_metadata = SQLModel.metadata
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Leaves the FTS5 history index and its shadow tables out of autogenerate, they are created by the app"""
+    return not (type_ == "table" and name.startswith(HISTORY_SEARCH_TABLE))
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -42,6 +50,8 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
+        render_as_batch=True,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -64,8 +74,12 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
+        # SQLite can't alter columns, batch mode recreates the table instead
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection,
+            target_metadata=target_metadata,
+            include_object=include_object,
+            render_as_batch=True,
         )
 
         with context.begin_transaction():
@@ -9,6 +9,8 @@ from typing import Sequence, Union
 
 from alembic import op
 import sqlalchemy as sa
+## autogenerate renders the str fields of the SQLModel models as sqlmodel.sql.sqltypes.AutoString
+import sqlmodel
 ${imports if imports else ""}
 
 # revision identifiers, used by Alembic.
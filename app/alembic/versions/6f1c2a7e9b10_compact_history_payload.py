@@ -0,0 +1,147 @@
+"""compact history payload
+
+Stores HistoryEvent.event_type as a small int (event_kind) and event_data as a compact,
+optionally zlib compressed payload without the fields that already have their own column.
+
+Revision ID: 6f1c2a7e9b10
+Revises:
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+import json
+import os
+import zlib
+from datetime import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '6f1c2a7e9b10'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+# copies of app.models as of this revision, so later changes to the models don't change what it does
+MESSAGE_KINDS = {
+    "DestinySwitchMessage": 1,
+    "DestinyAddMessage": 2,
+    "DestinyRemoveMessage": 3,
+    "CharacterCreateMessage": 4,
+    "CharacterUpdateMessage": 5,
+    "CharacterDeleteMessage": 6,
+    "RollReqestMessage": 7,
+    "RollResultMessage": 8,
+    "RollBatchRequestMessage": 9,
+    "RollBatchResultMessage": 10,
+    "InitiativeOrderMessage": 11,
+    "PresenceSnapshotMessage": 12,
+    "PresenceMessage": 13,
+}
+MESSAGE_KIND_NAMES = {kind: message_type for message_type, kind in MESSAGE_KINDS.items()}
+HISTORY_COLUMN_FIELDS = ("message_type", "group_name", "created_at")
+PAYLOAD_COMPRESS_THRESHOLD = int(os.getenv("HISTORY_COMPRESS_THRESHOLD", "0"))
+PAYLOAD_JSON = b"j"
+PAYLOAD_ZLIB = b"z"
+
+
+def encode_payload(message_data: dict) -> bytes:
+    raw = json.dumps(
+        {key: value for key, value in message_data.items() if key not in HISTORY_COLUMN_FIELDS},
+        separators=(",", ":"),
+    ).encode()
+    if 0 < PAYLOAD_COMPRESS_THRESHOLD <= len(raw):
+        return PAYLOAD_ZLIB + zlib.compress(raw)
+    return PAYLOAD_JSON + raw
+
+
+def decode_payload(payload: bytes) -> dict:
+    if payload[:1] == PAYLOAD_ZLIB:
+        return json.loads(zlib.decompress(payload[1:]))
+    return json.loads(payload[1:])
+
+
+def _message_type(event_kind: int) -> str:
+    if event_kind not in MESSAGE_KIND_NAMES:
+        raise ValueError(f"event_kind {event_kind} is unknown to this revision")
+    return MESSAGE_KIND_NAMES[event_kind]
+
+
+def _history_columns() -> set[str]:
+    return {column["name"] for column in sa.inspect(op.get_bind()).get_columns("historyevent")}
+
+
+def upgrade() -> None:
+    columns = _history_columns()
+    if "event_data" not in columns:
+        # created by create_all with the compact schema already
+        return
+    if "payload" not in columns:
+        op.add_column("historyevent", sa.Column("event_kind", sa.Integer(), nullable=True))
+        op.add_column("historyevent", sa.Column("payload", sa.LargeBinary(), nullable=True))
+
+    connection = op.get_bind()
+    # converts unconverted rows only, so an interrupted upgrade continues where it stopped
+    while rows := connection.execute(
+        sa.text(
+            "SELECT id, event_type, event_data FROM historyevent "
+            "WHERE payload IS NULL ORDER BY id LIMIT :batch_size"
+        ),
+        {"batch_size": BATCH_SIZE},
+    ).all():
+        connection.execute(
+            sa.text("UPDATE historyevent SET event_kind = :event_kind, payload = :payload WHERE id = :id"),
+            [
+                {
+                    "id": row.id,
+                    "event_kind": MESSAGE_KINDS[row.event_type],
+                    "payload": encode_payload(json.loads(row.event_data)),
+                }
+                for row in rows
+            ],
+        )
+
+    with op.batch_alter_table("historyevent") as batch_op:
+        batch_op.drop_column("event_type")
+        batch_op.drop_column("event_data")
+        batch_op.alter_column("event_kind", existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column("payload", existing_type=sa.LargeBinary(), nullable=False)
+
+
+def downgrade() -> None:
+    op.add_column("historyevent", sa.Column("event_type", sa.String(), nullable=True))
+    op.add_column("historyevent", sa.Column("event_data", sa.String(), nullable=True))
+
+    connection = op.get_bind()
+    while rows := connection.execute(
+        sa.text(
+            "SELECT id, group_name, created_at, event_kind, payload FROM historyevent "
+            "WHERE event_data IS NULL ORDER BY id LIMIT :batch_size"
+        ),
+        {"batch_size": BATCH_SIZE},
+    ).all():
+        connection.execute(
+            sa.text("UPDATE historyevent SET event_type = :event_type, event_data = :event_data WHERE id = :id"),
+            [
+                {
+                    "id": row.id,
+                    "event_type": _message_type(row.event_kind),
+                    "event_data": json.dumps({
+                        "message_type": _message_type(row.event_kind),
+                        **decode_payload(row.payload),
+                        "group_name": row.group_name,
+                        "created_at": datetime.fromisoformat(str(row.created_at)).strftime("%H:%M:%S"),
+                    }),
+                }
+                for row in rows
+            ],
+        )
+
+    with op.batch_alter_table("historyevent") as batch_op:
+        batch_op.drop_column("event_kind")
+        batch_op.drop_column("payload")
+        batch_op.alter_column("event_type", existing_type=sa.String(), nullable=False)
+        batch_op.alter_column("event_data", existing_type=sa.String(), nullable=False)
@@ -0,0 +1,38 @@
+"""history display cache
+
+Adds the pre-rendered display html, its DISPLAY_VERSION and the symbol summary to HistoryEvent.
+Existing rows are left empty and rendered by the server in the background.
+
+Revision ID: a3d9e4b1c2f7
+Revises: 6f1c2a7e9b10
+Create Date: 2026-10-19 12:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3d9e4b1c2f7'
+down_revision: Union[str, None] = '6f1c2a7e9b10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    columns = {column["name"] for column in sa.inspect(op.get_bind()).get_columns("historyevent")}
+    if "display_html" in columns:
+        # created by create_all with the display columns already
+        return
+    op.add_column("historyevent", sa.Column("display_html", sa.String(), nullable=True))
+    op.add_column("historyevent", sa.Column("display_version", sa.Integer(), nullable=True))
+    op.add_column("historyevent", sa.Column("symbol_summary", sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("historyevent") as batch_op:
+        batch_op.drop_column("symbol_summary")
+        batch_op.drop_column("display_version")
+        batch_op.drop_column("display_html")
@@ -0,0 +1,91 @@
+"""packed destiny pool
+
+Replaces the DestinyState table with one row per destiny point by DestinyPool with one packed
+record per group. The points of a group keep their order, gaps left by removed points are closed.
+
+Revision ID: c5e8f2a4d6b3
+Revises: a3d9e4b1c2f7
+Create Date: 2026-10-19 13:00:00.000000
+
+"""
+from itertools import groupby
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5e8f2a4d6b3'
+down_revision: Union[str, None] = 'a3d9e4b1c2f7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# copy of app.models as of this revision, SQLite integers are signed 64 bit and the sign bit is never used
+MAX_DESTINY_POINTS = 63
+
+
+def _has_table(table_name: str) -> bool:
+    return sa.inspect(op.get_bind()).has_table(table_name)
+
+
+def upgrade() -> None:
+    if not _has_table("destinypool"):
+        op.create_table(
+            "destinypool",
+            sa.Column("group_name", sa.String(), nullable=False),
+            sa.Column("point_count", sa.Integer(), nullable=False),
+            sa.Column("light_bits", sa.Integer(), nullable=False),
+            sa.Column("version", sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint("group_name"),
+        )
+    if not _has_table("destinystate"):
+        # created by create_all without the row per point table
+        return
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.text("SELECT group_name, id, is_light FROM destinystate ORDER BY group_name, id")
+    ).all()
+    pools = []
+    for group_name, group_rows in groupby(rows, key=lambda row: row.group_name):
+        is_light = [row.is_light for row in group_rows]
+        if len(is_light) > MAX_DESTINY_POINTS:
+            raise ValueError(f"{group_name} has {len(is_light)} destiny points, at most {MAX_DESTINY_POINTS} can be packed")
+        pools.append(
+            {
+                "group_name": group_name,
+                "point_count": len(is_light),
+                "light_bits": sum(1 << position for position, light in enumerate(is_light) if light),
+            }
+        )
+    if pools:
+        connection.execute(
+            sa.text(
+                "INSERT OR REPLACE INTO destinypool (group_name, point_count, light_bits, version) "
+                "VALUES (:group_name, :point_count, :light_bits, 0)"
+            ),
+            pools,
+        )
+    op.drop_table("destinystate")
+
+
+def downgrade() -> None:
+    op.create_table(
+        "destinystate",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("group_name", sa.String(), nullable=False),
+        sa.Column("is_light", sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint("id", "group_name"),
+    )
+    connection = op.get_bind()
+    points = [
+        {"id": point_id, "group_name": pool.group_name, "is_light": bool(pool.light_bits >> (point_id - 1) & 1)}
+        for pool in connection.execute(sa.text("SELECT group_name, point_count, light_bits FROM destinypool")).all()
+        for point_id in range(1, pool.point_count + 1)
+    ]
+    if points:
+        connection.execute(
+            sa.text("INSERT INTO destinystate (id, group_name, is_light) VALUES (:id, :group_name, :is_light)"),
+            points,
+        )
+    op.drop_table("destinypool")
@@ -0,0 +1,128 @@
+"""status flag bits
+
+Replaces the comma separated CharacterState.status_flags with the status_bits bitmask.
+Flags that are not in STATUS_FLAGS become custom flags of their group in the statusflag table.
+
+Revision ID: d7a1b3c5e9f2
+Revises: c5e8f2a4d6b3
+Create Date: 2026-10-19 13:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7a1b3c5e9f2'
+down_revision: Union[str, None] = 'c5e8f2a4d6b3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# copies of app.models as of this revision, so later changes to the models don't change what it does
+STATUS_FLAGS = {
+    "staggered": 0,
+    "disoriented": 1,
+    "immobilized": 2,
+    "ensnared": 3,
+    "stunned": 4,
+    "prone": 5,
+    "unconscious": 6,
+    "aiming": 7,
+    "guarded": 8,
+    "in_cover": 9,
+}
+CUSTOM_STATUS_FLAG_BITS = range(32, 63)
+
+
+def status_flag_names(status_bits: int, flag_bits: dict[str, int]):
+    return [
+        flag_name
+        for flag_name, bit in sorted(flag_bits.items(), key=lambda flag: flag[1])
+        if status_bits >> bit & 1
+    ]
+
+
+def _character_columns() -> set[str]:
+    return {column["name"] for column in sa.inspect(op.get_bind()).get_columns("characterstate")}
+
+
+def _group_flag_bits(connection: sa.Connection) -> dict[str, dict[str, int]]:
+    flag_bits = {}
+    for row in connection.execute(sa.text("SELECT group_name, flag_name, bit FROM statusflag")).all():
+        flag_bits.setdefault(row.group_name, dict(STATUS_FLAGS))[row.flag_name] = row.bit
+    return flag_bits
+
+
+def upgrade() -> None:
+    if not sa.inspect(op.get_bind()).has_table("statusflag"):
+        op.create_table(
+            "statusflag",
+            sa.Column("group_name", sa.String(), nullable=False),
+            sa.Column("flag_name", sa.String(), nullable=False),
+            sa.Column("bit", sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint("group_name", "flag_name"),
+        )
+    columns = _character_columns()
+    if "status_flags" not in columns:
+        # created by create_all with the status bits already
+        return
+    if "status_bits" not in columns:
+        op.add_column("characterstate", sa.Column("status_bits", sa.Integer(), nullable=False, server_default="0"))
+
+    connection = op.get_bind()
+    group_flag_bits = _group_flag_bits(connection)
+    rows = connection.execute(sa.text("SELECT group_name, char_name, status_flags FROM characterstate")).all()
+    for row in rows:
+        flag_bits = group_flag_bits.setdefault(row.group_name, dict(STATUS_FLAGS))
+        status_bits = 0
+        for flag_name in filter(None, (flag_name.strip().lower() for flag_name in (row.status_flags or "").split(","))):
+            if flag_name not in flag_bits:
+                free_bits = [bit for bit in CUSTOM_STATUS_FLAG_BITS if bit not in flag_bits.values()]
+                if not free_bits:
+                    raise ValueError(f"{row.group_name} has more than {len(CUSTOM_STATUS_FLAG_BITS)} custom status flags")
+                flag_bits[flag_name] = free_bits[0]
+                connection.execute(
+                    sa.text("INSERT INTO statusflag (group_name, flag_name, bit) VALUES (:group_name, :flag_name, :bit)"),
+                    {"group_name": row.group_name, "flag_name": flag_name, "bit": free_bits[0]},
+                )
+            status_bits |= 1 << flag_bits[flag_name]
+        connection.execute(
+            sa.text(
+                "UPDATE characterstate SET status_bits = :status_bits "
+                "WHERE group_name = :group_name AND char_name = :char_name"
+            ),
+            {"status_bits": status_bits, "group_name": row.group_name, "char_name": row.char_name},
+        )
+
+    with op.batch_alter_table("characterstate") as batch_op:
+        batch_op.drop_column("status_flags")
+
+
+def downgrade() -> None:
+    op.add_column("characterstate", sa.Column("status_flags", sa.String(), nullable=False, server_default=""))
+
+    connection = op.get_bind()
+    group_flag_bits = _group_flag_bits(connection)
+    rows = connection.execute(sa.text("SELECT group_name, char_name, status_bits FROM characterstate")).all()
+    if rows:
+        connection.execute(
+            sa.text(
+                "UPDATE characterstate SET status_flags = :status_flags "
+                "WHERE group_name = :group_name AND char_name = :char_name"
+            ),
+            [
+                {
+                    "status_flags": ",".join(
+                        status_flag_names(row.status_bits, group_flag_bits.get(row.group_name, STATUS_FLAGS))
+                    ),
+                    "group_name": row.group_name,
+                    "char_name": row.char_name,
+                }
+                for row in rows
+            ],
+        )
+
+    with op.batch_alter_table("characterstate") as batch_op:
+        batch_op.drop_column("status_bits")
+    op.drop_table("statusflag")
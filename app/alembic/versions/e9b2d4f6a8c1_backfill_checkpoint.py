@@ -0,0 +1,38 @@
+"""backfill checkpoint
+
+Adds the BackfillCheckpoint table that records the progress of batched backfills, see app/batched_backfill.py.
+
+Revision ID: e9b2d4f6a8c1
+Revises: d7a1b3c5e9f2
+Create Date: 2026-10-19 14:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'e9b2d4f6a8c1'
+down_revision: Union[str, None] = 'd7a1b3c5e9f2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    if sa.inspect(op.get_bind()).has_table("backfillcheckpoint"):
+        # created by create_all
+        return
+    op.create_table(
+        "backfillcheckpoint",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("last_id", sa.Integer(), nullable=False),
+        sa.Column("processed", sa.Integer(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("backfillcheckpoint")
@@ -0,0 +1,18 @@
+"""
+Rebuilds the materialized roll statistics from the stored history.
+
+Usage: python -m app.backfill_roll_statistics [--group GROUP_NAME]
+"""
+
+import argparse
+
+from app.db_controller import backfill_roll_statistics
+from app.models import create_db_and_tables
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--group", default=None, help="only rebuild the statistics of this group")
+    arguments = parser.parse_args()
+    create_db_and_tables()
+    replayed = backfill_roll_statistics(arguments.group)
+    print(f"Replayed {replayed} roll events into the statistics")
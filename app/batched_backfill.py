@@ -0,0 +1,185 @@
+"""
+Runs data backfills over large tables in short, checkpointed batches while the server is live.
+
+Usage: python -m app.batched_backfill [NAME] [--batch-size 500] [--duty-cycle 0.25] [--reset]
+
+Every batch is its own transaction: the next batch_size rows after the checkpointed id are read,
+rewritten and the checkpoint is advanced in the same commit, so the write lock is only held for
+one batch and an interrupted backfill continues after the last committed batch.
+Between batches the backfill sleeps so it holds the database for at most duty_cycle of the time.
+Without a name the progress of all known backfills is printed.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+from time import perf_counter
+from typing import Callable, Optional, Type
+
+from sqlalchemy import ColumnElement, Engine, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, SQLModel, delete, select
+
+from app.models import BackfillCheckpoint, get_engine
+
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "500"))
+BACKFILL_DUTY_CYCLE = float(os.getenv("BACKFILL_DUTY_CYCLE", "0.25"))
+
+
+class BatchedBackfill:
+    """A backfill that passes the rows of a model with an integer id, optionally filtered by where, to apply in
+    batches ordered by id. apply changes the rows in the session it gets and must not commit."""
+
+    name: str
+    model: Type[SQLModel]
+    apply: Callable[[Session, list], None]
+    where: Optional[ColumnElement]
+    batch_size: int
+    duty_cycle: float
+
+    def __init__(
+        self,
+        name: str,
+        model: Type[SQLModel],
+        apply: Callable[[Session, list], None],
+        where: Optional[ColumnElement] = None,
+        batch_size: int = BACKFILL_BATCH_SIZE,
+        duty_cycle: float = BACKFILL_DUTY_CYCLE,
+    ):
+        if not 0 < duty_cycle <= 1:
+            raise ValueError(f"duty_cycle has to be in (0, 1], got {duty_cycle}")
+        self.name = name
+        self.model = model
+        self.apply = apply
+        self.where = where
+        self.batch_size = batch_size
+        self.duty_cycle = duty_cycle
+
+    def checkpoint(self, session: Session) -> BackfillCheckpoint:
+        """Gets the checkpoint of the backfill, creating it at the start if it doesn't exist. Does not commit."""
+        session.execute(sqlite_insert(BackfillCheckpoint).values(name=self.name).on_conflict_do_nothing())
+        return session.get(BackfillCheckpoint, self.name)
+
+    def run_batch(self, bind: Optional[Engine] = None) -> Optional[int]:
+        """Processes the next batch in one transaction. Returns the number of processed rows,
+        None if the backfill is finished and 0 if another runner committed the batch first."""
+        with Session(bind or get_engine()) as session:
+            checkpoint = self.checkpoint(session)
+            if checkpoint.finished_at is not None:
+                session.commit()
+                return None
+            query = select(self.model).where(self.model.id > checkpoint.last_id)
+            if self.where is not None:
+                query = query.where(self.where)
+            rows = session.exec(query.order_by(self.model.id).limit(self.batch_size)).all()
+            now = datetime.now()
+            # claims the batch before rewriting it, a concurrent runner that read the same checkpoint matches nothing
+            claimed = session.execute(
+                update(BackfillCheckpoint)
+                .where(BackfillCheckpoint.name == self.name, BackfillCheckpoint.last_id == checkpoint.last_id)
+                .values(
+                    last_id=rows[-1].id if rows else checkpoint.last_id,
+                    processed=BackfillCheckpoint.processed + len(rows),
+                    updated_at=now,
+                    finished_at=now if len(rows) < self.batch_size else None,
+                )
+            ).rowcount
+            if not claimed:
+                session.rollback()
+                return 0
+            if rows:
+                self.apply(session, rows)
+            session.commit()
+        return len(rows)
+
+    def pause(self, batch_seconds: float) -> float:
+        """Seconds to wait after a batch that took batch_seconds, so the backfill runs duty_cycle of the time."""
+        return batch_seconds * (1 - self.duty_cycle) / self.duty_cycle
+
+    async def run(self, bind: Optional[Engine] = None) -> int:
+        """Runs the backfill to the end without blocking the event loop. Returns the number of processed rows."""
+        processed = 0
+        while True:
+            started = perf_counter()
+            batch_rows = self.run_batch(bind)
+            if batch_rows is None:
+                return processed
+            processed += batch_rows
+            # let the event loop serve requests between batches
+            await asyncio.sleep(self.pause(perf_counter() - started))
+
+    def run_blocking(self, bind: Optional[Engine] = None) -> int:
+        """Runs the backfill to the end in the calling thread. Returns the number of processed rows."""
+        processed = 0
+        while True:
+            started = perf_counter()
+            batch_rows = self.run_batch(bind)
+            if batch_rows is None:
+                return processed
+            processed += batch_rows
+            time.sleep(self.pause(perf_counter() - started))
+
+    def run_in_migration(self) -> int:
+        """Runs the backfill from an Alembic migration. The migration transaction is committed first and every batch
+        is committed on its own, so the migration doesn't hold the write lock for the whole table."""
+        from alembic import op
+
+        with op.get_context().autocommit_block():
+            return self.run_blocking(op.get_bind().engine)
+
+    def reset(self, bind: Optional[Engine] = None):
+        """Removes the checkpoint, the next run starts at the first row again"""
+        with Session(bind or get_engine()) as session:
+            session.exec(delete(BackfillCheckpoint).where(BackfillCheckpoint.name == self.name))
+            session.commit()
+
+
+def get_backfills() -> dict[str, BatchedBackfill]:
+    """Returns the backfills of the app by name"""
+    from app.db_controller import history_display_backfill
+    from app.dependencies import get_message_bus, register_handlers
+
+    register_handlers()
+    backfills = [history_display_backfill(get_message_bus().message_types)]
+    return {backfill.name: backfill for backfill in backfills}
+
+
+def parse_arguments():
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("name", nargs="?", default=None, help="backfill to run, prints the progress of all if omitted")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE, help="rows per transaction")
+    parser.add_argument("--duty-cycle", type=float, default=BACKFILL_DUTY_CYCLE, help="share of the time spent in batches")
+    parser.add_argument("--reset", action="store_true", help="start over at the first row")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from app.models import create_db_and_tables
+
+    arguments = parse_arguments()
+    create_db_and_tables()
+    backfills = get_backfills()
+    if arguments.name is None:
+        with Session(get_engine()) as session:
+            checkpoints = {checkpoint.name: checkpoint for checkpoint in session.exec(select(BackfillCheckpoint))}
+        for name in sorted(backfills.keys() | checkpoints.keys()):
+            checkpoint = checkpoints.get(name)
+            if checkpoint is None:
+                print(f"{name}: not started")
+            else:
+                state = f"finished {checkpoint.finished_at:%Y-%m-%d %H:%M:%S}" if checkpoint.finished_at else "running"
+                print(f"{name}: {state}, {checkpoint.processed} rows processed, last id {checkpoint.last_id}")
+    else:
+        if arguments.name not in backfills:
+            raise SystemExit(f"Unknown backfill {arguments.name}, known are: {', '.join(sorted(backfills))}")
+        backfill = backfills[arguments.name]
+        backfill.batch_size = arguments.batch_size
+        backfill.duty_cycle = arguments.duty_cycle
+        if arguments.reset:
+            backfill.reset()
+        started = perf_counter()
+        processed = backfill.run_blocking()
+        print(f"Processed {processed} rows of {arguments.name} in {perf_counter() - started:.1f}s")
@@ -0,0 +1,17 @@
+"""
+Builds the fingerprinted and precompressed static assets served under /assets.
+
+Usage: python -m app.build_static_assets [--target DIRECTORY]
+"""
+
+import argparse
+
+from app.static_assets import ENCODINGS, STATIC_BUILD_DIR, StaticAssets
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--target", default=STATIC_BUILD_DIR, help="directory the assets are written to")
+    arguments = parser.parse_args()
+    manifest = StaticAssets(build_dir=arguments.target).build()
+    encodings = ", ".join(encoding for encoding, _, _ in ENCODINGS)
+    print(f"Built {len(manifest)} assets with {encodings} variants into {arguments.target}")
@@ -1,68 +1,316 @@
 """
 This file contains the ConnectionManager class.
 
-It is responsible for managing the WebSocket connections.
+It is responsible for managing the WebSocket connections and the presence of the clients.
+Connections are indexed by group and by client, so a message for one client or the GM is only
+sent to their sockets instead of the whole group. Read-only spectators get the group broadcasts
+through a queue each, the frame is built once per broadcast and shared by all of them.
 """
 
+import json
+import logging
 import os
-from asyncio import get_event_loop, sleep
-from threading import Thread
+from asyncio import Queue, QueueFull, Task, create_task, sleep
+from time import monotonic
 
-from fastapi import WebSocket
+from fastapi import WebSocket, status
+from starlette.websockets import WebSocketState
+
+from app.admission_control import AdmissionControl, TokenBucket
+from app.static.scripts.message_types import PresenceMessage, PresenceSnapshotMessage
+
+logger = logging.getLogger(__name__)
 
 HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "30"))
 SHOW_PULSE_LEVEL = int(os.getenv("SHOW_PULSE", "1"))
+IDLE_TIMEOUT = int(os.getenv("IDLE_TIMEOUT", "300"))
+# the client name of the game master, who also receives the private messages of the players
+GM_CLIENT_NAME = os.getenv("GM_CLIENT_NAME", "gm")
+# broadcasts a spectator may fall behind before its stream is closed, the viewer reconnects with a fresh snapshot
+SPECTATOR_QUEUE_SIZE = int(os.getenv("SPECTATOR_QUEUE_SIZE", "100"))
 
 
 class ConnectionManager:
     """Class that manages the WebSocket connections."""
 
-    active_connections: dict[str, list[WebSocket]]
-    hearbeat_thread: Thread
+    active_connections: dict[str, set[WebSocket]]
+    clients: dict[str, dict[str, set[WebSocket]]]
+    last_seen: dict[str, dict[str, float]]
+    idle: dict[str, set[str]]
+    socket_clients: dict[WebSocket, str]
+    subscriptions: dict[WebSocket, set[str]]
+    frame_buckets: dict[WebSocket, TokenBucket | None]
+    spectators: dict[str, set[Queue]]
+    admission: AdmissionControl
+    heartbeat_task: Task | None
 
-    def __init__(self):
-        self.active_connections: dict[str, list[WebSocket]] = {}
-        # self.hearbeat_thread = Thread(
-        #     target=get_event_loop().run_until_complete, args=(self.heartbeat(),)
-        # )
-        # self.hearbeat_thread.start()
+    def __init__(self, admission: AdmissionControl | None = None):
+        self.active_connections: dict[str, set[WebSocket]] = {}
+        # group_name -> client_name -> open sockets of that client, one per tab
+        self.clients = {}
+        self.last_seen = {}
+        self.idle = {}
+        self.socket_clients = {}
+        # every group a connection joined, a multiplexed connection can join many
+        self.subscriptions = {}
+        self.frame_buckets = {}
+        # group_name -> queues of the Server-Sent Events streams watching the group
+        self.spectators = {}
+        self.admission = admission or AdmissionControl()
+        self.heartbeat_task = None
 
     async def heartbeat(self):
-        """Sends a heartbeat message to all active connections every HEARTBEAT_INTERVAL seconds."""
+        """Marks clients without frames for IDLE_TIMEOUT seconds as idle, checked every HEARTBEAT_INTERVAL seconds."""
         while True:
             await sleep(HEARTBEAT_INTERVAL)
             if SHOW_PULSE_LEVEL > 0:
-                print("Pulse")
+                logger.info(
+                    "Pulse",
+                    extra={
+                        "group_count": len(self.active_connections),
+                        "spectator_count": sum(len(queues) for queues in self.spectators.values()),
+                    },
+                )
                 if SHOW_PULSE_LEVEL > 1:
-                    print("Active connections: ")
                     for group_name,connections in self.active_connections.items():
-                        print(
-                            f"{len(connections)} connections in group {group_name}"
+                        logger.info(
+                            "Active connections",
+                            extra={"group_name": group_name, "connections": len(connections)},
                         )
-            for group_name,connections in self.active_connections.items():
-                for connection in connections:
-                    await connection.send_text(
-                        f"{len(connections)} connections in group {group_name}"
-                    )
-
-    async def connect(self, group_name: str, websocket: WebSocket):
-        """Adds a new WebSocket connection to the list of active connections"""
+            now = monotonic()
+            for group_name, last_seen in list(self.last_seen.items()):
+                for client_name, seen in list(last_seen.items()):
+                    # the group or the client can leave while a presence change is sent
+                    if self.last_seen.get(group_name) is not last_seen:
+                        break
+                    if client_name not in last_seen:
+                        continue
+                    if now - seen > IDLE_TIMEOUT and client_name not in self.idle[group_name]:
+                        self.idle[group_name].add(client_name)
+                        await self.broadcast_presence(group_name, client_name, "idle")
+
+    async def connect(self, group_name: str, websocket: WebSocket, client_name: str):
+        """Accepts a WebSocket connection to a single group and sends the presence snapshot to it,
+        returns False if the connection was rejected by the admission control"""
+        rejection = self.admission.check_connection(len(self.socket_clients)) or self.admission.check_subscription(
+            len(self.active_connections.get(group_name, ())),
+            len(self.clients.get(group_name, {}).get(client_name, ())),
+        )
+        if not await self.accept(websocket, client_name, rejection, group_name):
+            return False
+        await self.join(group_name, websocket, client_name)
+        return True
+
+    async def connect_multiplexed(self, websocket: WebSocket, client_name: str):
+        """Accepts a WebSocket connection that subscribes to groups later on, returns False if it was rejected"""
+        return await self.accept(websocket, client_name, self.admission.check_connection(len(self.socket_clients)))
+
+    async def accept(self, websocket: WebSocket, client_name: str, rejection: str | None, group_name: str = None):
+        """Accepts and registers a connection or closes it if the admission control gave a rejection reason"""
+        if rejection is not None:
+            logger.warning(
+                "Rejected connection", extra={"group_name": group_name, "client_name": client_name, "reason": rejection}
+            )
+            # closing before accept answers the handshake with 403, so nothing is parsed or stored
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=rejection)
+            return False
         await websocket.accept()
+        if self.heartbeat_task is None:
+            self.heartbeat_task = create_task(self.heartbeat())
+        self.socket_clients[websocket] = client_name
+        self.subscriptions[websocket] = set()
+        self.frame_buckets[websocket] = self.admission.create_bucket()
+        return True
+
+    async def join(self, group_name: str, websocket: WebSocket, client_name: str):
+        """Adds an accepted connection to a group and sends the presence snapshot of the group to it"""
         if group_name not in self.active_connections:
-            self.active_connections[group_name] = []
-        self.active_connections[group_name].append(websocket)
+            self.active_connections[group_name] = set()
+            self.clients[group_name] = {}
+            self.last_seen[group_name] = {}
+            self.idle[group_name] = set()
+        is_new_client = client_name not in self.clients[group_name]
+        if is_new_client:
+            await self.broadcast_presence(group_name, client_name, "joined")
+        self.active_connections[group_name].add(websocket)
+        self.subscriptions[websocket].add(group_name)
+        self.clients[group_name].setdefault(client_name, set()).add(websocket)
+        await self.touch(group_name, client_name)
+        await self.send_personal_message(
+            PresenceSnapshotMessage(
+                group_name=group_name,
+                author=client_name,
+                online=sorted(self.clients[group_name]),
+                idle=sorted(self.idle[group_name]),
+            ).to_json(),
+            websocket,
+        )
 
-    def disconnect(self, group_name: str, websocket: WebSocket):
-        """Removes a WebSocket connection from the list of active connections"""
-        self.active_connections[group_name].remove(websocket)
+    async def subscribe(self, group_name: str, websocket: WebSocket):
+        """Adds a multiplexed connection to one more group, returns the rejection reason or None if it was added"""
+        if group_name in self.subscriptions[websocket]:
+            return None
+        client_name = self.socket_clients[websocket]
+        rejection = self.admission.check_subscription(
+            len(self.active_connections.get(group_name, ())),
+            len(self.clients.get(group_name, {}).get(client_name, ())),
+            len(self.subscriptions[websocket]),
+        )
+        if rejection is None:
+            await self.join(group_name, websocket, client_name)
+        return rejection
+
+    async def unsubscribe(self, group_name: str, websocket: WebSocket):
+        """Removes a multiplexed connection from a group, the connection stays open"""
+        await self.leave(group_name, websocket, self.socket_clients[websocket])
+
+    def disconnect(self, group_name: str, websocket: WebSocket, client_name: str = None):
+        """Removes a WebSocket connection from the active connections of a group, returns True if the client has no sockets left"""
+        self.active_connections[group_name].discard(websocket)
+        self.subscriptions.get(websocket, set()).discard(group_name)
+        client_name = client_name or self.socket_clients.get(websocket)
+        client_left = False
+        client_connections = self.clients[group_name].get(client_name)
+        if client_connections is not None:
+            client_connections.discard(websocket)
+            if not client_connections:
+                del self.clients[group_name][client_name]
+                self.last_seen[group_name].pop(client_name, None)
+                self.idle[group_name].discard(client_name)
+                client_left = True
         if not self.active_connections[group_name]:
             del self.active_connections[group_name]
+            del self.clients[group_name]
+            del self.last_seen[group_name]
+            del self.idle[group_name]
+        return client_left
+
+    async def leave(self, group_name: str, websocket: WebSocket, client_name: str):
+        """Removes a WebSocket connection from a group and tells the group if the client went offline, does nothing if it was already removed"""
+        if group_name not in self.subscriptions.get(websocket, ()):
+            return
+        if self.disconnect(group_name, websocket, client_name) and group_name in self.active_connections:
+            await self.broadcast_presence(group_name, client_name, "left")
+
+    async def close(self, websocket: WebSocket):
+        """Removes a WebSocket connection from all of its groups and forgets it, does nothing if it was already closed"""
+        if websocket not in self.socket_clients:
+            return
+        client_name = self.socket_clients[websocket]
+        for group_name in list(self.subscriptions[websocket]):
+            await self.leave(group_name, websocket, client_name)
+        del self.socket_clients[websocket]
+        del self.subscriptions[websocket]
+        self.frame_buckets.pop(websocket, None)
+
+    async def prune(self, group_name: str):
+        """Removes sockets of a group that were closed without a clean disconnect, returns how many were removed"""
+        dead_connections = [
+            connection
+            for connection in self.active_connections.get(group_name, ())
+            if WebSocketState.DISCONNECTED in (connection.client_state, connection.application_state)
+        ]
+        for connection in dead_connections:
+            await self.close(connection)
+        return len(dead_connections)
+
+    def check_spectator(self, group_name: str):
+        """Returns the reason the admission control rejects one more spectator of a group, None if it is admitted"""
+        rejection = self.admission.check_spectator(len(self.spectators.get(group_name, ())))
+        if rejection is not None:
+            logger.warning("Rejected spectator", extra={"group_name": group_name, "reason": rejection})
+        return rejection
+
+    def add_spectator(self, group_name: str):
+        """Registers a read-only spectator of a group, returns the queue of its broadcast frames"""
+        queue = Queue(SPECTATOR_QUEUE_SIZE)
+        self.spectators.setdefault(group_name, set()).add(queue)
+        return queue
+
+    def remove_spectator(self, group_name: str, queue: Queue):
+        """Forgets a spectator of a group, does nothing if it was already removed"""
+        queues = self.spectators.get(group_name)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.spectators[group_name]
+
+    def send_to_spectators(self, group_name: str, message: str, display_html: str | None = None):
+        """Queues a message as one shared Server-Sent Events frame for every spectator of a group, followed by a
+        "history" event with the display html of the message if it has one, so spectators show the same history
+        line as the players. A spectator that fell SPECTATOR_QUEUE_SIZE frames behind is dropped and its stream ends with None."""
+        queues = self.spectators.get(group_name)
+        if not queues:
+            return
+        # JSON has no raw newlines, so the payload always fits into a single data line
+        frame = f"data: {message}\n\n"
+        if display_html:
+            frame += f"event: history\ndata: {json.dumps(display_html)}\n\n"
+        frame = frame.encode()
+        for queue in tuple(queues):
+            try:
+                queue.put_nowait(frame)
+            except QueueFull:
+                self.remove_spectator(group_name, queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    def allow_frame(self, websocket: WebSocket):
+        """Returns False if the connection exceeded its inbound frame rate"""
+        return self.admission.check_frame(self.frame_buckets.get(websocket))
+
+    def is_first_drop(self, websocket: WebSocket):
+        """Returns True if the last frame was the first one dropped since the bucket of the connection had a token"""
+        bucket = self.frame_buckets.get(websocket)
+        return bucket is not None and bucket.dropped == 1
+
+    async def touch(self, group_name: str, client_name: str):
+        """Records activity of a client, an idle client becomes active again"""
+        self.last_seen[group_name][client_name] = monotonic()
+        if client_name in self.idle[group_name]:
+            self.idle[group_name].discard(client_name)
+            await self.broadcast_presence(group_name, client_name, "active")
+
+    async def broadcast_presence(self, group_name: str, client_name: str, status: str):
+        """Sends a single presence change to the group"""
+        if group_name in self.active_connections:
+            await self.broadcast(
+                group_name,
+                PresenceMessage(
+                    group_name=group_name, author=client_name, client_name=client_name, status=status
+                ).to_json(),
+            )
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
         """Sends a message to a specific WebSocket connection"""
         await websocket.send_text(message)
 
-    async def broadcast(self, group_name: str, message: str):
-        """Sends a message to all active WebSocket connections in a group"""
-        for connection in self.active_connections[group_name]:
+    async def broadcast(self, group_name: str, message: str, display_html: str | None = None):
+        """Sends a message to all active WebSocket connections and spectators of a group,
+        display_html is the history line the spectators show for it"""
+        self.send_to_spectators(group_name, message, display_html)
+        # a copy, sockets can leave the group while a send is awaited
+        for connection in tuple(self.active_connections.get(group_name, ())):
+            await connection.send_text(message)
+
+    async def broadcast_except(self, group_name: str, message: str, client_name: str):
+        """Sends a message to all active WebSocket connections in a group except the ones of a client"""
+        excluded = self.clients.get(group_name, {}).get(client_name, ())
+        for connection in tuple(self.active_connections.get(group_name, ())):
+            if connection not in excluded:
+                await connection.send_text(message)
+
+    async def send_to_client(self, group_name: str, client_name: str, message: str):
+        """Sends a message to every open tab of a client in a group"""
+        for connection in tuple(self.clients.get(group_name, {}).get(client_name, ())):
             await connection.send_text(message)
+
+    async def send_to_gm(self, group_name: str, message: str):
+        """Sends a message only to the game master of a group"""
+        await self.send_to_client(group_name, GM_CLIENT_NAME, message)
+
+    async def send_to_clients(self, group_name: str, client_names: list[str], message: str):
+        """Sends a message to every open tab of some clients in a group, each client once"""
+        for client_name in dict.fromkeys(client_names):
+            await self.send_to_client(group_name, client_name, message)
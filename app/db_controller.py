@@ -1,13 +1,34 @@
 """This module contains the functions that interact with the database."""
 
+import logging
+from collections import Counter
 from datetime import datetime
 from typing import Type
 import random
 import json
 
-from sqlmodel import Session, select
+from sqlalchemy import literal, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, delete, func, or_, select
 
-from app.models import DestinyState, HistoryEvent, engine, CharacterState
+from app.batched_backfill import BACKFILL_BATCH_SIZE, BatchedBackfill
+from app.logging_config import log_payload
+from app.models import (
+    DestinyPool,
+    MAX_DESTINY_POINTS,
+    HistoryEvent,
+    get_engine,
+    CharacterState,
+    StatusFlag,
+    CUSTOM_STATUS_FLAG_BITS,
+    STATUS_FLAGS,
+    RollStatistic,
+    DiceFaceStatistic,
+    HISTORY_SEARCH_TABLE,
+    MESSAGE_KINDS,
+    encode_payload,
+    index_history_event,
+)
 from app.static.scripts.message_types import (
     DestinyAddMessage,
     DestinySwitchMessage,
@@ -16,72 +37,112 @@ from app.static.scripts.message_types import (
     CharacterCreateMessage,
     CharacterDeleteMessage,
     CharacterUpdateMessage,
+    CharacterStatusToggleMessage,
     RollResultMessage,
     RollReqestMessage,
+    RollBatchRequestMessage,
+    RollBatchResultMessage,
+    count_roll_symbols,
+    DISPLAY_VERSION,
 )
 
+logger = logging.getLogger(__name__)
+
 #+ DESTINY
 def get_destiny_state(group_name: str, session: Session):
     """Gets the current state of the destiny points for a group."""
-    return session.exec(
-        select(DestinyState).where(DestinyState.group_name == group_name)
-    ).all()
+    destiny_pool = session.get(DestinyPool, group_name)
+    return destiny_pool.points if destiny_pool else []
+
+
+def _destiny_point_error(message: DestinySwitchMessage | DestinyRemoveMessage, session: Session):
+    """Explains why a conditional update of the destiny pool matched no record."""
+    destiny_point = next(
+        (point for point in get_destiny_state(message.group_name, session) if point.id == message.point_id), None
+    )
+    if destiny_point is None:
+        return ValueError(f"No state found for {message.group_name} and {message.point_id}")
+    # a client that switched an outdated point gets the stored state back instead of a second switch
+    return ValueError(
+        f"Destiny point {message.point_id} of {message.group_name} is already {'light' if destiny_point.is_light else 'dark'}"
+    )
 
 
 async def add_destiny_state(message: DestinyAddMessage):
-    """Adds a new destiny state to the database."""
-    with Session(engine) as session:
-        new_state_id = (
-            len(
-                session.exec(
-                    select(DestinyState).where(
-                        DestinyState.group_name == message.group_name
-                    )
-                ).all()
+    """Appends a destiny point to the pool of the group, creating the pool with the first point."""
+    with Session(get_engine()) as session:
+        new_state_id = session.execute(
+            sqlite_insert(DestinyPool)
+            .values(group_name=message.group_name, point_count=1, light_bits=int(message.is_light), version=1)
+            .on_conflict_do_update(
+                index_elements=[DestinyPool.group_name],
+                set_={
+                    "light_bits": DestinyPool.light_bits.op("|")(
+                        literal(int(message.is_light)).op("<<")(DestinyPool.point_count)
+                    ),
+                    "point_count": DestinyPool.point_count + 1,
+                    "version": DestinyPool.version + 1,
+                },
+                where=DestinyPool.point_count < MAX_DESTINY_POINTS,
             )
-            + 1
-        )
-        new_state = DestinyState(
-            group_name=message.group_name, is_light=message.is_light, id=new_state_id
-        )
-        session.add(new_state)
+            .returning(DestinyPool.point_count)
+        ).scalar()
+        if new_state_id is None:
+            raise ValueError(f"{message.group_name} already has {MAX_DESTINY_POINTS} destiny points")
         session.commit()
         message.point_id = new_state_id
     return message
 
 
 async def update_destiny_state(message: DestinySwitchMessage):
-    """Updates the state of a destiny point."""
-    with Session(engine) as session:
-        destiny_state = session.exec(
-            select(DestinyState).where(
-                DestinyState.group_name == message.group_name,
-                DestinyState.id == message.point_id,
+    """Updates the state of a destiny point, only if it still has the state the client saw."""
+    if not 0 < message.point_id <= MAX_DESTINY_POINTS:
+        raise ValueError(f"No state found for {message.group_name} and {message.point_id}")
+    with Session(get_engine()) as session:
+        bit = 1 << (message.point_id - 1)
+        light_bits = DestinyPool.light_bits
+        switched = session.execute(
+            update(DestinyPool)
+            .where(
+                DestinyPool.group_name == message.group_name,
+                DestinyPool.point_count >= message.point_id,
+                light_bits.op("&")(bit) == (bit if message.was_light else 0),
             )
-        ).first()
-        if not destiny_state:
-            raise ValueError(
-                f"No state found for {message.group_name} and {message.point_id}"
+            .values(
+                light_bits=light_bits.op("&")(~bit) if message.was_light else light_bits.op("|")(bit),
+                version=DestinyPool.version + 1,
             )
-        destiny_state.is_light = not message.was_light
+            .returning(DestinyPool.version)
+        ).first()
+        if switched is None:
+            raise _destiny_point_error(message, session)
         session.commit()
     return message
 
+
 async def delete_destiny_state(message: DestinyRemoveMessage):
-    """Deletes a destiny point."""
-    with Session(engine) as session:
-        destiny_state = session.exec(
-            select(DestinyState).where(
-                DestinyState.group_name == message.group_name,
-                DestinyState.id == message.point_id,
+    """Deletes a destiny point, the points after it move down one id so the ids stay 1 to point_count."""
+    if not 0 < message.point_id <= MAX_DESTINY_POINTS:
+        raise ValueError(f"No state found for {message.group_name} and {message.point_id}")
+    with Session(get_engine()) as session:
+        position = message.point_id - 1
+        light_bits = DestinyPool.light_bits
+        deleted = session.execute(
+            update(DestinyPool)
+            .where(DestinyPool.group_name == message.group_name, DestinyPool.point_count >= message.point_id)
+            .values(
+                light_bits=light_bits.op("&")((1 << position) - 1).op("|")(
+                    light_bits.op(">>")(position + 1).op("<<")(position)
+                ),
+                point_count=DestinyPool.point_count - 1,
+                version=DestinyPool.version + 1,
             )
+            .returning(DestinyPool.version)
         ).first()
-        if not destiny_state:
-            raise ValueError(
-                f"No state found for {message.group_name} and {message.point_id}"
-            )
-        session.delete(destiny_state)
+        if deleted is None:
+            raise _destiny_point_error(message, session)
         session.commit()
+    return message
 #+
 
 #+ HISTORY
@@ -94,19 +155,119 @@ def get_history(group_name: str, session: Session):
     ).all()
 
 
+def get_recent_groups(limit: int, session: Session):
+    """Gets the names of the groups with the most recent history events."""
+    return session.exec(
+        select(HistoryEvent.group_name)
+        .group_by(HistoryEvent.group_name)
+        .order_by(func.max(HistoryEvent.created_at).desc())
+        .limit(limit)
+    ).all()
+
+
+def get_symbol_summary(message: Type[JediMessage]):
+    """Returns the counted symbols of a roll result as JSON, per pool for batch rolls, None for other messages."""
+    if message.message_type == "RollResultMessage":
+        return json.dumps(count_roll_symbols(json.loads(message.result)))
+    if message.message_type == "RollBatchResultMessage":
+        return json.dumps({
+            pool_name: count_roll_symbols(result_dict)
+            for pool_name, result_dict in json.loads(message.results).items()
+        })
+    return None
+
+
 async def store_history_event(message: Type[JediMessage]):
-    """Stores a historical event in the database."""
-    print("Storing history event", message.to_json())
-    with Session(engine) as session:
+    """Stores a historical event in the database, rendered once for display."""
+    log_payload(logger, "Storing history event", dict(message.__dict__))
+    with Session(get_engine()) as session:
         new_event = HistoryEvent(
             group_name=message.group_name,
             created_at=datetime.now(),
-            event_type=message.message_type,
-            event_data=message.to_json(),
+            event_kind=MESSAGE_KINDS[message.message_type],
+            payload=encode_payload(message.__dict__),
+            display_html=message.display_event,
+            display_version=DISPLAY_VERSION,
+            symbol_summary=get_symbol_summary(message),
         )
         session.add(new_event)
+        session.flush()
+        index_history_event(session, new_event.id, message.__dict__)
         session.commit()
     return message
+
+
+def render_history_event(history_event: HistoryEvent, message_types: dict[str, Type[JediMessage]]):
+    """Renders the display html and symbol summary of a stored event with the current DISPLAY_VERSION, does not commit."""
+    message = message_types[history_event.event_type].from_json(history_event.json_data)
+    history_event.display_html = message.display_event
+    history_event.display_version = DISPLAY_VERSION
+    history_event.symbol_summary = get_symbol_summary(message)
+    return history_event.display_html
+
+
+def get_history_html(group_name: str, session: Session, message_types: dict[str, Type[JediMessage]]):
+    """Gets the display html of the history of a group, oldest first. Only the html columns are loaded,
+    stale events are loaded in full and rendered on the fly."""
+    history_rows = session.exec(
+        select(HistoryEvent.id, HistoryEvent.display_html, HistoryEvent.display_version)
+        .where(HistoryEvent.group_name == group_name)
+        .order_by(HistoryEvent.created_at, HistoryEvent.id)
+    ).all()
+    stale_html = {}
+    if any(display_version != DISPLAY_VERSION for _, _, display_version in history_rows):
+        stale_events = session.exec(
+            select(HistoryEvent).where(
+                HistoryEvent.group_name == group_name,
+                or_(HistoryEvent.display_version.is_(None), HistoryEvent.display_version != DISPLAY_VERSION),
+            )
+        )
+        stale_html = {history_event.id: render_history_event(history_event, message_types) for history_event in stale_events}
+    # an event the background re-render finished in between keeps the html of the first query
+    return [
+        display_html if display_version == DISPLAY_VERSION else stale_html.get(event_id, display_html)
+        for event_id, display_html, display_version in history_rows
+    ]
+
+
+def history_display_backfill(message_types: dict[str, Type[JediMessage]], batch_size: int = BACKFILL_BATCH_SIZE):
+    """The backfill that re-renders every event rendered with an older DISPLAY_VERSION, one checkpoint per version."""
+    return BatchedBackfill(
+        f"history_display_v{DISPLAY_VERSION}",
+        HistoryEvent,
+        lambda session, history_events: [render_history_event(history_event, message_types) for history_event in history_events],
+        where=or_(HistoryEvent.display_version.is_(None), HistoryEvent.display_version != DISPLAY_VERSION),
+        batch_size=batch_size,
+    )
+
+
+async def rerender_stale_history(message_types: dict[str, Type[JediMessage]], batch_size: int = BACKFILL_BATCH_SIZE):
+    """Re-renders every event rendered with an older DISPLAY_VERSION in batches. Returns the number of re-rendered events."""
+    return await history_display_backfill(message_types, batch_size).run()
+
+
+def search_history(group_name: str, query: str, session: Session, page: int = 0, page_size: int = 20):
+    """Searches the history text of a group, every word of the query has to match, the last one as prefix."""
+    words = query.split()
+    if not words:
+        return []
+    match = " ".join(f'"{word.replace(chr(34), chr(34) * 2)}"' for word in words) + "*"
+    return session.execute(
+        text(
+            f"SELECT {HISTORY_SEARCH_TABLE}.rowid AS id, historyevent.created_at, "
+            f"{HISTORY_SEARCH_TABLE}.author, {HISTORY_SEARCH_TABLE}.char_name, "
+            f"{HISTORY_SEARCH_TABLE}.comment, {HISTORY_SEARCH_TABLE}.message_type "
+            f"FROM {HISTORY_SEARCH_TABLE} JOIN historyevent ON historyevent.id = {HISTORY_SEARCH_TABLE}.rowid "
+            f"WHERE {HISTORY_SEARCH_TABLE} MATCH :match AND {HISTORY_SEARCH_TABLE}.group_name = :group_name "
+            "ORDER BY rank LIMIT :limit OFFSET :offset"
+        ),
+        {
+            "match": match,
+            "group_name": group_name,
+            "limit": page_size,
+            "offset": page * page_size,
+        },
+    ).mappings().all()
 #+
 
 #+ CHARACTER
@@ -116,22 +277,46 @@ def get_character_states(group_name: str, session: Session):
         select(CharacterState).where(CharacterState.group_name == group_name)
     ).all()
 
+
+def get_status_flags(group_name: str, session: Session):
+    """Gets the bits of the predefined and the custom status flags of a group."""
+    custom_flags = session.exec(select(StatusFlag).where(StatusFlag.group_name == group_name)).all()
+    return {**STATUS_FLAGS, **{status_flag.flag_name: status_flag.bit for status_flag in custom_flags}}
+
+
+def get_status_mask(group_name: str, flag_names: list[str], session: Session):
+    """Combines the bits of the status flags, unknown flags become custom flags of the group, does not commit."""
+    flag_bits = get_status_flags(group_name, session)
+    free_bits = [bit for bit in CUSTOM_STATUS_FLAG_BITS if bit not in flag_bits.values()]
+    status_mask = 0
+    for flag_name in filter(None, (flag_name.strip().lower() for flag_name in flag_names)):
+        if flag_name not in flag_bits:
+            if not free_bits:
+                raise ValueError(f"{group_name} already has {len(CUSTOM_STATUS_FLAG_BITS)} custom status flags")
+            flag_bits[flag_name] = free_bits.pop(0)
+            session.add(StatusFlag(group_name=group_name, flag_name=flag_name, bit=flag_bits[flag_name]))
+        status_mask |= 1 << flag_bits[flag_name]
+    return status_mask
+
+
 async def create_character_state(message: CharacterCreateMessage):
     """Creates a new character state."""
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
+        character_fields = {key: value for key, value in message.__dict__.items() if key in CharacterState.model_fields}
+        character_fields["status_bits"] = get_status_mask(message.group_name, message.status_flags.split(","), session)
         if existing := session.exec( select(CharacterState).where( CharacterState.group_name == message.group_name, CharacterState.char_name == message.char_name, ) ).first():
-            for key in existing.model_dump():
-                setattr(existing, key, getattr(message, key))
+            for key, value in character_fields.items():
+                setattr(existing, key, value)
             session.commit()
             return message # TODO MAYBE mark as updated?
-        new_state = CharacterState(**message.__dict__)
+        new_state = CharacterState(**character_fields)
         session.add(new_state)
         session.commit()
     return message
 
 async def update_character_state(message: CharacterUpdateMessage):
     """Updates the state of a character."""
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         character_state = session.exec(
             select(CharacterState).where(
                 CharacterState.group_name == message.group_name,
@@ -142,13 +327,56 @@ async def update_character_state(message: CharacterUpdateMessage):
             raise ValueError(
                 f"No state found for {message.group_name} and {message.char_name}"
             )
-        setattr(character_state, message.trait_name, message.trait_value)
+        if message.trait_name == "status_flags":
+            # replaces all flags, CharacterStatusToggleMessage changes a single one
+            character_state.status_bits = get_status_mask(message.group_name, str(message.trait_value).split(","), session)
+        else:
+            trait_field = CharacterState.model_fields.get(message.trait_name)
+            if trait_field is not None and trait_field.annotation is int:
+                # SQLite stores any text in an integer column, so the value is checked before the commit
+                try:
+                    message.trait_value = int(message.trait_value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"{message.trait_name} has to be an integer, got {message.trait_value!r}") from None
+            setattr(character_state, message.trait_name, message.trait_value)
+        session.commit()
+    return message
+
+
+async def toggle_character_status(message: CharacterStatusToggleMessage):
+    """Sets or clears a single status flag with one update, a flag that is already in that state is rejected."""
+    message.flag_name = message.flag_name.strip().lower()
+    # the flags are sent to the clients as comma separated list
+    if not message.flag_name or "," in message.flag_name:
+        raise ValueError(f"Invalid status flag {message.flag_name!r}")
+    with Session(get_engine()) as session:
+        status_mask = get_status_mask(message.group_name, [message.flag_name], session)
+        status_bits = CharacterState.status_bits
+        toggled = session.execute(
+            update(CharacterState)
+            .where(
+                CharacterState.group_name == message.group_name,
+                CharacterState.char_name == message.char_name,
+                status_bits.op("&")(status_mask) == (0 if message.is_set else status_mask),
+            )
+            .values(
+                status_bits=status_bits.op("|")(status_mask) if message.is_set else status_bits.op("&")(~status_mask)
+            )
+        ).rowcount
+        if not toggled:
+            if session.get(CharacterState, (message.group_name, message.char_name)) is None:
+                raise ValueError(
+                    f"No state found for {message.group_name} and {message.char_name}"
+                )
+            raise ValueError(
+                f"{message.char_name} is {'already' if message.is_set else 'not'} {message.flag_name}"
+            )
         session.commit()
     return message
 
 async def delete_character_state(message: CharacterDeleteMessage):
     """Deletes a character state."""
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         character_state = session.exec(
             select(CharacterState).where(
                 CharacterState.group_name == message.group_name,
@@ -165,9 +393,7 @@ async def delete_character_state(message: CharacterDeleteMessage):
 #+
 
 #+ ROLL
-async def roll_dice(message: RollReqestMessage):
-    """Rolls dice for a character."""
-    dice_definitions = {
+DICE_DEFINITIONS = {
     'proficiency' : [
         "success_success",
         "success_success",
@@ -245,11 +471,21 @@ async def roll_dice(message: RollReqestMessage):
         "light_light",
         "light_light",
         "light_light",
-    ]}
-    results:dict[str,list[str]] ={
-        dice: [random.choice(dice_definitions.get(dice,[dice])) for _ in range(count)]
-        for dice, count in json.loads(message.dice_pool).items()
+    ],
+}
+
+
+def roll_pool(dice_pool: dict[str, int]):
+    """Rolls every dice of a pool and returns the faces per dice type."""
+    return {
+        dice: [random.choice(DICE_DEFINITIONS.get(dice,[dice])) for _ in range(count)]
+        for dice, count in dice_pool.items()
     }
+
+
+async def roll_dice(message: RollReqestMessage):
+    """Rolls dice for a character."""
+    results:dict[str,list[str]] = roll_pool(json.loads(message.dice_pool))
     return  RollResultMessage(
         group_name=message.group_name,
         char_name=message.char_name,
@@ -257,5 +493,143 @@ async def roll_dice(message: RollReqestMessage):
         dice_pool=message.dice_pool,
         result=json.dumps(results),
         comment=message.comment,
+        is_private=message.is_private,
+    )
+
+
+async def roll_dice_batch(message: RollBatchRequestMessage):
+    """Rolls multiple named dice pools in one pass, e.g. for a squad of NPCs."""
+    results:dict[str,dict[str,list[str]]] = {
+        pool_name: roll_pool(dice_pool)
+        for pool_name, dice_pool in json.loads(message.dice_pools).items()
+    }
+    return RollBatchResultMessage(
+        group_name=message.group_name,
+        char_name=message.char_name,
+        author=message.author,
+        dice_pools=message.dice_pools,
+        results=json.dumps(results),
+        comment=message.comment,
+        is_private=message.is_private,
     )
+#+
+
+#+ STATISTICS
+def get_roll_statistics(group_name: str, session: Session):
+    """Gets the roll statistics of all characters of a group."""
+    return session.exec(
+        select(RollStatistic).where(RollStatistic.group_name == group_name)
+    ).all()
+
+
+def get_roll_statistic(group_name: str, char_name: str, session: Session):
+    """Gets the roll statistics of a single character."""
+    return session.get(RollStatistic, (group_name, char_name))
 
+
+def get_dice_face_statistics(group_name: str, char_name: str, session: Session):
+    """Gets how often each face of each dice type was rolled by a character."""
+    return session.exec(
+        select(DiceFaceStatistic).where(
+            DiceFaceStatistic.group_name == group_name,
+            DiceFaceStatistic.char_name == char_name,
+        )
+    ).all()
+
+
+def add_roll_to_statistics(session: Session, group_name: str, char_name: str, result_dict: dict[str, list[str]]):
+    """Adds a single rolled pool to the running statistics of a character with one upsert per table, does not commit."""
+    symbols = count_roll_symbols(result_dict)
+    histogram = RollStatistic.net_success_histogram
+    histogram_path = f'$."{symbols["s"]}"'
+    session.execute(
+        sqlite_insert(RollStatistic)
+        .values(
+            group_name=group_name,
+            char_name=char_name,
+            roll_count=1,
+            triumph_count=symbols["x"],
+            despair_count=symbols["y"],
+            net_success_total=symbols["s"],
+            net_advantage_total=symbols["a"],
+            net_success_histogram=json.dumps({str(symbols["s"]): 1}),
+        )
+        .on_conflict_do_update(
+            index_elements=[RollStatistic.group_name, RollStatistic.char_name],
+            set_={
+                "roll_count": RollStatistic.roll_count + 1,
+                "triumph_count": RollStatistic.triumph_count + symbols["x"],
+                "despair_count": RollStatistic.despair_count + symbols["y"],
+                "net_success_total": RollStatistic.net_success_total + symbols["s"],
+                "net_advantage_total": RollStatistic.net_advantage_total + symbols["a"],
+                # the histogram is counted up inside SQLite, so the stored row is never loaded
+                "net_success_histogram": func.json_set(
+                    histogram, histogram_path, func.coalesce(func.json_extract(histogram, histogram_path), 0) + 1
+                ),
+            },
+        )
+    )
+
+    face_counts = Counter(
+        (dice_type, face) for dice_type, faces in result_dict.items() for face in faces
+    )
+    if not face_counts:
+        return
+    face_insert = sqlite_insert(DiceFaceStatistic).values(
+        [
+            {"group_name": group_name, "char_name": char_name, "dice_type": dice_type, "face": face, "count": count}
+            for (dice_type, face), count in face_counts.items()
+        ]
+    )
+    session.execute(
+        face_insert.on_conflict_do_update(
+            index_elements=[
+                DiceFaceStatistic.group_name,
+                DiceFaceStatistic.char_name,
+                DiceFaceStatistic.dice_type,
+                DiceFaceStatistic.face,
+            ],
+            set_={"count": DiceFaceStatistic.count + face_insert.excluded.count},
+        )
+    )
+
+
+def add_message_to_statistics(session: Session, message: RollResultMessage | RollBatchResultMessage):
+    """Adds every pool of a roll result message to the statistics, does not commit."""
+    if message.message_type == "RollBatchResultMessage":
+        for result_dict in json.loads(message.results).values():
+            add_roll_to_statistics(session, message.group_name, message.char_name, result_dict)
+    else:
+        add_roll_to_statistics(session, message.group_name, message.char_name, json.loads(message.result))
+
+
+async def update_roll_statistics(message: RollResultMessage | RollBatchResultMessage):
+    """Updates the statistics of the rolling character with a roll result."""
+    with Session(get_engine()) as session:
+        add_message_to_statistics(session, message)
+        session.commit()
+    return message
+
+
+def backfill_roll_statistics(group_name: str = None):
+    """Rebuilds the roll statistics from the history, for one group or all groups. Returns the number of replayed events."""
+    with Session(get_engine()) as session:
+        statistic_delete = delete(RollStatistic)
+        face_delete = delete(DiceFaceStatistic)
+        history_query = select(HistoryEvent).where(
+            HistoryEvent.event_kind.in_([MESSAGE_KINDS["RollResultMessage"], MESSAGE_KINDS["RollBatchResultMessage"]])
+        )
+        if group_name is not None:
+            statistic_delete = statistic_delete.where(RollStatistic.group_name == group_name)
+            face_delete = face_delete.where(DiceFaceStatistic.group_name == group_name)
+            history_query = history_query.where(HistoryEvent.group_name == group_name)
+        session.exec(statistic_delete)
+        session.exec(face_delete)
+        replayed = 0
+        for history_event in session.exec(history_query.order_by(HistoryEvent.id)):
+            message_type = RollBatchResultMessage if history_event.event_type == "RollBatchResultMessage" else RollResultMessage
+            add_message_to_statistics(session, message_type.from_json(history_event.json_data))
+            replayed += 1
+        session.commit()
+    return replayed
+#+
@@ -1,41 +1,136 @@
 """This module contains the dependencies that will be used in the FastAPI application."""
 
+import os
+import pathlib
+from functools import cache
+
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 from sqlmodel import Session
 
 from app.connection_manager import ConnectionManager
 from app.db_controller import (
+    get_recent_groups,
     store_history_event,
     add_destiny_state,
     delete_destiny_state,
     update_destiny_state,
     update_character_state,
+    toggle_character_status,
     delete_character_state,
     create_character_state,
     roll_dice,
+    roll_dice_batch,
+    update_roll_statistics,
 )
 
+from app.group_lifecycle import GroupLifecycleManager
+from app.initiative_index import InitiativeIndex
 from app.message_bus import MessageBus
-from app.models import engine
+from app.message_validation import MessageValidator
+from app.models import get_engine
+from app.static_assets import static_assets
 
 
 def get_session():
     """Yields a new session to the database"""
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         yield session
 
 
-templates = Jinja2Templates(directory="app/templates")
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", ".jinja_cache")
+
+
+# the providers build their object on first use, the lifespan calls them before the first request,
+# so importing the app has no side effects and scripts only build what they use
+@cache
+def get_templates():
+    """Returns the Jinja templates with a bytecode cache in TEMPLATE_CACHE_DIR"""
+    pathlib.Path(TEMPLATE_CACHE_DIR).mkdir(exist_ok=True)
+    templates = Jinja2Templates(
+        directory="app/templates",
+        bytecode_cache=FileSystemBytecodeCache(TEMPLATE_CACHE_DIR),
+    )
+    templates.env.globals["static_url"] = static_assets.url
+    return templates
+
+
+@cache
+def get_manager():
+    """Returns the ConnectionManager of the app"""
+    return ConnectionManager()
+
+
+@cache
+def get_message_bus():
+    """Returns the MessageBus of the app, the handlers are wired by register_handlers"""
+    return MessageBus(get_manager())
+
+
+@cache
+def get_initiative_index():
+    """Returns the InitiativeIndex of the app"""
+    return InitiativeIndex(get_manager())
+
+
+@cache
+def get_message_validator():
+    """Returns the MessageValidator of the app, compiled by register_handlers"""
+    return MessageValidator(get_message_bus())
+
+
+@cache
+def get_group_lifecycle():
+    """Returns the GroupLifecycleManager of the app"""
+    return GroupLifecycleManager(get_manager(), get_initiative_index())
+
+
+def build_services():
+    """Creates the engine, the connection manager, the message bus and the indexes, called once on startup"""
+    get_engine()
+    get_message_validator()
+    get_group_lifecycle()
+
+
+def register_handlers():
+    """Wires all handlers to the message bus and compiles the inbound validators, called once on startup"""
+    message_bus = get_message_bus()
+    initiative_index = get_initiative_index()
+    if message_bus.handlers:
+        return
+    message_bus.message_history_handler = store_history_event
+    message_bus.register_handler("DestinyAddMessage", add_destiny_state)
+    message_bus.register_handler("DestinySwitchMessage", update_destiny_state)
+    message_bus.register_handler("DestinyRemoveMessage", delete_destiny_state)
+    message_bus.register_handler("CharacterCreateMessage", create_character_state)
+    message_bus.register_handler("CharacterDeleteMessage", delete_character_state)
+    message_bus.register_handler("CharacterUpdateMessage", update_character_state)
+    message_bus.register_handler("CharacterStatusToggleMessage", toggle_character_status)
+    message_bus.register_handler("RollReqestMessage", roll_dice)
+    message_bus.register_handler("RollBatchRequestMessage", roll_dice_batch)
+    message_bus.register_after_broadcast_handler("RollResultMessage", update_roll_statistics)
+    message_bus.register_after_broadcast_handler("RollBatchResultMessage", update_roll_statistics)
+    message_bus.register_after_broadcast_handler("CharacterCreateMessage", initiative_index.handle_character_create)
+    message_bus.register_after_broadcast_handler("CharacterUpdateMessage", initiative_index.handle_character_update)
+    message_bus.register_after_broadcast_handler("CharacterDeleteMessage", initiative_index.handle_character_delete)
+    # compiled from the registered handlers, so it has to happen after all handlers are registered
+    get_message_validator().compile()
+
 
+def precompile_templates():
+    """Compiles every template once, so the bytecode cache is filled before the first request"""
+    templates = get_templates()
+    for template_name in templates.env.list_templates():
+        templates.env.get_template(template_name)
 
-manager = ConnectionManager()
 
-message_bus = MessageBus(manager)
-message_bus.message_history_handler = store_history_event
-message_bus.register_handler("DestinyAddMessage", add_destiny_state)
-message_bus.register_handler("DestinySwitchMessage", update_destiny_state)
-message_bus.register_handler("DestinyRemoveMessage", delete_destiny_state)
-message_bus.register_handler("CharacterCreateMessage", create_character_state)
-message_bus.register_handler("CharacterDeleteMessage", delete_character_state)
-message_bus.register_handler("CharacterUpdateMessage", update_character_state)
-message_bus.register_handler("RollReqestMessage", roll_dice)
+def warm_up_groups(limit: int):
+    """Loads the in-memory state of the most recently active groups, returns their names"""
+    if limit <= 0:
+        return []
+    with Session(get_engine()) as session:
+        group_names = get_recent_groups(limit, session)
+    for group_name in group_names:
+        get_initiative_index().ensure_group(group_name)
+        get_group_lifecycle().touch(group_name)
+    return group_names
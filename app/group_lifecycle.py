@@ -0,0 +1,128 @@
+"""
+This file contains the GroupLifecycleManager class.
+
+It tracks the last activity of every group and evicts the in-process state of idle groups,
+so a long running server with many short lived groups keeps a bounded memory footprint.
+"""
+
+import os
+import sys
+from asyncio import sleep
+from time import monotonic
+
+from app.connection_manager import ConnectionManager
+from app.initiative_index import InitiativeIndex
+
+GROUP_IDLE_TIMEOUT = int(os.getenv("GROUP_IDLE_TIMEOUT", "1800"))
+GROUP_SWEEP_INTERVAL = int(os.getenv("GROUP_SWEEP_INTERVAL", "60"))
+MAX_CACHED_GROUPS = int(os.getenv("MAX_CACHED_GROUPS", "1000"))
+MAX_GROUP_STATE_BYTES = int(os.getenv("MAX_GROUP_STATE_BYTES", str(64 * 1024 * 1024)))
+
+
+def estimate_size(value, seen: set[int] = None) -> int:
+    """Estimates the memory of plain containers and their contents, other objects are counted shallow"""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(key, seen) + estimate_size(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, seen) for item in value)
+    return size
+
+
+class GroupLifecycleManager:
+    """Class that tracks group activity and evicts idle groups from the in-process state"""
+
+    manager: ConnectionManager
+    initiative_index: InitiativeIndex
+    last_activity: dict[str, float]
+    evicted_count: int
+    pruned_count: int
+
+    def __init__(self, manager: ConnectionManager, initiative_index: InitiativeIndex):
+        self.manager = manager
+        self.initiative_index = initiative_index
+        self.last_activity = {}
+        self.evicted_count = 0
+        self.pruned_count = 0
+
+    def touch(self, group_name: str):
+        """Records activity of a group"""
+        self.last_activity[group_name] = monotonic()
+
+    def tracked_groups(self) -> set[str]:
+        """Returns every group that holds in-process state"""
+        return set(self.last_activity) | set(self.manager.active_connections) | set(self.initiative_index.orders)
+
+    def estimate_group_size(self, group_name: str) -> int:
+        """Estimates the in-process memory a group holds in bytes"""
+        seen: set[int] = set()
+        return sum(
+            estimate_size(state.get(group_name), seen)
+            for state in (
+                self.manager.active_connections,
+                self.manager.clients,
+                self.manager.last_seen,
+                self.manager.idle,
+                self.initiative_index.orders,
+                self.initiative_index.keys,
+            )
+            if group_name in state
+        )
+
+    def evict(self, group_name: str):
+        """Drops the in-process state of a group without connections, it is reloaded from the database on next access"""
+        self.initiative_index.drop_group(group_name)
+        self.last_activity.pop(group_name, None)
+        self.evicted_count += 1
+
+    async def sweep(self):
+        """Prunes dead sockets, evicts idle groups and evicts the least recently active groups while over budget"""
+        for group_name in list(self.manager.active_connections):
+            self.pruned_count += await self.manager.prune(group_name)
+        now = monotonic()
+        evictable = [
+            group_name
+            for group_name in sorted(self.tracked_groups(), key=lambda name: self.last_activity.get(name, 0))
+            if group_name not in self.manager.active_connections
+        ]
+        for group_name in list(evictable):
+            if now - self.last_activity.get(group_name, 0) > GROUP_IDLE_TIMEOUT:
+                self.evict(group_name)
+                evictable.remove(group_name)
+        group_count = len(self.tracked_groups())
+        total_size = sum(self.estimate_group_size(group_name) for group_name in self.tracked_groups())
+        for group_name in evictable:
+            if group_count <= MAX_CACHED_GROUPS and total_size <= MAX_GROUP_STATE_BYTES:
+                break
+            total_size -= self.estimate_group_size(group_name)
+            group_count -= 1
+            self.evict(group_name)
+
+    async def run(self):
+        """Sweeps every GROUP_SWEEP_INTERVAL seconds"""
+        while True:
+            await sleep(GROUP_SWEEP_INTERVAL)
+            await self.sweep()
+
+    def report(self):
+        """Returns the tracked groups with their idle time and estimated memory"""
+        now = monotonic()
+        groups = {
+            group_name: {
+                "connections": len(self.manager.active_connections.get(group_name, [])),
+                "idle_seconds": round(now - self.last_activity[group_name], 1) if group_name in self.last_activity else None,
+                "estimated_bytes": self.estimate_group_size(group_name),
+            }
+            for group_name in self.tracked_groups()
+        }
+        return {
+            "group_count": len(groups),
+            "estimated_bytes": sum(group["estimated_bytes"] for group in groups.values()),
+            "evicted_count": self.evicted_count,
+            "pruned_sockets": self.pruned_count,
+            "groups": groups,
+        }
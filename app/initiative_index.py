@@ -0,0 +1,152 @@
+"""
+This file contains the InitiativeIndex class.
+
+It keeps a sorted initiative order per group in memory and updates it incrementally
+as character messages pass through the MessageBus.
+"""
+
+from bisect import bisect_left, insort
+
+from sqlmodel import Session
+
+from app.connection_manager import ConnectionManager
+from app.db_controller import get_character_states
+from app.models import CharacterState, get_engine
+from app.static.scripts.message_types import (
+    CharacterCreateMessage,
+    CharacterDeleteMessage,
+    CharacterUpdateMessage,
+    InitiativeOrderMessage,
+)
+
+InitiativeKey = tuple[int, int, int, str]
+
+INITIATIVE_TRAITS = ("initiative_triumph", "initiative_success", "initiative_advantage")
+
+
+def initiative_key(char_name: str, triumph: int, success: int, advantage: int) -> InitiativeKey:
+    """Returns the sort key of a character, highest initiative first and ties broken by name"""
+    return (-int(triumph), -int(success), -int(advantage), char_name)
+
+
+class InitiativeIndex:
+    """Class that maintains the initiative order of every group as a sorted list"""
+
+    orders: dict[str, list[InitiativeKey]]
+    keys: dict[str, dict[str, InitiativeKey]]
+    manager: ConnectionManager
+
+    def __init__(self, manager: ConnectionManager):
+        self.orders = {}
+        self.keys = {}
+        self.manager = manager
+
+    def load_group(self, group_name: str, character_states: list[CharacterState]):
+        """Builds the index of a group from its character states"""
+        self.keys[group_name] = {
+            character.char_name: initiative_key(
+                character.char_name,
+                character.initiative_triumph,
+                character.initiative_success,
+                character.initiative_advantage,
+            )
+            for character in character_states
+        }
+        self.orders[group_name] = sorted(self.keys[group_name].values())
+
+    def ensure_group(self, group_name: str, character_states: list[CharacterState] = None):
+        """Loads the index of a group if it is not in memory yet, from the database if no states are given"""
+        if group_name in self.orders:
+            return
+        if character_states is None:
+            with Session(get_engine()) as session:
+                character_states = get_character_states(group_name, session)
+        self.load_group(group_name, character_states)
+
+    def drop_group(self, group_name: str):
+        """Removes a group from the index, it will be reloaded on next access"""
+        self.orders.pop(group_name, None)
+        self.keys.pop(group_name, None)
+
+    def order(self, group_name: str) -> list[str]:
+        """Returns the character names of a group in initiative order"""
+        self.ensure_group(group_name)
+        return [key[-1] for key in self.orders[group_name]]
+
+    def position(self, group_name: str, char_name: str) -> int:
+        """Returns the position of a character in the initiative order or -1"""
+        self.ensure_group(group_name)
+        if char_name not in self.keys[group_name]:
+            return -1
+        return bisect_left(self.orders[group_name], self.keys[group_name][char_name])
+
+    def upsert(self, group_name: str, char_name: str, triumph: int, success: int, advantage: int):
+        """Inserts or moves a character and returns its old and new position"""
+        old_position = self.remove(group_name, char_name)
+        new_key = initiative_key(char_name, triumph, success, advantage)
+        insort(self.orders[group_name], new_key)
+        self.keys[group_name][char_name] = new_key
+        return old_position, bisect_left(self.orders[group_name], new_key)
+
+    def remove(self, group_name: str, char_name: str) -> int:
+        """Removes a character and returns its old position or -1"""
+        old_position = self.position(group_name, char_name)
+        if old_position >= 0:
+            del self.orders[group_name][old_position]
+            del self.keys[group_name][char_name]
+        return old_position
+
+    async def broadcast_move(self, message, old_position: int, new_position: int):
+        """Sends the position delta of a character if it changed"""
+        if old_position != new_position:
+            await self.manager.broadcast(
+                message.group_name,
+                InitiativeOrderMessage(
+                    group_name=message.group_name,
+                    author=message.author,
+                    char_name=message.char_name,
+                    old_position=old_position,
+                    new_position=new_position,
+                ).to_json(),
+            )
+        return message
+
+    async def handle_character_create(self, message: CharacterCreateMessage):
+        """Inserts a created character into the initiative order"""
+        # runs after the commit, so a group loaded from the database by upsert already contains the character
+        is_loaded = message.group_name in self.orders
+        old_position, new_position = self.upsert(
+            message.group_name,
+            message.char_name,
+            message.initiative_triumph,
+            message.initiative_success,
+            message.initiative_advantage,
+        )
+        if not is_loaded:
+            old_position = -1
+        return await self.broadcast_move(message, old_position, new_position)
+
+    async def handle_character_update(self, message: CharacterUpdateMessage):
+        """Moves a character if one of its initiative traits changed"""
+        if message.trait_name not in INITIATIVE_TRAITS:
+            return message
+        # converted before the index is touched, upsert removes the character before it builds the new key
+        try:
+            trait_value = int(message.trait_value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{message.trait_name} has to be an integer, got {message.trait_value!r}") from None
+        self.ensure_group(message.group_name)
+        if message.char_name not in self.keys[message.group_name]:
+            return message
+        triumph, success, advantage, _ = self.keys[message.group_name][message.char_name]
+        traits = dict(zip(INITIATIVE_TRAITS, (-triumph, -success, -advantage)))
+        traits[message.trait_name] = trait_value
+        old_position, new_position = self.upsert(
+            message.group_name, message.char_name, *traits.values()
+        )
+        return await self.broadcast_move(message, old_position, new_position)
+
+    async def handle_character_delete(self, message: CharacterDeleteMessage):
+        """Removes a deleted character, the clients drop its row with the delete message"""
+        self.remove(message.group_name, message.char_name)
+        return message
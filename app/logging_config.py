@@ -0,0 +1,76 @@
+"""
+This file contains the logging setup of the server.
+
+All loggers below "app" write JSON lines through a queue, so the event loop never blocks on
+stdout. Message payloads are only logged at debug level and can be sampled.
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+
+# attributes every LogRecord has, everything else was passed with extra= and is logged as a field
+RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single JSON line with the extra fields at the top level"""
+
+    def format(self, record: logging.LogRecord):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (key, value) for key, value in record.__dict__.items() if key not in RECORD_ATTRIBUTES
+        )
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LoggingSetup:
+    """Class that owns the queue listener of the app loggers"""
+
+    listener: QueueListener | None
+
+    def __init__(self):
+        self.listener = None
+
+    def start(self, level: str = LOG_LEVEL, stream=None):
+        """Routes the "app" loggers through a queue to a JSON stream handler running in its own thread"""
+        if self.listener is not None:
+            return
+        log_queue = SimpleQueue()
+        stream_handler = logging.StreamHandler(stream or sys.stdout)
+        stream_handler.setFormatter(JsonFormatter())
+        app_logger = logging.getLogger("app")
+        app_logger.setLevel(level)
+        app_logger.handlers = [QueueHandler(log_queue)]
+        app_logger.propagate = False
+        self.listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Flushes the queue and stops the listener thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+logging_setup = LoggingSetup()
+
+
+def log_payload(logger: logging.Logger, message: str, payload, **fields):
+    """Logs a message payload at debug level, sampled with LOG_PAYLOAD_SAMPLE_RATE"""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        logger.debug(message, extra={"payload": payload, **fields})
@@ -2,26 +2,224 @@
 This is the main file for the FastAPI application. It contains the main application logic and routes.
 """
 
-import json
+import logging
+import os
 import pathlib
+from asyncio import create_task, wait_for
+from contextlib import asynccontextmanager
+from time import perf_counter
 
-from fastapi import Depends, FastAPI, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from sqlmodel import Session
-from app.static.scripts.message_types import dice_display_lookup
+from app.static.scripts.message_types import (
+    GroupSnapshotMessage,
+    JediMessage,
+    RequestRejectedMessage,
+    dice_display_lookup,
+)
 
 from app.db_controller import (
     get_destiny_state,
-    get_history,
+    get_status_flags,
+    get_history_html,
+    rerender_stale_history,
     get_character_states,
+    get_roll_statistics,
+    get_roll_statistic,
+    get_dice_face_statistics,
+    search_history,
+)
+from app.connection_manager import HEARTBEAT_INTERVAL
+from app.dependencies import (
+    build_services,
+    get_group_lifecycle,
+    get_initiative_index,
+    get_manager,
+    get_message_bus,
+    get_message_validator,
+    get_session,
+    get_templates,
+    precompile_templates,
+    register_handlers,
+    warm_up_groups,
 )
-from app.dependencies import get_session, manager, message_bus, templates
-from app.models import create_db_and_tables
+from app.logging_config import log_payload, logging_setup
+from app.message_validation import PendingRequest
+from app.models import check_schema_revision, create_db_and_tables, get_engine
+from app.static_assets import STATIC_BUILD_DIR, STATIC_BUILD_URL, PrecompressedStaticFiles, static_assets
+from app.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+WARM_UP_GROUP_COUNT = int(os.getenv("WARM_UP_GROUP_COUNT", "20"))
+SHELL_MAX_AGE = int(os.getenv("SHELL_MAX_AGE", "300"))
+# author of the snapshots sent to spectators, they never send messages themselves
+SPECTATOR_CLIENT_NAME = "spectator"
+
+
+def load_static_assets():
+    """Creates the build directory served under /assets and loads the manifest of the last build"""
+    pathlib.Path(STATIC_BUILD_DIR).mkdir(exist_ok=True)
+    return static_assets.load()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initializes database, services, message bus and templates explicitly before the first request and records how long each step took.
+    Nothing is built on import, the providers in app.dependencies build their objects here"""
+    logging_setup.start()
+    startup_timings = {}
+    started = step_started = perf_counter()
+    for step_name, step in (
+        # an outdated database fails here instead of on the first query that needs a new column
+        ("schema", check_schema_revision),
+        ("database", create_db_and_tables),
+        ("services", build_services),
+        ("message_bus", register_handlers),
+        ("templates", precompile_templates),
+        ("static_assets", load_static_assets),
+        ("warm_up", lambda: warm_up_groups(WARM_UP_GROUP_COUNT)),
+    ):
+        step()
+        startup_timings[step_name] = round((perf_counter() - step_started) * 1000, 2)
+        step_started = perf_counter()
+    startup_timings["total"] = round((perf_counter() - started) * 1000, 2)
+    app.state.startup_timings = startup_timings
+    logger.info("Startup finished", extra={"timings_ms": startup_timings})
+    group_sweep_task = create_task(get_group_lifecycle().run())
+    # history rendered with an older DISPLAY_VERSION is rendered again without blocking startup
+    rerender_task = create_task(rerender_stale_history(get_message_bus().message_types))
+    yield
+    rerender_task.cancel()
+    group_sweep_task.cancel()
+    manager = get_manager()
+    if manager.heartbeat_task is not None:
+        manager.heartbeat_task.cancel()
+    logging_setup.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
-create_db_and_tables()
+# created by the static_assets startup step, it may not exist yet on import
+app.mount(STATIC_BUILD_URL, PrecompressedStaticFiles(directory=STATIC_BUILD_DIR, check_dir=False), name="assets")
+
+
+def get_ordered_character_states(group_name: str, session: Session):
+    """Gets the character states of a group in initiative order"""
+    character_states = get_character_states(group_name, session)
+    initiative_index = get_initiative_index()
+    get_group_lifecycle().touch(group_name)
+    initiative_index.ensure_group(group_name, character_states)
+    initiative_positions = {
+        char_name: position
+        for position, char_name in enumerate(initiative_index.order(group_name))
+    }
+    return sorted(
+        character_states,
+        key=lambda character: initiative_positions.get(character.char_name, len(initiative_positions)),
+    )
+
+
+def get_destiny_points(group_name: str, session: Session):
+    """Gets the destiny points of a group in the form of the snapshot messages"""
+    return [
+        {"point_id": destiny_state.id, "is_light": destiny_state.is_light}
+        for destiny_state in get_destiny_state(group_name, session)
+    ]
+
+
+def get_characters(group_name: str, session: Session):
+    """Gets the character states of a group in initiative order in the form of the snapshot messages"""
+    flag_bits = get_status_flags(group_name, session)
+    return [
+        {
+            **character_state.model_dump(exclude={"group_name", "status_bits"}),
+            "status_flags": ",".join(character_state.stati(flag_bits)),
+        }
+        for character_state in get_ordered_character_states(group_name, session)
+    ]
+
+
+def get_group_snapshot(group_name: str, client_name: str, session: Session):
+    """Collects the state rendered by get_group_state into a single message for pages served as shell"""
+    return GroupSnapshotMessage(
+        group_name=group_name,
+        author=client_name,
+        destiny_points=get_destiny_points(group_name, session),
+        characters=get_characters(group_name, session),
+        history=get_history_html(group_name, session, get_message_bus().message_types),
+    )
+
+
+def get_request_rejection(request: PendingRequest, client_name: str, reason: str, session: Session):
+    """Tells the author of a rejected optimistic request the stored state of the component the request changed"""
+    return RequestRejectedMessage(
+        group_name=request.group_name,
+        author=client_name,
+        request_id=request.request_id,
+        reason=reason,
+        destiny_points=get_destiny_points(request.group_name, session)
+        if request.message_type.startswith("Destiny")
+        else None,
+        characters=get_characters(request.group_name, session)
+        if request.message_type.startswith("Character")
+        else None,
+    )
+
+
+def get_frame_rate_rejection(group_name: str | None, client_name: str):
+    """Tells a client that its frames are dropped over the rate limit, without the request_id or any stored state,
+    so a flooding client causes no parsing or database work"""
+    return RequestRejectedMessage(
+        group_name=group_name, author=client_name, request_id=None, reason="frame_rate"
+    ).to_json()
+
+
+async def answer_request(
+    websocket: WebSocket,
+    group_name: str | None,
+    client_name: str,
+    data: str,
+    message: JediMessage | None,
+    reason: str,
+):
+    """Answers a rejected frame with a RequestRejectedMessage if the client waits for the acknowledgement
+    of an optimistic update, frames that could not be decoded are answered if their request_id can be read"""
+    if message is None:
+        request = get_message_validator().peek_request(data, group_name)
+    elif message.request_id is not None:
+        request = PendingRequest(message.group_name, message.message_type, message.request_id)
+    else:
+        request = None
+    manager = get_manager()
+    # the state of groups without subscription is never sent back
+    if request is None or request.group_name not in manager.subscriptions.get(websocket, ()):
+        return
+    with Session(get_engine()) as session:
+        rejection = get_request_rejection(request, client_name, reason, session)
+    await manager.send_personal_message(rejection.to_json(), websocket)
+
+
+async def reject_frame(
+    websocket: WebSocket,
+    group_name: str | None,
+    client_name: str,
+    data: str,
+    message: JediMessage | None,
+    error: Exception,
+):
+    """Logs a rejected frame and answers it if the client waits for the acknowledgement of an optimistic update"""
+    if isinstance(error, ValueError):
+        logger.warning(
+            "Rejected frame", extra={"group_name": group_name, "client_name": client_name, "error": str(error)}
+        )
+        reason = str(error)
+    else:
+        logger.exception("Failed frame", extra={"group_name": group_name, "client_name": client_name})
+        reason = "internal error"
+    await answer_request(websocket, group_name, client_name, data, message, reason)
 
 
 @app.get("/main/{group_name}/")
@@ -34,51 +232,289 @@ async def get_group_state(
     # get current state
     destiny_states = get_destiny_state(group_name, session)
 
-    # get history
-    history = get_history(group_name, session)
-    messages = sorted([
-        message_bus.message_types[history_event.event_type].from_json(history_event.json_data)
-        for history_event in history
-    ], key=lambda x: x.created_at)
+    # get history, rendered when it was stored
+    history_html = get_history_html(group_name, session, get_message_bus().message_types)
 
-    # get character states
-    character_states = get_character_states(group_name, session)
+    character_states = get_ordered_character_states(group_name, session)
 
-    return templates.TemplateResponse(
+    return get_templates().TemplateResponse(
         "mainpage.html",
         {
             "request": request,
             "destiny_states": destiny_states,
-            "messages": messages,
+            "history_html": history_html,
             "char_name": char_name,
             "group_name": group_name,
             "character_states": character_states,
+            "status_flags": get_status_flags(group_name, session),
+            "dice_types": dice_display_lookup,
+        },
+    )
+
+
+@app.get("/shell/{group_name}/")
+async def get_group_shell(request: Request, group_name: str):
+    """Serves the main page without any group state, the state is sent as GroupSnapshotMessage on connect"""
+    response = get_templates().TemplateResponse(
+        "mainpage.html",
+        {
+            "request": request,
+            "destiny_states": [],
+            "history_html": [],
+            "group_name": group_name,
+            "character_states": [],
             "dice_types": dice_display_lookup,
         },
     )
+    # the shell only depends on the URL, so browsers and proxies can keep it
+    response.headers["cache-control"] = f"public, max-age={SHELL_MAX_AGE}"
+    return response
+
+
+@app.get("/watch/{group_name}/")
+async def get_spectator_page(request: Request, group_name: str):
+    """Serves the read-only viewer of a group, it renders the spectator stream without PyScript"""
+    response = get_templates().TemplateResponse(
+        "spectator.html",
+        {"request": request, "group_name": group_name, "history_html": []},
+    )
+    response.headers["cache-control"] = f"public, max-age={SHELL_MAX_AGE}"
+    return response
+
+
+async def stream_spectator_events(group_name: str):
+    """Yields a snapshot of the group as the first Server-Sent Event, then the frames the group broadcasts"""
+    manager = get_manager()
+    queue = manager.add_spectator(group_name)
+    try:
+        # taken right after registering without awaiting in between, so no broadcast is missed
+        with Session(get_engine()) as session:
+            group_snapshot = get_group_snapshot(group_name, SPECTATOR_CLIENT_NAME, session)
+        yield f"event: snapshot\ndata: {group_snapshot.to_json()}\n\n"
+        while True:
+            try:
+                frame = await wait_for(queue.get(), HEARTBEAT_INTERVAL)
+            except TimeoutError:
+                # a comment keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                continue
+            if frame is None:
+                # fell too far behind, the viewer reconnects and starts over with a snapshot
+                return
+            yield frame
+    finally:
+        manager.remove_spectator(group_name, queue)
+
+
+@app.get("/events/{group_name}/")
+async def get_spectator_stream(group_name: str):
+    """Streams the broadcasts of a group read-only as Server-Sent Events, private messages are not included"""
+    rejection = get_manager().check_spectator(group_name)
+    if rejection is not None:
+        raise HTTPException(status_code=503, detail=rejection)
+    return StreamingResponse(
+        stream_spectator_events(group_name),
+        media_type="text/event-stream",
+        # no proxy may buffer or cache the stream
+        headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+    )
+
 
+@app.get("/stats/{group_name}/")
+async def get_group_roll_statistics(
+    group_name: str,
+    session: Session = Depends(get_session),
+):
+    """Returns the running roll statistics of every character of a group"""
+    return [
+        {
+            **statistic.model_dump(exclude={"net_success_histogram"}),
+            "net_success_histogram": statistic.net_success_counts,
+        }
+        for statistic in get_roll_statistics(group_name, session)
+    ]
+
+
+@app.get("/stats/{group_name}/{char_name}/")
+async def get_character_roll_statistics(
+    group_name: str,
+    char_name: str,
+    session: Session = Depends(get_session),
+):
+    """Returns the running roll statistics and dice face counts of a single character"""
+    statistic = get_roll_statistic(group_name, char_name, session)
+    if statistic is None:
+        raise HTTPException(status_code=404, detail=f"No rolls found for {char_name} in {group_name}")
+    faces: dict[str, dict[str, int]] = {}
+    for face_statistic in get_dice_face_statistics(group_name, char_name, session):
+        faces.setdefault(face_statistic.dice_type, {})[face_statistic.face] = face_statistic.count
+    return {
+        **statistic.model_dump(exclude={"net_success_histogram"}),
+        "net_success_histogram": statistic.net_success_counts,
+        "dice_faces": faces,
+    }
+
+
+@app.get("/search/{group_name}/")
+async def search_group_history(
+    group_name: str,
+    q: str,
+    page: int = Query(default=0, ge=0),
+    page_size: int = Query(default=20, ge=1, le=100),
+    session: Session = Depends(get_session),
+):
+    """Returns one page of history events of a group whose author, character, comment or type match the query"""
+    hits = search_history(group_name, q, session, page, page_size)
+    return {"page": page, "page_size": page_size, "hits": [dict(hit) for hit in hits]}
+
+
+@app.get("/admin/startup/")
+async def get_startup_report(request: Request):
+    """Returns how long each startup step took in milliseconds"""
+    return request.app.state.startup_timings
+
+
+@app.get("/admin/traces/")
+async def get_slow_traces():
+    """Returns the recent traces of the message pipeline that were slower than the threshold"""
+    return tracer.report()
+
+
+@app.get("/admin/groups/")
+async def get_group_report():
+    """Returns the groups held in memory with their idle time and estimated memory"""
+    return get_group_lifecycle().report()
+
+
+@app.get("/admin/validation/")
+async def get_validation_report():
+    """Returns how many inbound frames were rejected, by reason"""
+    return get_message_validator().report()
+
+
+@app.get("/admin/admission/")
+async def get_admission_report():
+    """Returns the connection and frame rate limits and how many connections and frames were rejected"""
+    manager = get_manager()
+    return {
+        "connections": len(manager.socket_clients),
+        "groups": len(manager.active_connections),
+        "spectators": sum(len(queues) for queues in manager.spectators.values()),
+        **manager.admission.report(),
+    }
 
 
 @app.websocket("/ws/{group_name}/{client_name}")
-async def websocket_endpoint(websocket: WebSocket, group_name: str, client_name: str):
-    await manager.connect(group_name, websocket)
-    while True:
-        try:
+async def websocket_endpoint(websocket: WebSocket, group_name: str, client_name: str, snapshot: bool = False):
+    manager = get_manager()
+    message_bus = get_message_bus()
+    message_validator = get_message_validator()
+    group_lifecycle = get_group_lifecycle()
+    if not await manager.connect(group_name, websocket, client_name):
+        return
+    group_lifecycle.touch(group_name)
+    try:
+        if snapshot:
+            with Session(get_engine()) as session:
+                group_snapshot = get_group_snapshot(group_name, client_name, session)
+            await manager.send_personal_message(group_snapshot.to_json(), websocket)
+        while True:
             data = await websocket.receive_text()
-            print("received:", data)
-            if data.startswith("Hello"):
-                await manager.send_personal_message(
-                    f"Hello Client #{client_name}", websocket
-                )
-                continue
+            message = None
+            try:
+                # dropped before any parsing or database work, the client is told once per refill of its bucket
+                if not manager.allow_frame(websocket):
+                    logger.debug(
+                        "Dropped frame over rate limit", extra={"group_name": group_name, "client_name": client_name}
+                    )
+                    if manager.is_first_drop(websocket):
+                        await manager.send_personal_message(get_frame_rate_rejection(group_name, client_name), websocket)
+                    continue
+                log_payload(logger, "Received frame", data, group_name=group_name, client_name=client_name)
+                await manager.touch(group_name, client_name)
+                group_lifecycle.touch(group_name)
+                if data.startswith("Hello"):
+                    await manager.send_personal_message(
+                        f"Hello Client #{client_name}", websocket
+                    )
+                    continue
+
+                with tracer.span("websocket_frame", group_name=group_name, client_name=client_name, size=len(data)):
+                    # decode and validate before any handler touches the database, author and group_name come from the connection
+                    with tracer.span("decode"):
+                        message = message_validator.decode(data, group_name, client_name)
+                    await message_bus.dispatch(message)
+            except Exception as e:
+                await reject_frame(websocket, group_name, client_name, data, message, e)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # also runs for abnormal disconnects, so no socket stays registered
+        await manager.close(websocket)
+
+
+@app.websocket("/mux/{client_name}")
+async def multiplexed_websocket_endpoint(websocket: WebSocket, client_name: str):
+    """One connection for many groups, e.g. for a GM running several tables.
+    Text frames "subscribe <group_name>" and "unsubscribe <group_name>" manage the groups, every message frame
+    carries its group_name and is only accepted for subscribed groups. A subscription is answered with the
+    presence snapshot and the GroupSnapshotMessage of the group, a "Hello" frame is answered as on /ws."""
+    manager = get_manager()
+    message_bus = get_message_bus()
+    message_validator = get_message_validator()
+    group_lifecycle = get_group_lifecycle()
+    if not await manager.connect_multiplexed(websocket, client_name):
+        return
+    try:
+        while True:
+            data = await websocket.receive_text()
+            message = None
+            try:
+                if not manager.allow_frame(websocket):
+                    logger.debug("Dropped frame over rate limit", extra={"client_name": client_name})
+                    if manager.is_first_drop(websocket):
+                        await manager.send_personal_message(get_frame_rate_rejection(None, client_name), websocket)
+                    continue
+                log_payload(logger, "Received frame", data, client_name=client_name)
+                if data.startswith("Hello"):
+                    await manager.send_personal_message(f"Hello Client #{client_name}", websocket)
+                    continue
+                command, _, group_name = data.partition(" ")
+                if command == "subscribe" and group_name:
+                    rejection = await manager.subscribe(group_name, websocket)
+                    if rejection is not None:
+                        await manager.send_personal_message(
+                            RequestRejectedMessage(
+                                group_name=group_name,
+                                author=client_name,
+                                request_id=None,
+                                reason=f"subscribe: {rejection}",
+                            ).to_json(),
+                            websocket,
+                        )
+                        continue
+                    group_lifecycle.touch(group_name)
+                    with Session(get_engine()) as session:
+                        group_snapshot = get_group_snapshot(group_name, client_name, session)
+                    await manager.send_personal_message(group_snapshot.to_json(), websocket)
+                    continue
+                if command == "unsubscribe" and group_name:
+                    await manager.unsubscribe(group_name, websocket)
+                    continue
 
-            data = json.loads(data)
-            # ensure author and group_name are set
-            data["author"] = client_name
-            data["group_name"] = group_name
-            await message_bus.process_message(data)
-        except ValueError as e:
-            print("ERROR", e)
-        except WebSocketDisconnect:
-            manager.disconnect(group_name, websocket)
-            await manager.broadcast(group_name, f"Client #{client_name} left the chat")
+                with tracer.span("websocket_frame", client_name=client_name, size=len(data)):
+                    with tracer.span("decode"):
+                        decoded_message = message_validator.decode(data, None, client_name)
+                    # the state of groups without subscription is never sent back
+                    if decoded_message.group_name not in manager.subscriptions[websocket]:
+                        raise ValueError(f"not subscribed to {decoded_message.group_name}")
+                    message = decoded_message
+                    await manager.touch(message.group_name, client_name)
+                    group_lifecycle.touch(message.group_name)
+                    await message_bus.dispatch(message)
+            except Exception as e:
+                await reject_frame(websocket, message.group_name if message else None, client_name, data, message, e)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await manager.close(websocket)
@@ -4,9 +4,12 @@ Message Bus for the Jedi Chat application.
 where all messages are sent to and which registers message handlers for each message type
 """
 
+import logging
 from typing import Awaitable, Callable, Type
 
-from app.connection_manager import ConnectionManager
+from app.connection_manager import GM_CLIENT_NAME, ConnectionManager
+from app.logging_config import log_payload
+from app.tracing import tracer
 from app.static.scripts.message_types import (
     DestinyAddMessage,
     DestinySwitchMessage,
@@ -15,21 +18,29 @@ from app.static.scripts.message_types import (
     CharacterCreateMessage,
     CharacterDeleteMessage,
     CharacterUpdateMessage,
+    CharacterStatusToggleMessage,
     RollReqestMessage,
     RollResultMessage,
+    RollBatchRequestMessage,
+    RollBatchResultMessage,
 )
+
+logger = logging.getLogger(__name__)
+
 MessageHandlerType = Callable[[Type[JediMessage]], Awaitable[Type[JediMessage]]]
 
 class MessageBus:
     """Message Bus for the Jedi Chat application. where all messages are sent to and which registers message handlers for each message type"""
 
     handlers: dict[str, list[MessageHandlerType]]
+    after_broadcast_handlers: dict[str, list[MessageHandlerType]]
     message_types: dict[str, Type[JediMessage]]
     message_history_handler: MessageHandlerType
     manager: ConnectionManager
 
     def __init__(self,manager:ConnectionManager):
         self.handlers = {}
+        self.after_broadcast_handlers = {}
         self.message_types = {
             "DestinyAddMessage": DestinyAddMessage,
             "DestinySwitchMessage": DestinySwitchMessage,
@@ -37,8 +48,11 @@ class MessageBus:
             "CharacterCreateMessage": CharacterCreateMessage,
             "CharacterDeleteMessage": CharacterDeleteMessage,
             "CharacterUpdateMessage": CharacterUpdateMessage,
+            "CharacterStatusToggleMessage": CharacterStatusToggleMessage,
             "RollReqestMessage": RollReqestMessage,
             "RollResultMessage": RollResultMessage,
+            "RollBatchRequestMessage": RollBatchRequestMessage,
+            "RollBatchResultMessage": RollBatchResultMessage,
 
         }
         self.message_history_handler = None
@@ -50,6 +64,12 @@ class MessageBus:
             self.handlers[message_type] = []
         self.handlers[message_type].append(handler)
 
+    def register_after_broadcast_handler(self, message_type: str, handler: MessageHandlerType):
+        """Registers a handler that is called with the processed message after it was broadcast, not for private messages"""
+        if message_type not in self.after_broadcast_handlers:
+            self.after_broadcast_handlers[message_type] = []
+        self.after_broadcast_handlers[message_type].append(handler)
+
     async def process_message(self, message_json: dict):
         """Processes a message by calling all registered handlers for its type"""
         if (
@@ -60,11 +80,45 @@ class MessageBus:
             specialized_message = self.message_types[message_json['message_type']].from_json(
                 message_json
             )
-            print(f"Processing: {message_json} -> {type(specialized_message)}")
-            for handler in self.handlers[message_json['message_type']]:
-                specialized_message = await handler(specialized_message)
-            if self.message_history_handler is not None:
-                await self.message_history_handler(specialized_message)
-            await self.manager.broadcast(specialized_message.group_name, specialized_message.to_json())
+            log_payload(logger, "Processing", message_json, message_type=message_json['message_type'])
+            await self.dispatch(specialized_message)
         else:
-            print(f"No handler for message type {message_json['message_type']}")
+            logger.warning("No handler for message type", extra={"message_type": message_json['message_type']})
+
+    async def dispatch(self, specialized_message: Type[JediMessage]):
+        """Calls all registered handlers for an already decoded and validated message, stores and broadcasts the result"""
+        with tracer.span("dispatch", message_type=specialized_message.message_type):
+            request_id = specialized_message.request_id
+            for handler in self.handlers.get(specialized_message.message_type, []):
+                with tracer.span(handler.__qualname__):
+                    specialized_message = await handler(specialized_message)
+            # private messages are only for the author and the GM, so they stay out of the shared history
+            is_private = getattr(specialized_message, "is_private", False)
+            if self.message_history_handler is not None and not is_private:
+                with tracer.span(self.message_history_handler.__qualname__):
+                    await self.message_history_handler(specialized_message)
+            if request_id is not None:
+                # handlers may return a new message, the author still needs the acknowledgement
+                specialized_message.request_id = request_id
+            if is_private:
+                with tracer.span("send_private"):
+                    await self.manager.send_to_clients(
+                        specialized_message.group_name,
+                        [specialized_message.author, GM_CLIENT_NAME],
+                        specialized_message.to_json(),
+                    )
+            else:
+                group_name = specialized_message.group_name
+                with tracer.span(
+                    "broadcast",
+                    connections=len(self.manager.active_connections.get(group_name, ())),
+                ):
+                    # spectators show the history line rendered by the server, only rendered if anyone watches
+                    display_html = specialized_message.display_event if self.manager.spectators.get(group_name) else None
+                    await self.manager.broadcast(group_name, specialized_message.to_json(), display_html)
+            if is_private:
+                # e.g. the roll statistics are public, a private roll must not show up there
+                return
+            for handler in self.after_broadcast_handlers.get(specialized_message.message_type, []):
+                with tracer.span(handler.__qualname__):
+                    await handler(specialized_message)
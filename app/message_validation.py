@@ -0,0 +1,225 @@
+"""
+This file contains the MessageValidator class.
+
+It decodes and validates inbound websocket frames in one pass before they reach the MessageBus,
+so malformed or oversized frames are rejected before any database work.
+"""
+
+import inspect
+import json
+import os
+import types
+from collections import Counter
+from typing import Any, Callable, NamedTuple, Type
+
+from app.message_bus import MessageBus
+from app.static.scripts.message_types import JediMessage
+
+MAX_FRAME_SIZE = int(os.getenv("MAX_FRAME_SIZE", "65536"))
+MAX_REQUEST_ID_LENGTH = 64
+
+FieldCoercer = Callable[[Any], Any]
+
+
+class PendingRequest(NamedTuple):
+    """The optimistic update a client waits to be acknowledged or rejected"""
+
+    group_name: str
+    message_type: str
+    request_id: str
+
+
+class MessageValidationError(ValueError):
+    """Raised when an inbound frame is rejected, reason is used as the rejection counter key"""
+
+    def __init__(self, reason: str, detail: str):
+        super().__init__(f"{reason}: {detail}")
+        self.reason = reason
+
+
+def _coerce_int(value: Any):
+    if isinstance(value, bool):
+        raise TypeError("bool is not an int")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        return int(value)
+    raise TypeError(f"{type(value).__name__} is not an int")
+
+
+def _coerce_str(value: Any):
+    if not isinstance(value, str):
+        raise TypeError(f"{type(value).__name__} is not a str")
+    return value
+
+
+def _coerce_bool(value: Any):
+    if not isinstance(value, bool):
+        raise TypeError(f"{type(value).__name__} is not a bool")
+    return value
+
+
+def _coerce_any(value: Any):
+    return value
+
+
+COERCERS: dict[Any, FieldCoercer] = {
+    int: _coerce_int,
+    str: _coerce_str,
+    bool: _coerce_bool,
+}
+
+
+def _compile_coercer(annotation: Any, allows_none: bool) -> FieldCoercer:
+    """Builds a coercer for a parameter annotation, unions try each member in order"""
+    if isinstance(annotation, types.UnionType):
+        # exact type matches win, so "3" stays a str for int | str
+        members = annotation.__args__
+
+        def coerce_union(value: Any):
+            if type(value) in members:
+                return value
+            for member in members:
+                try:
+                    return COERCERS.get(member, _coerce_any)(value)
+                except (TypeError, ValueError):
+                    continue
+            raise TypeError(f"{type(value).__name__} is not one of {annotation}")
+
+        coercer = coerce_union
+    else:
+        coercer = COERCERS.get(annotation, _coerce_any)
+    if not allows_none:
+        return coercer
+
+    def coerce_optional(value: Any):
+        return None if value is None else coercer(value)
+
+    return coerce_optional
+
+
+def _exact_types(annotation: Any, allows_none: bool) -> tuple[type, ...]:
+    """Returns the types a value may already have to be accepted without coercion"""
+    exact = annotation.__args__ if isinstance(annotation, types.UnionType) else (annotation,)
+    exact = tuple(member for member in exact if member in COERCERS)
+    return exact + (type(None),) if allows_none else exact
+
+
+def compile_validator(message_class: Type[JediMessage]) -> Callable[[dict], JediMessage]:
+    """Compiles the __init__ signature of a message class into a function that validates a decoded frame and builds the message"""
+    parameters = [
+        parameter
+        for parameter in inspect.signature(message_class.__init__).parameters.values()
+        if parameter.name != "self" and parameter.kind != inspect.Parameter.VAR_KEYWORD
+    ]
+    required = frozenset(
+        parameter.name for parameter in parameters if parameter.default is inspect.Parameter.empty
+    )
+    coercers = {
+        parameter.name: _compile_coercer(parameter.annotation, parameter.default is None)
+        for parameter in parameters
+    }
+    # values that already have the annotated type skip the coercer
+    exact_types = {
+        parameter.name: _exact_types(parameter.annotation, parameter.default is None)
+        for parameter in parameters
+    }
+    exact_types["message_type"] = (str,)
+    coercers["message_type"] = _coerce_str
+    allowed = frozenset(coercers)
+
+    def validate(data: dict) -> JediMessage:
+        if not required <= data.keys():
+            raise MessageValidationError("missing_field", ", ".join(sorted(required - data.keys())))
+        if not allowed >= data.keys():
+            raise MessageValidationError("unknown_field", ", ".join(sorted(data.keys() - allowed)))
+        for name, value in data.items():
+            if type(value) in exact_types[name]:
+                continue
+            try:
+                data[name] = coercers[name](value)
+            except (TypeError, ValueError) as e:
+                raise MessageValidationError("invalid_type", f"{name}: {e}") from e
+        return message_class(**data)
+
+    return validate
+
+
+class MessageValidator:
+    """Class that decodes inbound frames and validates them against the message types the MessageBus handles"""
+
+    message_bus: MessageBus
+    validators: dict[str, Callable[[dict], JediMessage]]
+    rejections: Counter
+    max_frame_size: int
+
+    def __init__(self, message_bus: MessageBus, max_frame_size: int = MAX_FRAME_SIZE):
+        self.message_bus = message_bus
+        self.validators = {}
+        self.rejections = Counter()
+        self.max_frame_size = max_frame_size
+
+    def compile(self):
+        """Compiles a validator for every message type the MessageBus has handlers for"""
+        self.validators = {
+            message_type: compile_validator(message_class)
+            for message_type, message_class in self.message_bus.message_types.items()
+            if message_type in self.message_bus.handlers
+        }
+
+    def decode(self, raw_message: str, group_name: str | None, client_name: str) -> JediMessage:
+        """Decodes and validates a frame, author and group_name are always taken from the connection.
+        Frames of multiplexed connections are tagged with their group_name, they are decoded with group_name None"""
+        if not self.validators:
+            self.compile()
+        try:
+            if len(raw_message) > self.max_frame_size:
+                raise MessageValidationError("oversized", f"{len(raw_message)} > {self.max_frame_size}")
+            try:
+                data = json.loads(raw_message)
+            except json.JSONDecodeError as e:
+                raise MessageValidationError("invalid_json", str(e)) from e
+            if not isinstance(data, dict):
+                raise MessageValidationError("invalid_json", "frame is not an object")
+            validator = self.validators.get(data.get("message_type"))
+            if validator is None:
+                raise MessageValidationError("unknown_message_type", str(data.get("message_type")))
+            # the request id is not a field of the message types, it is kept next to the validated fields
+            request_id = data.pop("request_id", None)
+            if request_id is not None and (not isinstance(request_id, str) or len(request_id) > MAX_REQUEST_ID_LENGTH):
+                raise MessageValidationError("invalid_request_id", repr(request_id)[:MAX_REQUEST_ID_LENGTH])
+            data["author"] = client_name
+            if group_name is not None:
+                data["group_name"] = group_name
+            elif not isinstance(data.get("group_name"), str):
+                raise MessageValidationError("missing_group", "frame of a multiplexed connection has no group_name")
+            message = validator(data)
+            if request_id is not None:
+                message.request_id = request_id
+            return message
+        except MessageValidationError as e:
+            self.rejections[e.reason] += 1
+            raise
+
+    def peek_request(self, raw_message: str, group_name: str | None) -> PendingRequest | None:
+        """Reads the request of a frame that was dropped or could not be decoded, so the client can still roll back
+        its optimistic update. Returns None if the frame carries no valid request_id."""
+        if len(raw_message) > self.max_frame_size or '"request_id"' not in raw_message:
+            return None
+        try:
+            data = json.loads(raw_message)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        request_id = data.get("request_id")
+        if not isinstance(request_id, str) or len(request_id) > MAX_REQUEST_ID_LENGTH:
+            return None
+        group_name = group_name if group_name is not None else data.get("group_name")
+        if not isinstance(group_name, str):
+            return None
+        return PendingRequest(group_name, str(data.get("message_type")), request_id)
+
+    def report(self):
+        """Returns the rejection counts by reason"""
+        return {"total": sum(self.rejections.values()), "by_reason": dict(self.rejections)}
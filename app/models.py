@@ -3,10 +3,40 @@ This file contains the models for the database.
 """
 
 import json
+import os
+import zlib
 from datetime import datetime
-from typing import Optional
+from functools import cache
+from typing import NamedTuple, Optional
+
+from sqlalchemy import inspect, text
+from sqlmodel import Field, Session, SQLModel, create_engine, select
+
+# the bit of each predefined status flag in CharacterState.status_bits, only ever append new flags
+STATUS_FLAGS = {
+    "staggered": 0,
+    "disoriented": 1,
+    "immobilized": 2,
+    "ensnared": 3,
+    "stunned": 4,
+    "prone": 5,
+    "unconscious": 6,
+    "aiming": 7,
+    "guarded": 8,
+    "in_cover": 9,
+}
+# bits left for the custom flags of a group, SQLite integers are signed 64 bit and the sign bit is never used
+CUSTOM_STATUS_FLAG_BITS = range(32, 63)
+
+
+def status_flag_names(status_bits: int, flag_bits: dict[str, int]):
+    """Returns the names of the flags set in status_bits in the order of their bits"""
+    return [
+        flag_name
+        for flag_name, bit in sorted(flag_bits.items(), key=lambda flag: flag[1])
+        if status_bits >> bit & 1
+    ]
 
-from sqlmodel import Field, SQLModel, create_engine
 
 class CharacterState(SQLModel, table=True):
     """Each Group can has multiple Characters, this class represents the state of a single Character for a specific Group."""
@@ -20,39 +50,136 @@ class CharacterState(SQLModel, table=True):
     defense_melee: int
     defense_ranged: int
     soak: int
-    status_flags: str
+    status_bits: int = 0
     image_url: str
     initiative_triumph: int
     initiative_success: int
     initiative_advantage: int
 
-    @property
-    def stati(self):
-        '''Returns a list of the status flags'''
-        return self.status_flags.split(',') if self.status_flags else []
+    def stati(self, flag_bits: dict[str, int] = STATUS_FLAGS):
+        '''Returns the names of the set status flags, the custom flags of the group have to be included in flag_bits'''
+        return status_flag_names(self.status_bits, flag_bits)
 
 
-class DestinyState(SQLModel, table=True):
-    """Each Group can has multiple Destiny Points, this class represents the state of a single Destiny Point for a specific Group."""
+class StatusFlag(SQLModel, table=True):
+    """A status flag the users of a Group defined in addition to STATUS_FLAGS, with its bit in CharacterState.status_bits."""
 
-    id: int = Field(primary_key=True)
     group_name: str = Field(primary_key=True)
+    flag_name: str = Field(primary_key=True)
+    bit: int
+
+
+# SQLite integers are signed 64 bit, the sign bit is never used
+MAX_DESTINY_POINTS = 63
+
+
+class DestinyPoint(NamedTuple):
+    """A single Destiny Point unpacked from a DestinyPool"""
+
+    id: int
     is_light: bool
 
 
+class DestinyPool(SQLModel, table=True):
+    """The Destiny Points of a Group packed into a single record, so every flip, addition and removal is one atomic update.
+    Points are numbered 1 to point_count, point n is light if bit n - 1 of light_bits is set."""
+
+    group_name: str = Field(primary_key=True)
+    point_count: int = 0
+    light_bits: int = 0
+    version: int = 0
+
+    @property
+    def points(self):
+        '''Returns the Destiny Points in the order of their ids'''
+        return [
+            DestinyPoint(point_id, bool(self.light_bits >> (point_id - 1) & 1))
+            for point_id in range(1, self.point_count + 1)
+        ]
+
+
+# stored as small ints in HistoryEvent.event_kind, only ever append new message types
+MESSAGE_KINDS = {
+    "DestinySwitchMessage": 1,
+    "DestinyAddMessage": 2,
+    "DestinyRemoveMessage": 3,
+    "CharacterCreateMessage": 4,
+    "CharacterUpdateMessage": 5,
+    "CharacterDeleteMessage": 6,
+    "RollReqestMessage": 7,
+    "RollResultMessage": 8,
+    "RollBatchRequestMessage": 9,
+    "RollBatchResultMessage": 10,
+    "InitiativeOrderMessage": 11,
+    "PresenceSnapshotMessage": 12,
+    "PresenceMessage": 13,
+    "CharacterStatusToggleMessage": 14,
+}
+MESSAGE_KIND_NAMES = {kind: message_type for message_type, kind in MESSAGE_KINDS.items()}
+
+# fields that are stored in their own columns and stripped from the payload
+HISTORY_COLUMN_FIELDS = ("message_type", "group_name", "created_at")
+# only meaningful while the message is broadcast
+HISTORY_TRANSIENT_FIELDS = ("request_id",)
+# payloads of at least this many bytes are zlib compressed, 0 disables compression as it slows down loading the history
+PAYLOAD_COMPRESS_THRESHOLD = int(os.getenv("HISTORY_COMPRESS_THRESHOLD", "0"))
+PAYLOAD_JSON = b"j"
+PAYLOAD_ZLIB = b"z"
+
+
+def encode_payload(message_data: dict) -> bytes:
+    """Encodes the message fields that are not stored in columns as compact JSON, zlib compressed if it is long and compression is enabled"""
+    raw = json.dumps(
+        {
+            key: value
+            for key, value in message_data.items()
+            if key not in HISTORY_COLUMN_FIELDS and key not in HISTORY_TRANSIENT_FIELDS
+        },
+        separators=(",", ":"),
+    ).encode()
+    if 0 < PAYLOAD_COMPRESS_THRESHOLD <= len(raw):
+        return PAYLOAD_ZLIB + zlib.compress(raw)
+    return PAYLOAD_JSON + raw
+
+
+def decode_payload(payload: bytes) -> dict:
+    """Decodes a payload created by encode_payload"""
+    if payload[:1] == PAYLOAD_ZLIB:
+        return json.loads(zlib.decompress(payload[1:]))
+    return json.loads(payload[1:])
+
+
 class HistoryEvent(SQLModel, table=True):
     """Log of all events that happened in a Group. This can be used to display the history of the Group."""
 
     id: Optional[int] = Field(primary_key=True, default=None)
     group_name: str
     created_at: datetime
-    event_type: str
-    event_data: str
+    event_kind: int
+    payload: bytes
+    display_html: Optional[str] = None
+    display_version: Optional[int] = None
+    symbol_summary: Optional[str] = None
+
+    @property
+    def event_type(self):
+        '''Returns the message type name of the event'''
+        return MESSAGE_KIND_NAMES[self.event_kind]
 
     @property
     def json_data(self):
-        '''Converts the event_data to a JSON object'''
-        return json.loads(self.event_data)
+        '''Converts the payload and the columns back to the JSON object of the message'''
+        return {
+            **decode_payload(self.payload),
+            "message_type": self.event_type,
+            "group_name": self.group_name,
+            "created_at": self.created_at.strftime("%H:%M:%S"),
+        }
+
+    @property
+    def event_data(self):
+        '''Returns the JSON string of the message'''
+        return json.dumps(self.json_data)
 
     @property
     def display(self):
@@ -60,13 +187,120 @@ class HistoryEvent(SQLModel, table=True):
         return f'{self.created_at.strftime("%H:%M:%S")}: {self.event_type} - {self.event_data}'
 
 
-SQL_FILE_NAME = "database.db"
+class RollStatistic(SQLModel, table=True):
+    """Running roll statistics of a single Character for a specific Group, updated with every roll result."""
+
+    group_name: str = Field(primary_key=True)
+    char_name: str = Field(primary_key=True)
+    roll_count: int = 0
+    triumph_count: int = 0
+    despair_count: int = 0
+    net_success_total: int = 0
+    net_advantage_total: int = 0
+    net_success_histogram: str = "{}"
+
+    @property
+    def net_success_counts(self) -> dict[str, int]:
+        '''Converts the net_success_histogram to a dict of net successes to number of rolls'''
+        return json.loads(self.net_success_histogram)
+
+
+class DiceFaceStatistic(SQLModel, table=True):
+    """How often a face of a dice type was rolled by a single Character of a specific Group."""
+
+    group_name: str = Field(primary_key=True)
+    char_name: str = Field(primary_key=True)
+    dice_type: str = Field(primary_key=True)
+    face: str = Field(primary_key=True)
+    count: int = 0
+
+
+class BackfillCheckpoint(SQLModel, table=True):
+    """Progress of a batched backfill, every row with an id up to last_id has been processed."""
+
+    name: str = Field(primary_key=True)
+    last_id: int = 0
+    processed: int = 0
+    updated_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+
+SQL_FILE_NAME = os.getenv("SQL_FILE_NAME", "database.db")
 sqlite_url = f"sqlite:///{SQL_FILE_NAME}"
 
 connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, echo=False, connect_args=connect_args)
+
+
+@cache
+def get_engine():
+    """Returns the engine of the app database, created on first use so importing the models has no side effects"""
+    return create_engine(sqlite_url, echo=False, connect_args=connect_args)
+
+
+HISTORY_SEARCH_TABLE = "historyevent_fts"
+
+
+def index_history_event(session: Session, event_id: int, message_data: dict):
+    """Adds the searchable text of a history event to the FTS5 index, does not commit"""
+    session.execute(
+        text(
+            f"INSERT INTO {HISTORY_SEARCH_TABLE}(rowid, group_name, author, char_name, comment, message_type) "
+            "VALUES (:id, :group_name, :author, :char_name, :comment, :message_type)"
+        ),
+        {
+            "id": event_id,
+            "group_name": message_data["group_name"],
+            "author": message_data.get("author", ""),
+            "char_name": message_data.get("char_name", ""),
+            "comment": message_data.get("comment", ""),
+            "message_type": message_data["message_type"],
+        },
+    )
+
+
+def create_history_search_index():
+    """Creates the FTS5 index over the history text if it doesn't exist and fills it from the existing history"""
+    if inspect(get_engine()).has_table(HISTORY_SEARCH_TABLE):
+        return
+    with Session(get_engine()) as session:
+        session.execute(text(
+            f"CREATE VIRTUAL TABLE {HISTORY_SEARCH_TABLE} USING fts5("
+            "group_name UNINDEXED, author, char_name, comment, message_type)"
+        ))
+        for history_event in session.exec(select(HistoryEvent)).yield_per(1000):
+            index_history_event(session, history_event.id, history_event.json_data)
+        session.commit()
+
+
+ALEMBIC_SCRIPT_LOCATION = os.path.join(os.path.dirname(__file__), "alembic")
+
+
+def check_schema_revision():
+    """Fails with a clear error if an existing database is not migrated to the latest Alembic revision,
+    a new database is created at the latest revision by create_db_and_tables"""
+    from alembic.runtime.migration import MigrationContext
+    from alembic.script import ScriptDirectory
+
+    with get_engine().connect() as connection:
+        if not inspect(connection).get_table_names():
+            return
+        current_revisions = set(MigrationContext.configure(connection).get_current_heads())
+    head_revisions = set(ScriptDirectory(ALEMBIC_SCRIPT_LOCATION).get_heads())
+    if current_revisions != head_revisions:
+        raise RuntimeError(
+            f"{SQL_FILE_NAME} is at revision {', '.join(sorted(current_revisions)) or 'none'}, "
+            f"the models need {', '.join(sorted(head_revisions))}: run `alembic upgrade head` before starting the server"
+        )
 
 
 def create_db_and_tables():
-    """Creates the database and tables if they don't exist"""
-    SQLModel.metadata.create_all(engine, checkfirst=True)
+    """Creates the database and tables if they don't exist, a new database is stamped with the latest Alembic revision"""
+    from alembic.runtime.migration import MigrationContext
+    from alembic.script import ScriptDirectory
+
+    is_new_database = not inspect(get_engine()).get_table_names()
+    SQLModel.metadata.create_all(get_engine(), checkfirst=True)
+    if is_new_database:
+        with get_engine().begin() as connection:
+            MigrationContext.configure(connection).stamp(ScriptDirectory(ALEMBIC_SCRIPT_LOCATION), "head")
+    create_history_search_index()
@@ -0,0 +1,98 @@
+"""
+Replays the recorded history of a group through the MessageBus into a fresh database.
+
+Usage: python -m app.replay_history [--group GROUP_NAME] [--source database.db] [--target replay.db] [--speed 0]
+
+Broadcasting is stubbed, so the replay measures handler throughput and rebuilds
+the destiny pools, CharacterState, the history and the statistics from the log.
+A speed of 0 replays as fast as possible, otherwise the recorded gaps are divided by the speed.
+"""
+
+import argparse
+import asyncio
+import os
+import pathlib
+from collections import defaultdict
+from time import perf_counter
+
+
+def parse_arguments():
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--group", default=None, help="only replay this group, all groups if omitted")
+    parser.add_argument("--source", default="database.db", help="database file with the recorded history")
+    parser.add_argument("--target", default="replay.db", help="fresh database file the state is rebuilt into")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed factor, 0 for as fast as possible")
+    parser.add_argument("--force", action="store_true", help="overwrite the target database if it exists")
+    return parser.parse_args()
+
+
+async def replay(arguments):
+    """Replays the events and prints the throughput per message type"""
+    # the app modules read the database file on import, so the target has to be configured first
+    os.environ["SQL_FILE_NAME"] = arguments.target
+    from sqlmodel import Session, create_engine, select
+
+    from app.connection_manager import ConnectionManager
+    from app.dependencies import get_initiative_index, get_message_bus, register_handlers
+    from app.models import HistoryEvent, create_db_and_tables
+
+    class ReplayConnectionManager(ConnectionManager):
+        """ConnectionManager that only counts broadcasts instead of sending them"""
+
+        def __init__(self):
+            super().__init__()
+            self.broadcast_count = 0
+            self.broadcast_bytes = 0
+
+        async def broadcast(self, group_name: str, message: str, display_html: str | None = None):
+            self.broadcast_count += 1
+            self.broadcast_bytes += len(message)
+
+    create_db_and_tables()
+    register_handlers()
+    stub_manager = ReplayConnectionManager()
+    message_bus = get_message_bus()
+    message_bus.manager = stub_manager
+    get_initiative_index().manager = stub_manager
+
+    source_engine = create_engine(f"sqlite:///{arguments.source}")
+    with Session(source_engine) as session:
+        history_query = select(HistoryEvent).order_by(HistoryEvent.created_at, HistoryEvent.id)
+        if arguments.group is not None:
+            history_query = history_query.where(HistoryEvent.group_name == arguments.group)
+        history = session.exec(history_query).all()
+
+    durations: dict[str, list[float]] = defaultdict(list)
+    previous_created_at = None
+    started = perf_counter()
+    for history_event in history:
+        if arguments.speed > 0 and previous_created_at is not None:
+            await asyncio.sleep((history_event.created_at - previous_created_at).total_seconds() / arguments.speed)
+        previous_created_at = history_event.created_at
+        message = message_bus.message_types[history_event.event_type].from_json(history_event.json_data)
+        dispatch_started = perf_counter()
+        await message_bus.dispatch(message)
+        durations[history_event.event_type].append(perf_counter() - dispatch_started)
+    total = perf_counter() - started
+
+    print(f"Replayed {len(history)} events into {arguments.target} in {total:.3f}s")
+    for event_type, event_durations in sorted(durations.items()):
+        handler_time = sum(event_durations)
+        print(
+            f"{event_type:24} {len(event_durations):6} events "
+            f"{len(event_durations) / handler_time:9.1f} events/s "
+            f"{handler_time / len(event_durations) * 1000:7.3f}ms avg"
+        )
+    print(f"Stubbed {stub_manager.broadcast_count} broadcasts with {stub_manager.broadcast_bytes} bytes")
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    if pathlib.Path(arguments.target).resolve() == pathlib.Path(arguments.source).resolve():
+        raise SystemExit("The target has to be a different database than the source")
+    if pathlib.Path(arguments.target).exists():
+        if not arguments.force:
+            raise SystemExit(f"{arguments.target} exists, use --force to overwrite it")
+        pathlib.Path(arguments.target).unlink()
+    asyncio.run(replay(arguments))
@@ -2,7 +2,13 @@ import json
 
 from js import WebSocket, document, window
 from message_handler_base import MessageHandler
-from message_types import CharacterCreateMessage, CharacterDeleteMessage, CharacterUpdateMessage
+from message_types import (
+    CharacterCreateMessage,
+    CharacterDeleteMessage,
+    CharacterStatusToggleMessage,
+    CharacterUpdateMessage,
+    InitiativeOrderMessage,
+)
 from pyodide.ffi.wrappers import add_event_listener
 from pyweb import pydom
 
@@ -23,6 +29,10 @@ class CharacterStateMessageHandler(MessageHandler):
             return self.receive_character_update_message(raw_message)
         if "CharacterDeleteMessage" in raw_message:
             return self.receive_character_delete_message(raw_message)
+        if "CharacterStatusToggleMessage" in raw_message:
+            return self.receive_character_status_toggle_message(raw_message)
+        if "InitiativeOrderMessage" in raw_message:
+            return self.receive_initiative_order_message(raw_message)
         print(f"Unknown message: {raw_message}")
 
     def attach_listeners(self):
@@ -56,6 +66,11 @@ class CharacterStateMessageHandler(MessageHandler):
                 "click",
                 self.edit_character,
             )
+            add_event_listener(
+                document.getElementById(f"action-{char_name}-status"),
+                "click",
+                self.toggle_status,
+            )
             add_event_listener(
                 document.getElementById(f"action-{char_name}-delete"),
                 "click",
@@ -101,6 +116,8 @@ class CharacterStateMessageHandler(MessageHandler):
             button.id=f"action-{message.char_name}-decrease-strain"
             button = action_cell.create("button", html="Edit", classes=["bg-yellow-700","hover:bg-yellow-300", "size-8", "hexagon"])
             button.id=f"action-{message.char_name}-edit"
+            button = action_cell.create("button", html="Status", classes=["bg-yellow-700","hover:bg-yellow-300", "size-8", "hexagon"])
+            button.id=f"action-{message.char_name}-status"
             button = action_cell.create("button", html="Delete", classes=["bg-red-700","hover:bg-red-300", "size-8", "hexagon"])
             button.id=f"action-{message.char_name}-delete"
             add_event_listener(
@@ -128,6 +145,11 @@ class CharacterStateMessageHandler(MessageHandler):
                 "click",
                 self.edit_character,
             )
+            add_event_listener(
+                document.getElementById(f"action-{message.char_name}-status"),
+                "click",
+                self.toggle_status,
+            )
             add_event_listener(
                 document.getElementById(f"action-{message.char_name}-delete"),
                 "click",
@@ -145,7 +167,7 @@ class CharacterStateMessageHandler(MessageHandler):
         if trait:
             value = window.prompt("Trait Value","")
             if value:
-                self.ws.send(self.make_character_update_message(char_name,trait,value))
+                self.send_optimistic(self.make_character_update_message(char_name,trait,value), self.show_character_update)
 
     def make_character_update_message(self, char_name: str,trait:str,value:str|int):
         return CharacterUpdateMessage(
@@ -154,32 +176,77 @@ class CharacterStateMessageHandler(MessageHandler):
             author=self.client_name,
             trait_name=trait,
             trait_value=value,
-        ).to_json()
+        )
 
     def receive_character_update_message(self, raw_message: str):
         try:
-            message = CharacterUpdateMessage(**json.loads(raw_message))
-            if message.trait_name == "wound_current":
-                old_value:str = pydom[f"#character-row-{message.char_name} td:nth-child(2)"][0].text
-                new_value:str = f"{message.trait_value} / {old_value.split('/')[1]}"
-                pydom[f"#character-row-{message.char_name} td:nth-child(2)"][0].text = new_value
-            elif message.trait_name == "strain_current":
-                old_value:str = pydom[f"#character-row-{message.char_name} td:nth-child(3)"][0].text
-                new_value:str = f"{message.trait_value} / {old_value.split('/')[1]}"
-                pydom[f"#character-row-{message.char_name} td:nth-child(3)"][0].text = new_value
-            elif message.trait_name == "defense_melee":
-                pydom[f"#character-row-{message.char_name} td:nth-child(4)"][0].text = f"{message.trait_value} / {pydom[f'#character-row-{message.char_name} td:nth-child(4)'][0].text.split('/')[1]}"
-            elif message.trait_name == "defense_ranged":
-                pydom[f"#character-row-{message.char_name} td:nth-child(4)"][0].text = f"{pydom[f'#character-row-{message.char_name} td:nth-child(4)'][0].text.split('/')[0]} / {message.trait_value}"
-            elif message.trait_name == "soak":
-                pydom[f"#character-row-{message.char_name} td:nth-child(5)"][0].text = f"{message.trait_value}"
-            elif message.trait_name == "status_flags":
-                pydom[f"#character-row-{message.char_name} td:nth-child(6)"][0].text = f"{message.trait_value}"
+            message_data = json.loads(raw_message)
+            message = CharacterUpdateMessage(**message_data)
+            if not self.acknowledge(message_data):
+                self.show_character_update(message)
             return message
         except Exception as e:
             print(f"Error processing message: {raw_message}")
             print(e)
 
+    def show_character_update(self, message: CharacterUpdateMessage):
+        if message.trait_name == "wound_current":
+            old_value:str = pydom[f"#character-row-{message.char_name} td:nth-child(2)"][0].text
+            new_value:str = f"{message.trait_value} / {old_value.split('/')[1]}"
+            pydom[f"#character-row-{message.char_name} td:nth-child(2)"][0].text = new_value
+        elif message.trait_name == "strain_current":
+            old_value:str = pydom[f"#character-row-{message.char_name} td:nth-child(3)"][0].text
+            new_value:str = f"{message.trait_value} / {old_value.split('/')[1]}"
+            pydom[f"#character-row-{message.char_name} td:nth-child(3)"][0].text = new_value
+        elif message.trait_name == "defense_melee":
+            pydom[f"#character-row-{message.char_name} td:nth-child(4)"][0].text = f"{message.trait_value} / {pydom[f'#character-row-{message.char_name} td:nth-child(4)'][0].text.split('/')[1]}"
+        elif message.trait_name == "defense_ranged":
+            pydom[f"#character-row-{message.char_name} td:nth-child(4)"][0].text = f"{pydom[f'#character-row-{message.char_name} td:nth-child(4)'][0].text.split('/')[0]} / {message.trait_value}"
+        elif message.trait_name == "soak":
+            pydom[f"#character-row-{message.char_name} td:nth-child(5)"][0].text = f"{message.trait_value}"
+        elif message.trait_name == "status_flags":
+            pydom[f"#character-row-{message.char_name} td:nth-child(6)"][0].text = f"{message.trait_value}"
+
+    def toggle_status(self, event):
+        char_name = event.target.id.split("-")[1]
+        flag_name = window.prompt("Status Flag","")
+        if flag_name:
+            flag_name = flag_name.strip().lower()
+            is_set = flag_name not in self.get_status_flags(char_name)
+            self.send_optimistic(
+                self.make_character_status_toggle_message(char_name, flag_name, is_set), self.show_character_status_toggle
+            )
+
+    def make_character_status_toggle_message(self, char_name: str, flag_name: str, is_set: bool):
+        return CharacterStatusToggleMessage(
+            self.group_name,
+            char_name,
+            flag_name,
+            is_set,
+            self.client_name,
+        )
+
+    def receive_character_status_toggle_message(self, raw_message: str):
+        try:
+            message_data = json.loads(raw_message)
+            message = CharacterStatusToggleMessage(**message_data)
+            if not self.acknowledge(message_data):
+                self.show_character_status_toggle(message)
+            return message
+        except Exception as e:
+            print(f"Error processing message: {raw_message}")
+            print(e)
+
+    def get_status_flags(self, char_name: str):
+        status_text = pydom[f"#character-row-{char_name} td:nth-child(6)"][0].text
+        return [flag_name.strip() for flag_name in status_text.split(",") if flag_name.strip()]
+
+    def show_character_status_toggle(self, message: CharacterStatusToggleMessage):
+        status_flags = [flag_name for flag_name in self.get_status_flags(message.char_name) if flag_name != message.flag_name]
+        if message.is_set:
+            status_flags.append(message.flag_name)
+        pydom[f"#character-row-{message.char_name} td:nth-child(6)"][0].text = ",".join(status_flags)
+
     def delete_character(self, event):
         char_name = event.target.id.split("-")[1]
         print(f"Deleting: {char_name}")
@@ -201,27 +268,40 @@ class CharacterStateMessageHandler(MessageHandler):
             print(f"Error processing message: {raw_message}")
             print(e)
 
+    def receive_initiative_order_message(self, raw_message: str):
+        try:
+            message = InitiativeOrderMessage(**json.loads(raw_message))
+            table_body = document.getElementById("character-table-body")
+            row = document.getElementById(f"character-row-{message.char_name}")
+            if row and message.new_position >= 0:
+                table_body.removeChild(row)
+                table_body.insertBefore(row, table_body.children.item(message.new_position))
+            return message
+        except Exception as e:
+            print(f"Error processing message: {raw_message}")
+            print(e)
+
     def increase_wound(self, event):
         char_name = event.target.id.split("-")[1]
         print(f"Increasing Wound: {char_name}")
         current_wound = int(pydom[f"#character-row-{char_name} td:nth-child(2)"][0].text.split("/")[0])
-        self.ws.send(self.make_character_update_message(char_name,"wound_current",current_wound+1))
+        self.send_optimistic(self.make_character_update_message(char_name,"wound_current",current_wound+1), self.show_character_update)
 
     def decrease_wound(self, event):
         char_name = event.target.id.split("-")[1]
         print(f"Decreasing Wound: {char_name}")
         current_wound = int(pydom[f"#character-row-{char_name} td:nth-child(2)"][0].text.split("/")[0])
-        self.ws.send(self.make_character_update_message(char_name,"wound_current",current_wound-1))
+        self.send_optimistic(self.make_character_update_message(char_name,"wound_current",current_wound-1), self.show_character_update)
 
     def increase_strain(self, event):
         char_name = event.target.id.split("-")[1]
         print(f"Increasing Strain: {char_name}")
         current_strain = int(pydom[f"#character-row-{char_name} td:nth-child(3)"][0].text.split("/")[0])
-        self.ws.send(self.make_character_update_message(char_name,"strain_current",current_strain+1))
+        self.send_optimistic(self.make_character_update_message(char_name,"strain_current",current_strain+1), self.show_character_update)
 
     def decrease_strain(self, event):
         char_name = event.target.id.split("-")[1]
         print(f"Decreasing Strain: {char_name}")
         current_strain = int(pydom[f"#character-row-{char_name} td:nth-child(3)"][0].text.split("/")[0])
-        self.ws.send(self.make_character_update_message(char_name,"strain_current",current_strain-1))
+        self.send_optimistic(self.make_character_update_message(char_name,"strain_current",current_strain-1), self.show_character_update)
 
@@ -38,12 +38,12 @@ class DestinyMessageHandler(MessageHandler):
         add_event_listener(
             document.getElementById("add-destiny-button"),
             "click",
-            lambda event: self.ws.send(self.make_destiny_add_message()),
+            lambda event: self.send_optimistic(self.make_destiny_add_message(), self.show_destiny_add),
         )
         add_event_listener(
             document.getElementById("remove-destiny-button"),
             "click",
-            lambda event: self.ws.send(self.make_destiny_remove_message(1)),
+            lambda event: self.send_optimistic(self.make_destiny_remove_message(1), self.show_destiny_remove),
         )
 
     def make_destiny_switch_message(self, destiny_state_id: int):
@@ -53,43 +53,65 @@ class DestinyMessageHandler(MessageHandler):
             == "yellow",
             self.group_name,
             self.client_name,
-        ).to_json()
+        )
 
     def switch_destiny(self, event):
         print(f"Switching: {event.target.id}")
-        self.ws.send(self.make_destiny_switch_message(event.target.id.split("-")[-1]))
+        self.send_optimistic(
+            self.make_destiny_switch_message(event.target.id.split("-")[-1]), self.show_destiny_switch
+        )
 
     def receive_destiny_switch_message(self, raw_message: str):
         try:
-            message = DestinySwitchMessage(**json.loads(raw_message))
+            message_data = json.loads(raw_message)
+            message = DestinySwitchMessage(**message_data)
         except json.JSONDecodeError:
             print(f"Invalid JSON: {raw_message}")
             return None
         print(f"Received DestinySwitchMessage: {message.point_id}")
+        if not self.acknowledge(message_data):
+            self.show_destiny_switch(message)
+        return message
+
+    def show_destiny_switch(self, message: DestinySwitchMessage):
         point_display = pydom[f"#destiny-{message.point_id}"][0]
         if message.was_light:
             point_display.style["background-color"] = "black"
         else:
             point_display.style["background-color"] = "yellow"
-        return message
 
     def make_destiny_add_message(
         self, destiny_state_id: int = -1, is_light: bool = True
     ):
         result = DestinyAddMessage(
             destiny_state_id, is_light, self.group_name, self.client_name
-        ).to_json()
-        print(f"Sending: {result}")
-        return str(result)
+        )
+        print(f"Sending: {result.to_json()}")
+        return result
 
     def receive_destiny_add_message(self, raw_message: str):
         try:
-            message = DestinyAddMessage(**json.loads(raw_message))
+            message_data = json.loads(raw_message)
+            message = DestinyAddMessage(**message_data)
         except json.JSONDecodeError as e:
             print(f"Invalid JSON: {raw_message}\n{e}")
             return None
+        if not self.acknowledge(message_data):
+            self.show_destiny_add(message)
+            return message
+        pending_points = pydom[f"#destiny-pending-{message_data['request_id']}"]
+        if pending_points:
+            # the optimistic point gets the id the server assigned
+            pending_points[0].id = f"destiny-{message.point_id}"
+        elif not pydom[f"#destiny-{message.point_id}"]:
+            # a rejection or snapshot re-rendered the pool before the point was stored
+            self.show_destiny_add(message)
+        return message
+
+    def show_destiny_add(self, message: DestinyAddMessage):
         new_point = pydom["#destiny-monitor"][0].create("li")
-        new_point.id = f"destiny-{message.point_id}"
+        # optimistic points have no id from the server yet
+        new_point.id = f"destiny-{message.point_id}" if message.point_id != -1 else f"destiny-pending-{message.request_id}"
         new_point.style["background-color"] = "yellow" if message.is_light else "black"
         new_point.style["width"] = "64px"
         new_point.style["height"] = "64px"
@@ -98,23 +120,35 @@ class DestinyMessageHandler(MessageHandler):
         new_point.style["margin"] = "5px"
         new_point.style["cursor"] = "pointer"
         add_event_listener(
-            document.getElementById(f"destiny-{message.point_id}"),
+            document.getElementById(new_point.id),
             "click",
             self.switch_destiny,
         )
-        return message
 
     def receive_destiny_remove_message(self, raw_message: str):
         try:
-            message = DestinyRemoveMessage(**json.loads(raw_message))
+            message_data = json.loads(raw_message)
+            message = DestinyRemoveMessage(**message_data)
         except json.JSONDecodeError:
             print(f"Invalid JSON: {raw_message}")
             return None
         print(f"Received DestinyRemoveMessage: {message.point_id}")
-        pydom[f"#destiny-{message.point_id}"][0].remove()
+        if not self.acknowledge(message_data):
+            self.show_destiny_remove(message)
         return message
 
+    def show_destiny_remove(self, message: DestinyRemoveMessage):
+        point_displays = pydom[f"#destiny-{message.point_id}"]
+        if not point_displays:
+            return
+        point_displays[0].remove()
+        # the server keeps the ids 1 to point count, so the points after the removed one move down
+        for child_point in pydom["#destiny-monitor"][0].children:
+            point_id = child_point.id.split("-")[-1]
+            if point_id.isdigit() and int(point_id) > message.point_id:
+                child_point.id = f"destiny-{int(point_id) - 1}"
+
     def make_destiny_remove_message(self, destiny_state_id: int):
         return DestinyRemoveMessage(
             destiny_state_id, self.group_name, self.client_name
-        ).to_json()
+        )
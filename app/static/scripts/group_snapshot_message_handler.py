@@ -0,0 +1,87 @@
+import json
+
+from js import WebSocket
+from destiny_message_handler import DestinyMessageHandler
+from character_state_message_handler import CharacterStateMessageHandler
+from message_handler_base import MessageHandler
+from message_types import CharacterCreateMessage, DestinyAddMessage, GroupSnapshotMessage, RequestRejectedMessage
+from pyscript import window
+from pyweb import pydom
+
+
+class GroupSnapshotMessageHandler(MessageHandler):
+    """Renders the group state of a page served as shell and the stored state sent back for rejected optimistic
+    updates with the handlers of the live updates"""
+
+    ws: WebSocket
+    group_name: str
+    client_name: str
+    destiny_handler: DestinyMessageHandler
+    character_handler: CharacterStateMessageHandler
+
+    def __init__(
+        self,
+        group_name: str,
+        client_name: str,
+        ws: WebSocket,
+        destiny_handler: DestinyMessageHandler,
+        character_handler: CharacterStateMessageHandler,
+    ):
+        super().__init__(group_name, client_name, ws)
+        self.destiny_handler = destiny_handler
+        self.character_handler = character_handler
+
+    def process_message(self, raw_message: str):
+        if "GroupSnapshotMessage" in raw_message:
+            return self.receive_group_snapshot_message(raw_message)
+        if "RequestRejectedMessage" in raw_message:
+            return self.receive_request_rejected_message(raw_message)
+
+    def receive_group_snapshot_message(self, raw_message: str):
+        try:
+            message = GroupSnapshotMessage(**json.loads(raw_message))
+        except json.JSONDecodeError:
+            print(f"Invalid JSON: {raw_message}")
+            return None
+        # a second snapshot after a reconnect replaces the first one
+        self.show_destiny_points(message.destiny_points)
+        self.show_characters(message.characters)
+        messages = pydom["#messages"][0]
+        messages.html = ""
+        for event_html in message.history:
+            messages.create("li", html=event_html)
+        return message
+
+    def receive_request_rejected_message(self, raw_message: str):
+        try:
+            message = RequestRejectedMessage(**json.loads(raw_message))
+        except json.JSONDecodeError:
+            print(f"Invalid JSON: {raw_message}")
+            return None
+        window.console.warn("Rejected:", message.reason)
+        # the optimistic update is replaced by the stored state of its component
+        if message.destiny_points is not None:
+            self.destiny_handler.pending.pop(message.request_id, None)
+            self.show_destiny_points(message.destiny_points)
+        if message.characters is not None:
+            self.character_handler.pending.pop(message.request_id, None)
+            self.show_characters(message.characters)
+        return message
+
+    def show_destiny_points(self, destiny_points: list[dict]):
+        pydom["#destiny-monitor"][0].html = ""
+        for destiny_point in destiny_points:
+            self.destiny_handler.receive_destiny_add_message(
+                DestinyAddMessage(
+                    group_name=self.group_name, author=self.client_name, **destiny_point
+                ).to_json()
+            )
+
+    def show_characters(self, characters: list[dict]):
+        pydom["#character-table-body"][0].html = ""
+        for character in characters:
+            self.character_handler.receive_character_create_message(
+                CharacterCreateMessage(
+                    group_name=self.group_name, author=self.client_name, **character
+                ).to_json()
+            )
@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
 import functools
+from typing import Callable
+from uuid import uuid4
 
 from js import WebSocket, document
+from message_types import JediMessage
 from pyodide.ffi.wrappers import add_event_listener
 
 
@@ -28,11 +31,26 @@ class MessageHandler(ABC):
     ws: WebSocket
     group_name: str
     client_name: str
+    pending: dict[str, JediMessage]
 
     def __init__(self, group_name: str, client_name: str, ws: WebSocket):
         self.client_name = client_name
         self.group_name = group_name
         self.ws = ws
+        # optimistic updates that were not broadcast back yet, by request id
+        self.pending = {}
+
+    def send_optimistic(self, message: JediMessage, apply: Callable[[JediMessage], None]):
+        """Applies a message to the page right away and sends it with a new request id,
+        the broadcast of the message with the same request id is the acknowledgement"""
+        message.request_id = uuid4().hex[:12]
+        self.pending[message.request_id] = message
+        apply(message)
+        self.ws.send(message.to_json())
+
+    def acknowledge(self, message_data: dict):
+        """Returns True if a received message is the acknowledgement of an own optimistic update, which is applied already"""
+        return self.pending.pop(message_data.get("request_id"), None) is not None
 
     @abstractmethod
     def process_message(self, raw_message: str):
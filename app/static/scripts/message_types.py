@@ -4,6 +4,9 @@ from datetime import datetime
 import json
 import html
 
+# bump when any display_event changes, stored history is re-rendered in the background
+DISPLAY_VERSION = 1
+
 
 class JediMessage:
     """Base class for all messages sent by the Jedi Chat application"""
@@ -12,6 +15,8 @@ class JediMessage:
     group_name: str
     author: str
     created_at: str
+    # set by clients that update their page optimistically, echoed in the broadcast as acknowledgement
+    request_id: str | None = None
 
     def to_json(self):
         """Converts the message to a JSON string"""
@@ -218,11 +223,198 @@ class CharacterDeleteMessage(JediMessage):
         return f"{self.created_at}: {self.author} - Deleted Character({self.char_name})"
 
 
+class CharacterStatusToggleMessage(JediMessage):
+    """A message that represents setting or clearing a single status flag of a character"""
+
+    char_name: str
+    flag_name: str
+    is_set: bool
+
+    def __init__(
+        self,
+        group_name: str,
+        char_name: str,
+        flag_name: str,
+        is_set: bool,
+        author: str,
+        created_at: str = None,
+        **_,
+    ):
+        """Creates a new CharacterStatusToggleMessage object and fills base fields"""
+        self.message_type = "CharacterStatusToggleMessage"
+        self.char_name = char_name
+        self.flag_name = flag_name
+        self.is_set = is_set
+        self.group_name = group_name
+        self.author = author
+        self.created_at = created_at or datetime.now().strftime("%H:%M:%S")
+
+    @property
+    def display_event(self):
+        return f"{self.created_at}: {self.author} - {self.char_name} {'is now' if self.is_set else 'is no longer'} {self.flag_name}"
+
+
+class InitiativeOrderMessage(JediMessage):
+    """A message that represents a character moving in the initiative order, positions are -1 if absent"""
+
+    char_name: str
+    old_position: int
+    new_position: int
+
+    def __init__(
+        self,
+        group_name: str,
+        author: str,
+        char_name: str,
+        old_position: int,
+        new_position: int,
+        created_at: str = None,
+        **_,
+    ):
+        """Creates a new InitiativeOrderMessage object and fills base fields"""
+        self.message_type = "InitiativeOrderMessage"
+        self.char_name = char_name
+        self.old_position = old_position
+        self.new_position = new_position
+        self.group_name = group_name
+        self.author = author
+        self.created_at = created_at or datetime.now().strftime("%H:%M:%S")
+
+    @property
+    def display_event(self):
+        return ""
+
+
+class PresenceSnapshotMessage(JediMessage):
+    """A message that contains every client that is online in a group, sent once on connect"""
+
+    online: list[str]
+    idle: list[str]
+
+    def __init__(
+        self,
+        group_name: str,
+        author: str,
+        online: list[str],
+        idle: list[str],
+        created_at: str = None,
+        **_,
+    ):
+        """Creates a new PresenceSnapshotMessage object and fills base fields"""
+        self.message_type = "PresenceSnapshotMessage"
+        self.online = online
+        self.idle = idle
+        self.group_name = group_name
+        self.author = author
+        self.created_at = created_at or datetime.now().strftime("%H:%M:%S")
+
+    @property
+    def display_event(self):
+        return ""
+
+
+class PresenceMessage(JediMessage):
+    """A message that represents a presence change of a single client, status is joined, left, idle or active"""
+
+    client_name: str
+    status: str
+
+    def __init__(
+        self,
+        group_name: str,
+        author: str,
+        client_name: str,
+        status: str,
+        created_at: str = None,
+        **_,
+    ):
+        """Creates a new PresenceMessage object and fills base fields"""
+        self.message_type = "PresenceMessage"
+        self.client_name = client_name
+        self.status = status
+        self.group_name = group_name
+        self.author = author
+        self.created_at = created_at or datetime.now().strftime("%H:%M:%S")
+
+    @property
+    def display_event(self):
+        return ""
+
+
+class RequestRejectedMessage(JediMessage):
+    """A message sent only to the author of a rejected request, with the stored state of the component it changed,
+    so an optimistic update can be rolled back. A rejected subscription of a multiplexed connection and the notice that frames are dropped over the rate limit
+    have no request_id"""
+
+    reason: str
+    destiny_points: list[dict] | None
+    characters: list[dict] | None
+
+    def __init__(
+        self,
+        group_name: str,
+        author: str,
+        request_id: str,
+        reason: str,
+        destiny_points: list[dict] | None = None,
+        characters: list[dict] | None = None,
+        created_at: str = None,
+        **_,
+    ):
+        """Creates a new RequestRejectedMessage object and fills base fields"""
+        self.message_type = "RequestRejectedMessage"
+        self.request_id = request_id
+        self.reason = reason
+        self.destiny_points = destiny_points
+        self.characters = characters
+        self.group_name = group_name
+        self.author = author
+        self.created_at = created_at or datetime.now().strftime("%H:%M:%S")
+
+    @property
+    def display_event(self):
+        return ""
+
+
+class GroupSnapshotMessage(JediMessage):
+    """A message that contains the whole state of a group, sent once on connect to pages served as shell"""
+
+    destiny_points: list[dict]
+    characters: list[dict]
+    history: list[str]
+
+    def __init__(
+        self,
+        group_name: str,
+        author: str,
+        destiny_points: list[dict],
+        characters: list[dict],
+        history: list[str],
+        created_at: str = None,
+        **_,
+    ):
+        """Creates a new GroupSnapshotMessage object and fills base fields.
+        destiny_points hold point_id and is_light, characters the character state fields in initiative order
+        and history the display html of the events, oldest first"""
+        self.message_type = "GroupSnapshotMessage"
+        self.destiny_points = destiny_points
+        self.characters = characters
+        self.history = history
+        self.group_name = group_name
+        self.author = author
+        self.created_at = created_at or datetime.now().strftime("%H:%M:%S")
+
+    @property
+    def display_event(self):
+        return ""
+
+
 class RollReqestMessage(JediMessage):
     """A message that represents a request to roll dice"""
 
     dice_pool: str
     comment: str
+    is_private: bool
 
     def __init__(
         self,
@@ -232,6 +424,7 @@ class RollReqestMessage(JediMessage):
         dice_pool: str,
         comment: str,
         created_at: str = None,
+        is_private: bool = False,
         **_,
     ):
         """Creates a new RollReqestMessage object and fills base fields"""
@@ -241,6 +434,7 @@ class RollReqestMessage(JediMessage):
         self.group_name = group_name
         self.char_name = char_name
         self.author = author
+        self.is_private = is_private
         self.created_at = created_at or datetime.now().strftime("%H:%M:%S")
 
 symbol_lookup = {
@@ -286,6 +480,7 @@ class RollResultMessage(JediMessage):
     dice_pool: str
     result: str
     comment: str
+    is_private: bool
 
     def __init__(
         self,
@@ -296,6 +491,7 @@ class RollResultMessage(JediMessage):
         result: str,
         comment: str,
         created_at: str = None,
+        is_private: bool = False,
         **_,
     ):
         """Creates a new RollResultMessage object and fills base fields"""
@@ -306,32 +502,117 @@ class RollResultMessage(JediMessage):
         self.group_name = group_name
         self.char_name = char_name
         self.author = author
+        self.is_private = is_private
         self.created_at = created_at or datetime.now().strftime("%H:%M:%S")
 
     @property
     def display_event(self):
-        result_dict:dict[str,list[str]] = json.loads(self.result)
-        formatted_result = ""
-        result_sums = {}
-        for dice, results in result_dict.items():
-            dice_classes = dice_class_lookup.get(dice, "font-white")
-            for result in results:
-                content = "".join(symbol_lookup.get(r, r.lower()[0]) for r in result.split("_"))
-                for symbol in content:
-                    result_sums[symbol] = result_sums.get(symbol, 0) + 1
-                formatted_result += f'<span class="m-1 inline-block min-h-16 min-w-16 text-center content-center sw-symbol-font {dice_classes} {"text-lg" if "_" in result else ""}">{content}</span>'
-        calculated_results = {
-            'x': result_sums.get('x', 0),
-            'y': result_sums.get('y', 0),
-            's': result_sums.get('s', 0)-result_sums.get('f', 0),
-            'f': result_sums.get('f', 0)-result_sums.get('s', 0),
-            'a': result_sums.get('a', 0)-result_sums.get('t', 0),
-            't': result_sums.get('t', 0)-result_sums.get('a', 0),
-            'z': result_sums.get('z', 0)-result_sums.get('Z', 0),
-            'Z': result_sums.get('Z', 0)-result_sums.get('z', 0),
-        }
-        if all(value <=0 for value in calculated_results.values()):
-            message = "Alle Dice have cancelled each other out"
-        else:
-            message = 'Symbols Counted: '+ ', '.join(f'<span class=" sw-symbol-font text-white text-lg">{k}<span>: {v}' for k,v in calculated_results.items() if v>0)
+        formatted_result, message = format_roll_result(json.loads(self.result))
         return f'{self.created_at}: {self.author} - {self.char_name} rolled <div class="flex flex-row flex-wrap">{formatted_result}</div> <br> {message} {"<br>"+html.escape(self.comment) if self.comment else ""}'
+
+
+def count_roll_symbols(result_dict: dict[str, list[str]]):
+    """Counts the symbols of a roll result and cancels opposing symbols against each other"""
+    result_sums = {}
+    for results in result_dict.values():
+        for result in results:
+            for symbol in "".join(symbol_lookup.get(r, r.lower()[0]) for r in result.split("_")):
+                result_sums[symbol] = result_sums.get(symbol, 0) + 1
+    return {
+        'x': result_sums.get('x', 0),
+        'y': result_sums.get('y', 0),
+        's': result_sums.get('s', 0)-result_sums.get('f', 0),
+        'f': result_sums.get('f', 0)-result_sums.get('s', 0),
+        'a': result_sums.get('a', 0)-result_sums.get('t', 0),
+        't': result_sums.get('t', 0)-result_sums.get('a', 0),
+        'z': result_sums.get('z', 0)-result_sums.get('Z', 0),
+        'Z': result_sums.get('Z', 0)-result_sums.get('z', 0),
+    }
+
+
+def format_symbol_summary(calculated_results: dict[str, int]):
+    """Returns the html summary line for counted symbols"""
+    if all(value <=0 for value in calculated_results.values()):
+        return "Alle Dice have cancelled each other out"
+    return 'Symbols Counted: '+ ', '.join(f'<span class=" sw-symbol-font text-white text-lg">{k}<span>: {v}' for k,v in calculated_results.items() if v>0)
+
+
+def format_roll_result(result_dict: dict[str, list[str]]):
+    """Returns the html of all rolled dice and the html summary line of the counted symbols"""
+    formatted_result = ""
+    for dice, results in result_dict.items():
+        dice_classes = dice_class_lookup.get(dice, "font-white")
+        for result in results:
+            content = "".join(symbol_lookup.get(r, r.lower()[0]) for r in result.split("_"))
+            formatted_result += f'<span class="m-1 inline-block min-h-16 min-w-16 text-center content-center sw-symbol-font {dice_classes} {"text-lg" if "_" in result else ""}">{content}</span>'
+    return formatted_result, format_symbol_summary(count_roll_symbols(result_dict))
+
+
+class RollBatchRequestMessage(JediMessage):
+    """A message that represents a request to roll multiple named dice pools at once, e.g. for a squad of NPCs"""
+
+    dice_pools: str
+    comment: str
+    is_private: bool
+
+    def __init__(
+        self,
+        group_name: str,
+        char_name: str,
+        author: str,
+        dice_pools: str,
+        comment: str,
+        created_at: str = None,
+        is_private: bool = False,
+        **_,
+    ):
+        """Creates a new RollBatchRequestMessage object and fills base fields"""
+        self.message_type = "RollBatchRequestMessage"
+        self.dice_pools = dice_pools
+        self.comment = comment
+        self.group_name = group_name
+        self.char_name = char_name
+        self.author = author
+        self.is_private = is_private
+        self.created_at = created_at or datetime.now().strftime("%H:%M:%S")
+
+
+class RollBatchResultMessage(JediMessage):
+    """A message that represents the results of multiple named dice pools rolled at once"""
+
+    dice_pools: str
+    results: str
+    comment: str
+    is_private: bool
+
+    def __init__(
+        self,
+        group_name: str,
+        char_name: str,
+        author: str,
+        dice_pools: str,
+        results: str,
+        comment: str,
+        created_at: str = None,
+        is_private: bool = False,
+        **_,
+    ):
+        """Creates a new RollBatchResultMessage object and fills base fields"""
+        self.message_type = "RollBatchResultMessage"
+        self.dice_pools = dice_pools
+        self.results = results
+        self.comment = comment
+        self.group_name = group_name
+        self.char_name = char_name
+        self.author = author
+        self.is_private = is_private
+        self.created_at = created_at or datetime.now().strftime("%H:%M:%S")
+
+    @property
+    def display_event(self):
+        results_dict: dict[str, dict[str, list[str]]] = json.loads(self.results)
+        rows = "".join(
+            f'<li>{html.escape(pool_name)}: {format_symbol_summary(count_roll_symbols(result_dict))}</li>'
+            for pool_name, result_dict in results_dict.items()
+        )
+        return f'{self.created_at}: {self.author} - {self.char_name} rolled {len(results_dict)} pools <ul>{rows}</ul> {"<br>"+html.escape(self.comment) if self.comment else ""}'
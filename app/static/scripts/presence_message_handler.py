@@ -0,0 +1,57 @@
+import json
+
+from js import WebSocket
+from message_handler_base import MessageHandler
+from message_types import PresenceMessage, PresenceSnapshotMessage
+from pyweb import pydom
+
+
+class PresenceMessageHandler(MessageHandler):
+    ws: WebSocket
+    group_name: str
+    client_name: str
+
+    def process_message(self, raw_message: str):
+        print(f"Processing: {raw_message}")
+        if "PresenceSnapshotMessage" in raw_message:
+            return self.receive_presence_snapshot_message(raw_message)
+        if "PresenceMessage" in raw_message:
+            return self.receive_presence_message(raw_message)
+        print(f"Unknown message: {raw_message}")
+
+    def add_client(self, client_name: str, is_idle: bool = False):
+        if pydom[f"#presence-{client_name}"]:
+            return
+        entry = pydom["#presence-list"][0].create("li", html=client_name, classes=["inline-block", "m-1", "px-2", "rounded-full", "bg-green-700"])
+        entry.id = f"presence-{client_name}"
+        self.set_idle(client_name, is_idle)
+
+    def set_idle(self, client_name: str, is_idle: bool):
+        if pydom[f"#presence-{client_name}"]:
+            pydom[f"#presence-{client_name}"][0].style["opacity"] = "0.4" if is_idle else "1"
+
+    def receive_presence_snapshot_message(self, raw_message: str):
+        try:
+            message = PresenceSnapshotMessage(**json.loads(raw_message))
+        except json.JSONDecodeError:
+            print(f"Invalid JSON: {raw_message}")
+            return None
+        pydom["#presence-list"][0].html = ""
+        for client_name in message.online:
+            self.add_client(client_name, client_name in message.idle)
+        return message
+
+    def receive_presence_message(self, raw_message: str):
+        try:
+            message = PresenceMessage(**json.loads(raw_message))
+        except json.JSONDecodeError:
+            print(f"Invalid JSON: {raw_message}")
+            return None
+        if message.status == "joined":
+            self.add_client(message.client_name)
+        elif message.status == "left":
+            if pydom[f"#presence-{message.client_name}"]:
+                pydom[f"#presence-{message.client_name}"][0].remove()
+        else:
+            self.set_idle(message.client_name, message.status == "idle")
+        return message
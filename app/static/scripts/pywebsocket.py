@@ -4,6 +4,8 @@ from js import WebSocket, document
 from destiny_message_handler import DestinyMessageHandler
 from character_state_message_handler import CharacterStateMessageHandler
 from roll_message_handler import RollMessageHandler
+from presence_message_handler import PresenceMessageHandler
+from group_snapshot_message_handler import GroupSnapshotMessageHandler
 from pyscript import window
 from pyweb import pydom
 
@@ -14,12 +16,22 @@ url_params = {
 }
 client_name = url_params["char_name"]
 group_name = window.location.pathname.split("/")[2]
-ws = WebSocket.new(f"ws://{window.location.host}/ws/{group_name}/{client_name}")
+# pages served as shell get the group state as GroupSnapshotMessage on connect
+is_shell = window.location.pathname.split("/")[1] == "shell"
+ws = WebSocket.new(
+    f"ws://{window.location.host}/ws/{group_name}/{client_name}{'?snapshot=true' if is_shell else ''}"
+)
 
+destiny_message_handler = DestinyMessageHandler(group_name, client_name, ws)
+character_state_message_handler = CharacterStateMessageHandler(group_name, client_name, ws)
 message_handlers = [
-    DestinyMessageHandler(group_name, client_name, ws),
-    CharacterStateMessageHandler(group_name, client_name, ws),
+    GroupSnapshotMessageHandler(
+        group_name, client_name, ws, destiny_message_handler, character_state_message_handler
+    ),
+    destiny_message_handler,
+    character_state_message_handler,
     RollMessageHandler(group_name, client_name, ws),
+    PresenceMessageHandler(group_name, client_name, ws),
 ]
 
 def my_on_error(event):
@@ -39,8 +51,9 @@ def my_on_message(event):
     for handler in message_handlers:
         message = handler.process_message(event.data)
         if message:
-            new_log_entry = pydom["#messages"][0].create("li", html=message.display_event)
-            print(new_log_entry)
+            if message.display_event:
+                new_log_entry = pydom["#messages"][0].create("li", html=message.display_event)
+                print(new_log_entry)
             # TODO: style history
             break
     else:
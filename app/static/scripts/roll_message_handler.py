@@ -2,7 +2,7 @@ import json
 
 from js import WebSocket, document,window
 from message_handler_base import MessageHandler, add_on_click_listeners
-from message_types import RollReqestMessage,RollResultMessage,dice_display_lookup
+from message_types import RollReqestMessage,RollResultMessage,RollBatchRequestMessage,RollBatchResultMessage,dice_display_lookup
 from pyweb import pydom
 from pyodide.ffi.wrappers import add_event_listener
 
@@ -34,6 +34,8 @@ class RollMessageHandler(MessageHandler):
         #     return self.receive_roll_request_message(raw_message)
         if "RollResultMessage" in raw_message:
             return self.receive_roll_result_message(raw_message)
+        if "RollBatchResultMessage" in raw_message:
+            return self.receive_roll_batch_result_message(raw_message)
         print(f"Unknown message: {raw_message}")
 
     def receive_roll_result_message(self, raw_message: str):
@@ -43,6 +45,14 @@ class RollMessageHandler(MessageHandler):
             print(f"Invalid JSON: {raw_message}")
             return None
         return message
+
+    def receive_roll_batch_result_message(self, raw_message: str):
+        try:
+            message = RollBatchResultMessage(**json.loads(raw_message))
+        except json.JSONDecodeError:
+            print(f"Invalid JSON: {raw_message}")
+            return None
+        return message
     
     def handle_dice_count_button(self, event):
         dice_name = event.target.id.split("-")[-2]
@@ -66,4 +76,18 @@ class RollMessageHandler(MessageHandler):
             self.client_name,
             payload,
             pydom["#dice-comment"][0].value,
+            is_private=document.getElementById('dice-private').checked,
+        ).to_json()))
+
+    def on_click_roll_squad_button(self, *_, **__):
+        squad_size = max(1, int(pydom["#dice-squad-size"][0].value or 1))
+        payload = json.dumps({f"#{index+1}": self.dice_pool for index in range(squad_size)})
+
+        self.ws.send(str(RollBatchRequestMessage(
+            self.group_name,
+            self.client_name,
+            self.client_name,
+            payload,
+            pydom["#dice-comment"][0].value,
+            is_private=document.getElementById('dice-private').checked,
         ).to_json()))
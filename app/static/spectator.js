@@ -0,0 +1,135 @@
+// Read-only viewer of a group without PyScript. The event stream starts with a GroupSnapshotMessage and
+// then carries the same messages the players receive, each followed by a "history" event with its display
+// html if it has one. A reconnect starts over with a fresh snapshot.
+"use strict";
+
+const eventsUrl = document.currentScript.dataset.eventsUrl;
+const statusIndicator = document.getElementById("socket-status-indicator");
+const destinyMonitor = document.getElementById("destiny-monitor");
+const characterTableBody = document.getElementById("character-table-body");
+const messages = document.getElementById("messages");
+const characters = new Map();
+
+function showDestinyPoint(pointId, isLight) {
+  let point = document.getElementById(`destiny-${pointId}`);
+  if (!point) {
+    point = document.createElement("li");
+    point.id = `destiny-${pointId}`;
+    point.className = "size-16 rounded-full inline-block m-1";
+    destinyMonitor.append(point);
+  }
+  point.style.backgroundColor = isLight ? "yellow" : "black";
+}
+
+function removeDestinyPoint(pointId) {
+  const point = document.getElementById(`destiny-${pointId}`);
+  if (!point) {
+    return;
+  }
+  point.remove();
+  // the server keeps the ids 1 to point count, so the points after the removed one move down
+  Array.from(destinyMonitor.children).forEach((child, position) => {
+    child.id = `destiny-${position + 1}`;
+  });
+}
+
+function showCharacter(character) {
+  characters.set(character.char_name, character);
+  let row = document.getElementById(`character-row-${character.char_name}`);
+  if (!row) {
+    row = document.createElement("tr");
+    row.id = `character-row-${character.char_name}`;
+    characterTableBody.append(row);
+  }
+  row.replaceChildren(
+    ...[
+      character.char_name,
+      `${character.wound_current} / ${character.wound_limit}`,
+      `${character.strain_current} / ${character.strain_limit}`,
+      `${character.defense_melee} / ${character.defense_ranged}`,
+      `${character.soak}`,
+      character.status_flags,
+    ].map((text) => {
+      const cell = document.createElement("td");
+      cell.textContent = text;
+      return cell;
+    })
+  );
+}
+
+function toggleStatusFlag(character, flagName, isSet) {
+  const statusFlags = character.status_flags.split(",").filter((name) => name && name !== flagName);
+  if (isSet) {
+    statusFlags.push(flagName);
+  }
+  return statusFlags.join(",");
+}
+
+function moveCharacter(charName, newPosition) {
+  const row = document.getElementById(`character-row-${charName}`);
+  if (row && newPosition >= 0) {
+    characterTableBody.removeChild(row);
+    characterTableBody.insertBefore(row, characterTableBody.children.item(newPosition));
+  }
+}
+
+// rendered by the server, the same html the players see in their history
+function showHistory(eventHtml) {
+  const entry = document.createElement("li");
+  entry.innerHTML = eventHtml;
+  messages.append(entry);
+}
+
+function showSnapshot(snapshot) {
+  destinyMonitor.replaceChildren();
+  snapshot.destiny_points.forEach((point) => showDestinyPoint(point.point_id, point.is_light));
+  characterTableBody.replaceChildren();
+  characters.clear();
+  snapshot.characters.forEach(showCharacter);
+  messages.replaceChildren();
+  snapshot.history.forEach(showHistory);
+}
+
+function showMessage(message) {
+  const character = characters.get(message.char_name);
+  switch (message.message_type) {
+    case "DestinyAddMessage":
+      showDestinyPoint(message.point_id, message.is_light);
+      break;
+    case "DestinySwitchMessage":
+      showDestinyPoint(message.point_id, !message.was_light);
+      break;
+    case "DestinyRemoveMessage":
+      removeDestinyPoint(message.point_id);
+      break;
+    case "CharacterCreateMessage":
+      showCharacter(message);
+      break;
+    case "CharacterUpdateMessage":
+      if (character) {
+        showCharacter({ ...character, [message.trait_name]: message.trait_value });
+      }
+      break;
+    case "CharacterStatusToggleMessage":
+      if (character) {
+        showCharacter({ ...character, status_flags: toggleStatusFlag(character, message.flag_name, message.is_set) });
+      }
+      break;
+    case "CharacterDeleteMessage":
+      characters.delete(message.char_name);
+      document.getElementById(`character-row-${message.char_name}`)?.remove();
+      break;
+    case "InitiativeOrderMessage":
+      moveCharacter(message.char_name, message.new_position);
+      break;
+  }
+}
+
+const events = new EventSource(eventsUrl);
+events.addEventListener("snapshot", (event) => showSnapshot(JSON.parse(event.data)));
+events.addEventListener("message", (event) => showMessage(JSON.parse(event.data)));
+// follows the message it belongs to
+events.addEventListener("history", (event) => showHistory(JSON.parse(event.data)));
+events.addEventListener("open", () => statusIndicator.classList.replace("bg-red-500/70", "bg-green-500/70"));
+// the browser reconnects on its own, the new stream starts with a snapshot again
+events.addEventListener("error", () => statusIndicator.classList.replace("bg-green-500/70", "bg-red-500/70"));
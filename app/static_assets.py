@@ -0,0 +1,163 @@
+"""
+This file contains the static asset pipeline.
+
+build() copies every file of app/static to STATIC_BUILD_DIR with its content hash in the file
+name and precompressed gzip (and brotli, if installed) variants next to it. The fingerprinted
+files never change, so PrecompressedStaticFiles serves them with immutable caching and picks
+the precompressed variant by Accept-Encoding. Templates get their URLs from static_url, which
+falls back to the unfingerprinted /static files as long as no build exists.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import pathlib
+import stat
+
+import anyio
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = "app/static"
+STATIC_URL = "/static"
+STATIC_BUILD_DIR = os.getenv("STATIC_BUILD_DIR", "static_build")
+STATIC_BUILD_URL = "/assets"
+MANIFEST_FILE_NAME = "manifest.json"
+# files smaller than this gain nothing from compression
+COMPRESS_MIN_SIZE = 512
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def _compress_brotli(content: bytes):
+    return brotli.compress(content, quality=11)
+
+
+def _compress_gzip(content: bytes):
+    return gzip.compress(content, compresslevel=9, mtime=0)
+
+
+# preferred encoding first
+ENCODINGS = [("br", ".br", _compress_brotli)] if brotli is not None else []
+ENCODINGS.append(("gzip", ".gz", _compress_gzip))
+
+
+def fingerprinted_name(relative_path: str, content: bytes):
+    """Inserts the content hash before the file extension, scripts/pywebsocket.py -> scripts/pywebsocket.1a2b3c4d5e6f.py"""
+    path = pathlib.PurePosixPath(relative_path)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return str(path.with_name(f"{path.stem}.{digest}{path.suffix}"))
+
+
+def accepted_encodings(accept_encoding: str):
+    """Returns the content codings of an Accept-Encoding header that are not refused with q=0"""
+    encodings = set()
+    for coding in accept_encoding.split(","):
+        name, _, parameters = coding.partition(";")
+        _, _, quality = parameters.partition("=")
+        try:
+            if quality and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+class StaticAssets:
+    """Class that builds the fingerprinted assets and maps source paths to their URLs"""
+
+    source_dir: str
+    build_dir: str
+    manifest: dict[str, str]
+
+    def __init__(self, source_dir: str = STATIC_DIR, build_dir: str = STATIC_BUILD_DIR):
+        self.source_dir = source_dir
+        self.build_dir = build_dir
+        self.manifest = {}
+
+    def source_files(self):
+        """Returns the paths of all static files relative to the source directory, stylesheets last"""
+        source = pathlib.Path(self.source_dir)
+        relative_paths = [
+            path.relative_to(source).as_posix()
+            for path in source.rglob("*")
+            if path.is_file() and "__pycache__" not in path.parts
+        ]
+        # stylesheets reference the other files, so they are fingerprinted after them
+        return sorted(relative_paths, key=lambda relative_path: (relative_path.endswith(".css"), relative_path))
+
+    def build(self):
+        """Writes the fingerprinted and precompressed files and the manifest, returns the manifest"""
+        build = pathlib.Path(self.build_dir)
+        manifest = {}
+        for relative_path in self.source_files():
+            content = (pathlib.Path(self.source_dir) / relative_path).read_bytes()
+            if relative_path.endswith(".css"):
+                for referenced_path, built_path in manifest.items():
+                    content = content.replace(
+                        f"{STATIC_URL}/{referenced_path}".encode(), f"{STATIC_BUILD_URL}/{built_path}".encode()
+                    )
+            built_path = fingerprinted_name(relative_path, content)
+            target = build / built_path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(content)
+            if len(content) >= COMPRESS_MIN_SIZE:
+                for _, suffix, compress in ENCODINGS:
+                    compressed = compress(content)
+                    if len(compressed) < len(content):
+                        target.with_name(target.name + suffix).write_bytes(compressed)
+            manifest[relative_path] = built_path
+        # older fingerprinted files are kept, so pages rendered before the build still load
+        (build / MANIFEST_FILE_NAME).write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+        self.manifest = manifest
+        return manifest
+
+    def load(self):
+        """Loads the manifest of the last build, without a build the unfingerprinted files are used"""
+        manifest_path = pathlib.Path(self.build_dir) / MANIFEST_FILE_NAME
+        self.manifest = json.loads(manifest_path.read_text(encoding="utf-8")) if manifest_path.exists() else {}
+        return self.manifest
+
+    def url(self, relative_path: str):
+        """Returns the URL of a static file, used as static_url in the templates"""
+        if relative_path in self.manifest:
+            return f"{STATIC_BUILD_URL}/{self.manifest[relative_path]}"
+        return f"{STATIC_URL}/{relative_path}"
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """Serves fingerprinted files with immutable caching, precompressed if the client accepts it"""
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if path == MANIFEST_FILE_NAME:
+            raise HTTPException(status_code=404)
+        response = None
+        if scope["method"] in ("GET", "HEAD"):
+            encodings = accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+            for encoding, suffix, _ in ENCODINGS:
+                if encoding not in encodings:
+                    continue
+                full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path + suffix)
+                if stat_result is not None and stat.S_ISREG(stat_result.st_mode):
+                    # the media type is guessed from the name without the compression suffix
+                    response = self.file_response(full_path, stat_result, scope)
+                    if response.status_code == 200:
+                        response.headers["content-encoding"] = encoding
+                    break
+        if response is None:
+            response = await super().get_response(path, scope)
+        response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        response.headers["vary"] = "Accept-Encoding"
+        return response
+
+
+static_assets = StaticAssets()
@@ -0,0 +1,155 @@
+"""
+This file contains the Tracer class.
+
+It records nested timing spans across the message pipeline with contextvars, keeps the slowest
+recent traces in a ring buffer and can append them to a file in the Chrome trace event format.
+"""
+
+import json
+import os
+import random
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import count
+from time import perf_counter_ns, time_ns
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "100"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "100"))
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")
+# current span inside a root that was not sampled, so its children are not recorded either
+NOT_SAMPLED = "not sampled"
+
+
+class Span:
+    """A single timed step of a trace, the root span collects all spans of its trace"""
+
+    name: str
+    trace_id: int
+    span_id: int
+    parent_id: int | None
+    attributes: dict
+    start_ns: int
+    wall_start_ns: int
+    duration_ns: int
+    root: "Span"
+    spans: list["Span"]
+
+    def __init__(self, name: str, trace_id: int, span_id: int, parent: "Span | None", attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start_ns = perf_counter_ns()
+        self.wall_start_ns = time_ns()
+        self.duration_ns = 0
+        self.root = parent.root if parent else self
+        self.spans = []
+        self.root.spans.append(self)
+
+    def to_dict(self):
+        """Converts the span to a JSON serializable dict"""
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_us": self.wall_start_ns // 1000,
+            "duration_ms": round(self.duration_ns / 1e6, 3),
+            "attributes": self.attributes,
+        }
+
+    def to_trace_event(self):
+        """Converts the span to a complete event of the Chrome trace event format"""
+        return {
+            "name": self.name,
+            "ph": "X",
+            "ts": self.wall_start_ns // 1000,
+            "dur": self.duration_ns // 1000,
+            "pid": os.getpid(),
+            "tid": self.trace_id,
+            "args": self.attributes,
+        }
+
+
+class Tracer:
+    """Class that creates spans, samples traces and keeps the recent slow ones"""
+
+    sample_rate: float
+    slow_threshold_ms: float
+    slow_traces: deque
+    export_file: str
+    current_span: ContextVar
+
+    def __init__(
+        self,
+        sample_rate: float = TRACE_SAMPLE_RATE,
+        slow_threshold_ms: float = TRACE_SLOW_MS,
+        buffer_size: int = TRACE_BUFFER_SIZE,
+        export_file: str = TRACE_EXPORT_FILE,
+    ):
+        self.sample_rate = sample_rate
+        self.slow_threshold_ms = slow_threshold_ms
+        self.slow_traces = deque(maxlen=buffer_size)
+        self.export_file = export_file
+        self.current_span = ContextVar("current_span", default=None)
+        self._ids = count(1)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Times the enclosed block as a child of the current span, a new root span is only recorded if sampled"""
+        parent: Span | str | None = self.current_span.get()
+        if parent is NOT_SAMPLED:
+            yield None
+            return
+        if parent is None and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            token = self.current_span.set(NOT_SAMPLED)
+            try:
+                yield None
+            finally:
+                self.current_span.reset(token)
+            return
+        span_id = next(self._ids)
+        span = Span(name, parent.trace_id if parent else span_id, span_id, parent, attributes)
+        token = self.current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.attributes["error"] = repr(e)
+            raise
+        finally:
+            span.duration_ns = perf_counter_ns() - span.start_ns
+            self.current_span.reset(token)
+            if parent is None:
+                self.finish_trace(span)
+
+    def finish_trace(self, root: Span):
+        """Keeps and exports a finished trace if it was slower than the threshold"""
+        if root.duration_ns / 1e6 < self.slow_threshold_ms:
+            return
+        self.slow_traces.append([span.to_dict() for span in root.spans])
+        if self.export_file:
+            self.export(root)
+
+    def export(self, root: Span):
+        """Appends the spans of a trace to the export file in the Chrome trace event array format"""
+        is_new_file = not os.path.exists(self.export_file)
+        with open(self.export_file, "a", encoding="utf-8") as export_file:
+            if is_new_file:
+                # the closing bracket may be omitted in the trace event array format, so the file stays appendable
+                export_file.write("[\n")
+            for span in root.spans:
+                export_file.write(json.dumps(span.to_trace_event()) + ",\n")
+
+    def report(self):
+        """Returns the recent slow traces, newest first"""
+        return {
+            "sample_rate": self.sample_rate,
+            "slow_threshold_ms": self.slow_threshold_ms,
+            "traces": list(reversed(self.slow_traces)),
+        }
+
+
+tracer = Tracer()
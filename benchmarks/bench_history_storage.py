@@ -0,0 +1,89 @@
+"""
+Compares the database size and history load time of the previous JSON history format
+with the compact payload format on a synthetic history.
+
+Usage: python -m benchmarks.bench_history_storage [--events N]
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from app.db_controller import roll_pool
+from app.models import MESSAGE_KINDS, decode_payload, encode_payload
+from app.static.scripts.message_types import (
+    CharacterUpdateMessage,
+    DestinySwitchMessage,
+    RollResultMessage,
+)
+
+
+def make_messages(count: int):
+    """Creates a mix of roll, character and destiny messages like a played session"""
+    messages = []
+    for index in range(count):
+        group_name = f"group-{index % 20}"
+        kind = random.random()
+        if kind < 0.6:
+            dice_pool = {"ability": random.randint(1, 4), "difficulty": random.randint(1, 3), "boost": random.randint(0, 2)}
+            messages.append(RollResultMessage(group_name, "Luke", "player", json.dumps(dice_pool), json.dumps(roll_pool(dice_pool)), "shoot the Hutt"))
+        elif kind < 0.9:
+            messages.append(CharacterUpdateMessage(group_name, "Luke", "wound_current", random.randint(0, 12), "player"))
+        else:
+            messages.append(DestinySwitchMessage(random.randint(1, 6), random.random() < 0.5, group_name, "gm"))
+    return messages
+
+
+def write_database(path: str, rows: list[tuple], compact: bool):
+    """Writes the rows in the previous or the compact schema and vacuums the file"""
+    connection = sqlite3.connect(path)
+    data_type = "BLOB" if compact else "VARCHAR"
+    kind_type = "INTEGER" if compact else "VARCHAR"
+    connection.execute(
+        f"CREATE TABLE historyevent (id INTEGER PRIMARY KEY, group_name VARCHAR, created_at DATETIME, "
+        f"event_type {kind_type}, event_data {data_type})"
+    )
+    connection.executemany("INSERT INTO historyevent VALUES (?, ?, ?, ?, ?)", rows)
+    connection.commit()
+    connection.execute("VACUUM")
+    connection.close()
+    return os.path.getsize(path)
+
+
+def load_database(path: str, decode):
+    """Loads and decodes all rows, returns the seconds it took"""
+    started = perf_counter()
+    connection = sqlite3.connect(path)
+    for row in connection.execute("SELECT event_type, event_data FROM historyevent ORDER BY created_at DESC"):
+        decode(row[1])
+    connection.close()
+    return perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=50_000)
+    arguments = parser.parse_args()
+    messages = make_messages(arguments.events)
+    started_at = datetime(2024, 5, 13, 20, 0)
+    json_rows = []
+    compact_rows = []
+    for index, message in enumerate(messages):
+        created_at = (started_at + timedelta(seconds=index)).isoformat(sep=" ")
+        json_rows.append((index + 1, message.group_name, created_at, message.message_type, message.to_json()))
+        compact_rows.append((index + 1, message.group_name, created_at, MESSAGE_KINDS[message.message_type], encode_payload(message.__dict__)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        json_size = write_database(os.path.join(directory, "json.db"), json_rows, compact=False)
+        compact_size = write_database(os.path.join(directory, "compact.db"), compact_rows, compact=True)
+        json_load = min(load_database(os.path.join(directory, "json.db"), json.loads) for _ in range(3))
+        compact_load = min(load_database(os.path.join(directory, "compact.db"), decode_payload) for _ in range(3))
+
+    print(f"{arguments.events} events")
+    print(f"database size  json {json_size / 1024:9.1f}KiB  compact {compact_size / 1024:9.1f}KiB  ({compact_size / json_size:.2f}x)")
+    print(f"load + decode  json {json_load * 1000:9.1f}ms   compact {compact_load * 1000:9.1f}ms   ({compact_load / json_load:.2f}x)")
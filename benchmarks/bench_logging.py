@@ -0,0 +1,89 @@
+"""
+Compares the message pipeline with the previous print calls, with queue logging at INFO
+(payloads skipped) and with queue logging at DEBUG (every payload logged).
+
+Usage: python -m benchmarks.bench_logging [--number N] [--output FILE]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import timeit
+
+from app.logging_config import log_payload, logging_setup
+from app.message_bus import MessageBus, logger
+from app.static.scripts.message_types import CharacterUpdateMessage
+
+FRAME = CharacterUpdateMessage("bench", "luke", "wound_current", 4, "gm").to_json()
+
+
+class StubConnectionManager:
+    """Accepts broadcasts without sending them anywhere"""
+
+    active_connections: dict = {}
+    spectators: dict = {}
+
+    async def broadcast(self, group_name: str, message: str, display_html: str | None = None):
+        pass
+
+
+async def noop_handler(message):
+    return message
+
+
+def create_message_bus():
+    message_bus = MessageBus(StubConnectionManager())
+    message_bus.register_handler("CharacterUpdateMessage", noop_handler)
+    return message_bus
+
+
+async def print_path(message_bus: MessageBus, number: int):
+    """The prints previously done by websocket_endpoint and MessageBus.process_message"""
+    for _ in range(number):
+        print("received:", FRAME)
+        message_json = json.loads(FRAME)
+        message = message_bus.message_types[message_json["message_type"]].from_json(message_json)
+        print(f"Processing: {message_json} -> {type(message)}")
+        await message_bus.dispatch(message)
+
+
+async def logging_path(message_bus: MessageBus, number: int):
+    """The same steps with log_payload"""
+    for _ in range(number):
+        log_payload(logger, "Received frame", FRAME, group_name="bench", client_name="gm")
+        message_json = json.loads(FRAME)
+        message = message_bus.message_types[message_json["message_type"]].from_json(message_json)
+        log_payload(logger, "Processing", message_json, message_type=message_json["message_type"])
+        await message_bus.dispatch(message)
+
+
+def measure(path, message_bus: MessageBus, number: int, repeat: int):
+    """Best time per message in microseconds"""
+    best = min(timeit.repeat(lambda: asyncio.run(path(message_bus, number)), number=1, repeat=repeat))
+    return best / number * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=os.devnull, help="where printed and logged lines are written")
+    arguments = parser.parse_args()
+    message_bus = create_message_bus()
+    results = {}
+    with open(arguments.output, "w", encoding="utf-8") as output:
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            results["print"] = measure(print_path, message_bus, arguments.number, arguments.repeat)
+        finally:
+            sys.stdout = stdout
+        for level in ("INFO", "DEBUG"):
+            logging_setup.start(level, output)
+            try:
+                results[f"logging {level}"] = measure(logging_path, message_bus, arguments.number, arguments.repeat)
+            finally:
+                logging_setup.stop()
+    for name, per_message in results.items():
+        print(f"{name:14} {per_message:6.2f}us/message ({per_message / results['print']:4.2f}x)")
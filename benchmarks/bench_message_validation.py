@@ -0,0 +1,65 @@
+"""
+Compares the previous inbound path (json.loads, patching author/group_name, from_json)
+with the compiled MessageValidator.
+
+Usage: python -m benchmarks.bench_message_validation [--number N]
+"""
+
+import argparse
+import json
+import timeit
+
+from app.dependencies import get_message_bus, get_message_validator, register_handlers
+from app.static.scripts.message_types import (
+    CharacterUpdateMessage,
+    DestinySwitchMessage,
+    RollReqestMessage,
+)
+
+FRAMES = {
+    "DestinySwitchMessage": DestinySwitchMessage("3", True, "bench", "gm").to_json(),
+    "CharacterUpdateMessage": CharacterUpdateMessage("bench", "luke", "wound_current", 4, "gm").to_json(),
+    "RollReqestMessage": RollReqestMessage(
+        "bench", "luke", "gm", json.dumps({"ability": 2, "difficulty": 2}), "Hutt"
+    ).to_json(),
+}
+
+
+def current_path(raw_message: str):
+    """The decoding previously done by websocket_endpoint and MessageBus.process_message"""
+    data = json.loads(raw_message)
+    data["author"] = "gm"
+    data["group_name"] = "bench"
+    return get_message_bus().message_types[data["message_type"]].from_json(data)
+
+
+def validated_path(raw_message: str):
+    """The compiled validator used by websocket_endpoint now"""
+    return get_message_validator().decode(raw_message, "bench", "gm")
+
+
+def rejected_path(raw_message: str):
+    """An oversized frame, rejected before json.loads"""
+    try:
+        validated_path(raw_message)
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    arguments = parser.parse_args()
+    register_handlers()
+    for message_type, frame in FRAMES.items():
+        current = min(timeit.repeat(lambda: current_path(frame), number=arguments.number, repeat=arguments.repeat))
+        validated = min(timeit.repeat(lambda: validated_path(frame), number=arguments.number, repeat=arguments.repeat))
+        print(
+            f"{message_type:24} current {current / arguments.number * 1e6:6.2f}us "
+            f"validated {validated / arguments.number * 1e6:6.2f}us "
+            f"({validated / current:4.2f}x)"
+        )
+    oversized = "x" * (get_message_validator().max_frame_size + 1)
+    rejected = min(timeit.repeat(lambda: rejected_path(oversized), number=arguments.number, repeat=arguments.repeat))
+    print(f"{'oversized reject':24} validated {rejected / arguments.number * 1e6:6.2f}us")
@@ -0,0 +1,369 @@
+"""
+Runs the microbenchmarks of the hot paths and compares them with the stored baselines.
+
+Every benchmark reports the best mean time per call in microseconds. A benchmark that is slower
+than its baseline times the threshold is flagged as regression and the exit code is 1.
+The database handlers run against a temporary SQLite file, sockets are faked. The baselines are
+machine specific, store new ones with --save-baseline before comparing on another machine.
+
+Usage: python -m benchmarks.regression [--threshold 1.5] [--filter TEXT] [--save-baseline]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import tempfile
+from itertools import count
+from time import perf_counter_ns
+from typing import Awaitable, Callable
+
+# the database file is read on import, so the temporary database has to be set before any app import
+BENCH_DIRECTORY = tempfile.TemporaryDirectory(prefix="jedi-bench-")
+os.environ["SQL_FILE_NAME"] = os.path.join(BENCH_DIRECTORY.name, "bench.db")
+
+from app.connection_manager import GM_CLIENT_NAME, ConnectionManager  # noqa: E402
+from app.db_controller import (  # noqa: E402
+    add_destiny_state,
+    create_character_state,
+    delete_character_state,
+    delete_destiny_state,
+    roll_dice,
+    roll_dice_batch,
+    store_history_event,
+    toggle_character_status,
+    update_character_state,
+    update_destiny_state,
+    update_roll_statistics,
+)
+from app.dependencies import get_manager, get_message_bus, register_handlers  # noqa: E402
+from app.models import MAX_DESTINY_POINTS, create_db_and_tables  # noqa: E402
+from app.static.scripts.message_types import (  # noqa: E402
+    CharacterCreateMessage,
+    CharacterDeleteMessage,
+    CharacterStatusToggleMessage,
+    CharacterUpdateMessage,
+    DestinyAddMessage,
+    DestinyRemoveMessage,
+    DestinySwitchMessage,
+    GroupSnapshotMessage,
+    InitiativeOrderMessage,
+    PresenceMessage,
+    PresenceSnapshotMessage,
+    RollBatchRequestMessage,
+    RollBatchResultMessage,
+    RollReqestMessage,
+    RollResultMessage,
+)
+
+BASELINE_FILE = pathlib.Path(__file__).with_name("baselines.json")
+# the database handlers vary by about 25% between runs on the same machine
+DEFAULT_THRESHOLD = 1.5
+
+DICE_POOL = json.dumps({"ability": 2, "proficiency": 1, "difficulty": 2, "challenge": 1, "boost": 1, "setback": 1})
+DICE_RESULT = json.dumps({
+    "ability": ["success", "advantage"],
+    "proficiency": ["triumph"],
+    "difficulty": ["failure", "threat"],
+    "challenge": ["despair"],
+    "boost": ["advantage_advantage"],
+    "setback": ["failure"],
+})
+SQUAD_POOLS = json.dumps({f"trooper {index}": {"ability": 2, "difficulty": 2} for index in range(1, 5)})
+
+SAMPLE_MESSAGES = [
+    DestinySwitchMessage(1, True, "bench", "gm"),
+    DestinyAddMessage(1, True, "bench", "gm"),
+    DestinyRemoveMessage(1, "bench", "gm"),
+    CharacterCreateMessage("bench", "gm", "luke", 14, 3, 12, 2, 1, 1, 3, "", "", 1, 2, 1),
+    CharacterUpdateMessage("bench", "luke", "wound_current", 4, "gm"),
+    CharacterDeleteMessage("bench", "luke", "gm"),
+    CharacterStatusToggleMessage("bench", "luke", "prone", True, "gm"),
+    InitiativeOrderMessage("bench", "gm", "luke", 2, 0),
+    PresenceSnapshotMessage("bench", "gm", ["gm", "luke", "leia"], ["han"]),
+    PresenceMessage("bench", "gm", "luke", "joined"),
+    GroupSnapshotMessage(
+        "bench",
+        "gm",
+        [{"point_id": index, "is_light": index % 2 == 0} for index in range(1, 7)],
+        [{"char_name": name, "wound_current": 3, "wound_limit": 14} for name in ("luke", "leia", "han")],
+        ["<b>gm</b> switched a destiny point"] * 50,
+    ),
+    RollReqestMessage("bench", "luke", "gm", DICE_POOL, "shoot the Hutt"),
+    RollResultMessage("bench", "luke", "gm", DICE_POOL, DICE_RESULT, "shoot the Hutt"),
+    RollBatchRequestMessage("bench", "squad", "gm", SQUAD_POOLS, "volley"),
+    RollBatchResultMessage(
+        "bench",
+        "squad",
+        "gm",
+        SQUAD_POOLS,
+        json.dumps({f"trooper {index}": {"ability": ["success"], "difficulty": ["threat"]} for index in range(1, 5)}),
+        "volley",
+    ),
+]
+
+Setup = Callable[[], Awaitable[tuple]]
+
+
+def constant(*arguments) -> Setup:
+    """Setup that passes the same arguments to every call"""
+
+    async def setup():
+        return arguments
+
+    return setup
+
+
+def switched_back(message_json: dict) -> Setup:
+    """Setup that switches a destiny point back and forth, as a switch only applies to the stored state"""
+    switches = count()
+
+    async def setup():
+        return ({**message_json, "was_light": next(switches) % 2 == 0},)
+
+    return setup
+
+
+def drained(connection_manager: ConnectionManager) -> Setup:
+    """Setup that empties the spectator queues of the bench group, so no spectator falls behind and is dropped"""
+
+    async def setup():
+        for queue in connection_manager.spectators.get("bench", ()):
+            while not queue.empty():
+                queue.get_nowait()
+        return ()
+
+    return setup
+
+
+class FakeWebSocket:
+    """Counts the sent messages instead of sending them"""
+
+    sent: int
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_text(self, message: str):
+        self.sent += 1
+
+
+class Benchmark:
+    """A named callable that is timed in batches, setup prepares the arguments of each call outside the timing"""
+
+    name: str
+    function: Callable
+    setup: Setup | None
+    number: int
+    is_async: bool
+
+    def __init__(
+        self, name: str, function: Callable, setup: Setup | None = None, number: int = 2000, is_async: bool = False
+    ):
+        self.name = name
+        self.function = function
+        self.setup = setup
+        self.number = number
+        self.is_async = is_async or setup is not None
+
+    async def run_batch(self):
+        """Returns the mean nanoseconds per call of one batch"""
+        if not self.is_async:
+            function = self.function
+            started = perf_counter_ns()
+            for _ in range(self.number):
+                function()
+            return (perf_counter_ns() - started) / self.number
+        elapsed = 0
+        for _ in range(self.number):
+            arguments = await self.setup() if self.setup is not None else ()
+            started = perf_counter_ns()
+            await self.function(*arguments)
+            elapsed += perf_counter_ns() - started
+        return elapsed / self.number
+
+    async def measure(self, repeat: int):
+        """Returns the best mean microseconds per call of repeat batches"""
+        return min([await self.run_batch() for _ in range(repeat)]) / 1000
+
+
+def message_benchmarks():
+    """to_json and from_json of every message type and the display of roll results"""
+    benchmarks = []
+    for message in SAMPLE_MESSAGES:
+        message_json = json.loads(message.to_json())
+        benchmarks.append(Benchmark(f"to_json[{message.message_type}]", message.to_json))
+        benchmarks.append(
+            Benchmark(f"from_json[{message.message_type}]", lambda cls=type(message), data=message_json: cls.from_json(data))
+        )
+    roll_result = next(message for message in SAMPLE_MESSAGES if isinstance(message, RollResultMessage))
+    benchmarks.append(Benchmark("RollResultMessage.display_event", lambda: roll_result.display_event))
+    return benchmarks
+
+
+def handler_benchmarks():
+    """Every database handler and the dice rolls, each call on its own group where state would pile up"""
+    ids = count(1)
+    switches = count()
+    toggles = count()
+
+    async def new_destiny_point():
+        # a pool holds MAX_DESTINY_POINTS, so the points are spread over several groups
+        return (DestinyAddMessage(-1, True, f"bench-destiny-add-{next(ids) // MAX_DESTINY_POINTS}", "gm"),)
+
+    async def add_destiny_point():
+        message = await add_destiny_state(DestinyAddMessage(-1, True, "bench-destiny-remove", "gm"))
+        return (DestinyRemoveMessage(message.point_id, "bench-destiny-remove", "gm"),)
+
+    async def switch_destiny_point():
+        # the point starts light and a switch only applies to the stored state
+        return (DestinySwitchMessage(1, next(switches) % 2 == 0, "bench-destiny", "gm"),)
+
+    async def new_character():
+        return (CharacterCreateMessage("bench-characters", "gm", f"trooper {next(ids)}"),)
+
+    async def existing_character():
+        return (CharacterUpdateMessage("bench", "luke", "wound_current", next(ids) % 14, "gm"),)
+
+    async def status_toggle():
+        # sets and clears the flag in turn, a toggle to the stored state is rejected
+        return (CharacterStatusToggleMessage("bench", "luke", "prone", next(toggles) % 2 == 0, "gm"),)
+
+    async def character_to_delete():
+        char_name = f"trooper {next(ids)}"
+        await create_character_state(CharacterCreateMessage("bench-characters-delete", "gm", char_name))
+        return (CharacterDeleteMessage("bench-characters-delete", char_name, "gm"),)
+
+    roll_request, roll_result = (
+        next(message for message in SAMPLE_MESSAGES if isinstance(message, message_type))
+        for message_type in (RollReqestMessage, RollResultMessage)
+    )
+    batch_request = next(message for message in SAMPLE_MESSAGES if isinstance(message, RollBatchRequestMessage))
+    return [
+        Benchmark("roll_dice", roll_dice, constant(roll_request)),
+        Benchmark("roll_dice_batch", roll_dice_batch, constant(batch_request)),
+        Benchmark("add_destiny_state", add_destiny_state, new_destiny_point, number=200),
+        Benchmark("update_destiny_state", update_destiny_state, switch_destiny_point, number=200),
+        Benchmark("delete_destiny_state", delete_destiny_state, add_destiny_point, number=200),
+        Benchmark("create_character_state", create_character_state, new_character, number=200),
+        Benchmark("update_character_state", update_character_state, existing_character, number=200),
+        Benchmark("toggle_character_status", toggle_character_status, status_toggle, number=200),
+        Benchmark("delete_character_state", delete_character_state, character_to_delete, number=200),
+        Benchmark("store_history_event", store_history_event, constant(roll_result), number=200),
+        Benchmark("update_roll_statistics", update_roll_statistics, constant(roll_result), number=200),
+    ]
+
+
+def pipeline_benchmarks():
+    """MessageBus.process_message with all handlers registered and ConnectionManager.broadcast by group size
+    and by the number of spectators next to 10 players"""
+    benchmarks = []
+    message_bus = get_message_bus()
+    fill_group(get_manager(), 10)
+    for message in SAMPLE_MESSAGES:
+        if message.message_type not in ("CharacterUpdateMessage", "RollReqestMessage", "DestinySwitchMessage"):
+            continue
+        message_json = json.loads(message.to_json())
+        setup = switched_back(message_json) if message.message_type == "DestinySwitchMessage" else constant(message_json)
+        benchmarks.append(
+            Benchmark(
+                f"process_message[{message.message_type}]",
+                message_bus.process_message,
+                setup,
+                number=200,
+            )
+        )
+    broadcast_message = next(message for message in SAMPLE_MESSAGES if isinstance(message, RollResultMessage)).to_json()
+    for members in (1, 10, 100):
+        connection_manager = ConnectionManager()
+        fill_group(connection_manager, members)
+
+        async def broadcast(connection_manager=connection_manager):
+            await connection_manager.broadcast("bench", broadcast_message)
+
+        async def send_to_gm(connection_manager=connection_manager):
+            await connection_manager.send_to_gm("bench", broadcast_message)
+
+        benchmarks.append(Benchmark(f"broadcast[{members}]", broadcast, is_async=True, number=500))
+        benchmarks.append(Benchmark(f"send_to_gm[{members}]", send_to_gm, is_async=True, number=500))
+    for spectators in (1, 10, 100, 1000):
+        connection_manager = ConnectionManager()
+        fill_group(connection_manager, 10)
+        for _ in range(spectators):
+            connection_manager.add_spectator("bench")
+
+        async def broadcast(connection_manager=connection_manager):
+            await connection_manager.broadcast("bench", broadcast_message)
+
+        benchmarks.append(
+            Benchmark(f"broadcast_spectators[{spectators}]", broadcast, drained(connection_manager), number=200)
+        )
+    return benchmarks
+
+
+def fill_group(connection_manager: ConnectionManager, members: int):
+    """Registers the gm and members - 1 players with one fake socket each in the bench group"""
+    client_names = [GM_CLIENT_NAME] + [f"player {index}" for index in range(1, members)]
+    connection_manager.clients["bench"] = {client_name: {FakeWebSocket()} for client_name in client_names}
+    connection_manager.active_connections["bench"] = {
+        connection for connections in connection_manager.clients["bench"].values() for connection in connections
+    }
+
+
+async def prepare_database():
+    """Creates the rows the update handlers expect"""
+    create_db_and_tables()
+    register_handlers()
+    await add_destiny_state(DestinyAddMessage(-1, True, "bench-destiny", "gm"))
+    await add_destiny_state(DestinyAddMessage(-1, True, "bench", "gm"))
+    await create_character_state(next(message for message in SAMPLE_MESSAGES if isinstance(message, CharacterCreateMessage)))
+
+
+def compare(results: dict[str, float], baselines: dict[str, float], threshold: float):
+    """Prints every result next to its baseline, returns the names of the regressions"""
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print(f"{name:48} {result:10.2f}us   (no baseline)")
+            continue
+        ratio = result / baseline
+        flag = ""
+        if ratio > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:48} {result:10.2f}us {baseline:10.2f}us ({ratio:4.2f}x){flag}")
+    return regressions
+
+
+async def main(arguments: argparse.Namespace):
+    await prepare_database()
+    benchmarks = [
+        benchmark
+        for benchmark in message_benchmarks() + handler_benchmarks() + pipeline_benchmarks()
+        if arguments.filter in benchmark.name
+    ]
+    results = {benchmark.name: await benchmark.measure(arguments.repeat) for benchmark in benchmarks}
+    baselines = json.loads(BASELINE_FILE.read_text(encoding="utf-8")) if BASELINE_FILE.exists() else {}
+    regressions = compare(results, baselines, arguments.threshold)
+    if arguments.save_baseline:
+        baselines.update((name, round(result, 3)) for name, result in results.items())
+        BASELINE_FILE.write_text(json.dumps(baselines, indent=2) + "\n", encoding="utf-8")
+        print(f"Saved {len(results)} baselines to {BASELINE_FILE}")
+        return 0
+    if regressions:
+        print(f"{len(regressions)} regressions slower than {arguments.threshold}x their baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown against the baseline")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as new baselines")
+    exit_code = asyncio.run(main(parser.parse_args()))
+    BENCH_DIRECTORY.cleanup()
+    raise SystemExit(exit_code)
@@ -0,0 +1,303 @@
+"""
+Runs simulated groups that join, play and leave against the app for hours and tracks the memory growth.
+
+The app runs in-process with its lifespan against a temporary SQLite file, every player has its own
+websocket. Every interval the harness takes a tracemalloc snapshot, counts the live objects by type
+and records the in-process state of the app. The first sample after the warm-up is the baseline,
+the report lists the allocation sites and object types that grew the most since then. The exit code
+is 1 if the traced memory grew by more than the budget.
+
+Usage: python -m benchmarks.soak [--duration 3600] [--interval 60] [--groups 8] [--budget-mb 16]
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import tempfile
+import tracemalloc
+from collections import Counter
+from contextlib import ExitStack
+from itertools import count
+from time import monotonic
+
+# the database file and the limits are read on import, so the environment has to be set before any app import
+SOAK_DIRECTORY = tempfile.TemporaryDirectory(prefix="jedi-soak-")
+os.environ["SQL_FILE_NAME"] = os.path.join(SOAK_DIRECTORY.name, "soak.db")
+# the players send as fast as the app answers, dropped frames would never be answered
+os.environ.setdefault("FRAME_RATE", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from fastapi.testclient import TestClient  # noqa: E402
+from starlette.testclient import WebSocketTestSession  # noqa: E402
+
+from app.dependencies import get_group_lifecycle, get_manager, get_templates  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models import STATUS_FLAGS  # noqa: E402
+from app.static.scripts.message_types import (  # noqa: E402
+    CharacterCreateMessage,
+    CharacterStatusToggleMessage,
+    CharacterUpdateMessage,
+    DestinyAddMessage,
+    DestinyRemoveMessage,
+    DestinySwitchMessage,
+    JediMessage,
+    RollReqestMessage,
+)
+
+DICE_POOLS = [
+    {"ability": 2, "difficulty": 2},
+    {"proficiency": 1, "ability": 2, "difficulty": 3, "boost": 1},
+    {"ability": 3, "challenge": 1, "setback": 2},
+]
+# allocations of the harness and the interpreter itself are not reported
+TRACE_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+    tracemalloc.Filter(False, __file__),
+]
+
+
+class SimulatedGroup:
+    """A group of players with one websocket each that takes turns until its session is over"""
+
+    client: TestClient
+    group_name: str
+    players: list[str]
+    random: random.Random
+    session_turns: int
+    turns: int
+    sockets: dict[str, WebSocketTestSession]
+    destiny_points: list[bool]
+    status_flags: dict[str, set[str]]
+    request_ids: count
+    exit_stack: ExitStack
+
+    def __init__(self, client: TestClient, group_name: str, players: list[str], rng: random.Random, session_turns: int):
+        self.client = client
+        self.group_name = group_name
+        self.players = players
+        self.random = rng
+        self.session_turns = session_turns
+        self.turns = 0
+        self.sockets = {}
+        self.destiny_points = []
+        self.status_flags = {}
+        self.request_ids = count()
+        self.exit_stack = ExitStack()
+
+    def join(self):
+        """Connects every player and creates a character for each"""
+        for player in self.players:
+            self.sockets[player] = self.exit_stack.enter_context(
+                self.client.websocket_connect(f"/ws/{self.group_name}/{player}")
+            )
+        for player in self.players:
+            self.send(player, CharacterCreateMessage(self.group_name, player, player, wound_limit=14, strain_limit=12))
+            self.status_flags[player] = set()
+
+    def leave(self):
+        """Closes every socket of the group, unread frames are dropped with them"""
+        self.exit_stack.close()
+        self.sockets.clear()
+
+    def send(self, player: str, message: JediMessage):
+        """Sends a message and reads every socket up to its broadcast, so no frames pile up in the test client"""
+        request_id = f"soak-{next(self.request_ids)}"
+        message_data = json.loads(message.to_json())
+        message_data["request_id"] = request_id
+        self.sockets[player].send_text(json.dumps(message_data))
+        # the author first, a rejection only reaches the author and the others would wait forever
+        for websocket in [self.sockets[player]] + [socket for name, socket in self.sockets.items() if name != player]:
+            while True:
+                reply = json.loads(websocket.receive_text())
+                if reply.get("request_id") != request_id:
+                    continue
+                if reply["message_type"] == "RequestRejectedMessage":
+                    raise RuntimeError(f"{self.group_name}: {reply['reason']}")
+                break
+
+    def play_turn(self):
+        """Lets a random player do one of the things players do in a session"""
+        self.turns += 1
+        player = self.random.choice(self.players)
+        action = self.random.random()
+        if action < 0.35:
+            dice_pool = json.dumps(self.random.choice(DICE_POOLS))
+            self.send(player, RollReqestMessage(self.group_name, player, player, dice_pool, "soak"))
+        elif action < 0.55:
+            wounds = self.random.randint(0, 14)
+            self.send(player, CharacterUpdateMessage(self.group_name, player, "wound_current", wounds, player))
+        elif action < 0.7:
+            flag_name = self.random.choice(list(STATUS_FLAGS))
+            is_set = flag_name not in self.status_flags[player]
+            self.send(player, CharacterStatusToggleMessage(self.group_name, player, flag_name, is_set, player))
+            self.status_flags[player].symmetric_difference_update({flag_name})
+        elif action < 0.85:
+            self.play_destiny(player)
+        else:
+            # the rendered pages go through Jinja and the history queries
+            page = self.random.choice(
+                [f"/main/{self.group_name}/?char_name={player}", f"/shell/{self.group_name}/", f"/stats/{self.group_name}/"]
+            )
+            self.client.get(page).raise_for_status()
+
+    def play_destiny(self, player: str):
+        if len(self.destiny_points) < 3 or (len(self.destiny_points) < 8 and self.random.random() < 0.2):
+            is_light = self.random.random() < 0.5
+            self.send(player, DestinyAddMessage(-1, is_light, self.group_name, player))
+            self.destiny_points.append(is_light)
+        elif self.random.random() < 0.1:
+            self.send(player, DestinyRemoveMessage(1, self.group_name, player))
+            self.destiny_points.pop(0)
+        else:
+            point_id = self.random.randint(1, len(self.destiny_points))
+            was_light = self.destiny_points[point_id - 1]
+            self.send(player, DestinySwitchMessage(point_id, was_light, self.group_name, player))
+            self.destiny_points[point_id - 1] = not was_light
+
+    @property
+    def is_over(self):
+        return self.turns >= self.session_turns
+
+
+class MemorySample:
+    """The memory and the in-process state of the app at one point of the soak test"""
+
+    elapsed: float
+    snapshot: tracemalloc.Snapshot
+    traced_bytes: int
+    rss_bytes: int | None
+    object_counts: dict[str, int]
+    app_state: dict[str, int]
+
+    def __init__(self, elapsed: float):
+        gc.collect()
+        self.elapsed = elapsed
+        # counted here instead of with a Counter, so the counts are allocated in this file and filtered from the snapshots
+        self.object_counts = {}
+        for instance in gc.get_objects():
+            type_name = type(instance).__qualname__
+            self.object_counts[type_name] = self.object_counts.get(type_name, 0) + 1
+        self.snapshot = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+        self.traced_bytes = sum(statistic.size for statistic in self.snapshot.statistics("filename"))
+        self.rss_bytes = read_rss()
+        manager = get_manager()
+        self.app_state = {
+            "sockets": len(manager.socket_clients),
+            "connected_groups": len(manager.active_connections),
+            "tracked_groups": len(get_group_lifecycle().tracked_groups()),
+            "jinja_templates": len(get_templates().env.cache or ()),
+            "sessions": self.object_counts.get("Session", 0),
+            "identity_maps": self.object_counts.get("WeakInstanceDict", 0),
+        }
+
+
+def read_rss():
+    """Returns the resident set size of the process, None where /proc is not available"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def megabytes(size: int | None):
+    return f"{size / 2**20:8.2f}MB" if size is not None else "       n/a"
+
+
+def print_sample(sample: MemorySample, baseline: MemorySample | None):
+    growth = sample.traced_bytes - baseline.traced_bytes if baseline else 0
+    state = " ".join(f"{name}={value}" for name, value in sample.app_state.items())
+    print(
+        f"{sample.elapsed:8.0f}s traced {megabytes(sample.traced_bytes)} ({growth / 2**20:+.2f}MB) "
+        f"rss {megabytes(sample.rss_bytes)} {state}",
+        flush=True,
+    )
+
+
+def report(baseline: MemorySample, final: MemorySample, group_by: str, top: int):
+    """Prints the allocation sites and object types that grew the most since the baseline"""
+    print(f"\nTop {top} growing allocation sites since {baseline.elapsed:.0f}s:")
+    # compare_to sorts by the absolute difference, sites that shrank are skipped
+    growing = [statistic for statistic in final.snapshot.compare_to(baseline.snapshot, group_by) if statistic.size_diff > 0]
+    for statistic in growing[:top]:
+        print(f"  {statistic}")
+        if group_by == "traceback":
+            for line in statistic.traceback.format(most_recent_first=True):
+                print(f"      {line}")
+    print(f"\nTop {top} growing object types:")
+    object_growth = Counter(final.object_counts)
+    object_growth.subtract(baseline.object_counts)
+    for type_name, growth in object_growth.most_common(top):
+        if growth <= 0:
+            break
+        print(f"  {type_name:40} {growth:+8d} ({final.object_counts.get(type_name, 0)} alive)")
+
+
+def soak(arguments: argparse.Namespace):
+    """Plays the groups until the duration is over, returns the baseline and the final sample"""
+    rng = random.Random(arguments.seed)
+    group_numbers = count(1)
+    groups: list[SimulatedGroup] = []
+    # only the baseline and the latest sample are kept, every snapshot holds all traces
+    baseline = None
+    tracemalloc.start(arguments.frames)
+    with TestClient(app) as client:
+        start = monotonic()
+        next_sample = start + arguments.interval
+        while (now := monotonic()) - start < arguments.duration:
+            while len(groups) < arguments.groups:
+                group = SimulatedGroup(
+                    client,
+                    f"soak-{next(group_numbers)}",
+                    [f"player {index}" for index in range(1, rng.randint(2, arguments.players) + 1)],
+                    rng,
+                    rng.randint(arguments.session_turns // 2, arguments.session_turns * 2),
+                )
+                group.join()
+                groups.append(group)
+            group = rng.choice(groups)
+            group.play_turn()
+            if group.is_over:
+                group.leave()
+                groups.remove(group)
+            if now >= next_sample:
+                sample = MemorySample(now - start)
+                if baseline is None and sample.elapsed >= arguments.warmup:
+                    baseline = sample
+                print_sample(sample, baseline)
+                next_sample = now + arguments.interval
+        # taken while the groups still play, so it is comparable with the baseline
+        sample = MemorySample(monotonic() - start)
+        print_sample(sample, baseline)
+        for group in groups:
+            group.leave()
+    tracemalloc.stop()
+    return baseline or sample, sample
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--duration", type=float, default=3600, help="seconds to play")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between the memory samples")
+    parser.add_argument("--warmup", type=float, default=300, help="seconds before the baseline sample, caches fill up until then")
+    parser.add_argument("--groups", type=int, default=8, help="groups playing at the same time")
+    parser.add_argument("--players", type=int, default=5, help="most players per group")
+    parser.add_argument("--session-turns", type=int, default=200, help="average turns a group plays before it leaves")
+    parser.add_argument("--budget-mb", type=float, default=16, help="allowed growth of the traced memory after the warm-up")
+    parser.add_argument("--top", type=int, default=15, help="number of growing allocation sites and object types reported")
+    parser.add_argument("--frames", type=int, default=1, help="traceback depth of the allocations, more is slower")
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+    baseline, final = soak(arguments)
+    report(baseline, final, "traceback" if arguments.frames > 1 else "lineno", arguments.top)
+    growth = (final.traced_bytes - baseline.traced_bytes) / 2**20
+    SOAK_DIRECTORY.cleanup()
+    if growth > arguments.budget_mb:
+        print(f"\nTraced memory grew by {growth:.2f}MB, more than the budget of {arguments.budget_mb}MB")
+        raise SystemExit(1)
+    print(f"\nTraced memory grew by {growth:.2f}MB, within the budget of {arguments.budget_mb}MB")
@@ -0,0 +1,11 @@
+"""Points the app at a temporary database and cache directories before any test imports it"""
+
+import os
+import tempfile
+
+# the database file is read on import, so the environment has to be set before any app import
+TEST_DIRECTORY = tempfile.TemporaryDirectory(prefix="jedi-test-")
+os.environ["SQL_FILE_NAME"] = os.path.join(TEST_DIRECTORY.name, "test.db")
+os.environ["TEMPLATE_CACHE_DIR"] = os.path.join(TEST_DIRECTORY.name, "jinja_cache")
+os.environ["STATIC_BUILD_DIR"] = os.path.join(TEST_DIRECTORY.name, "static_build")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
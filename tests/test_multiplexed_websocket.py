@@ -0,0 +1,47 @@
+"""Tests of the multiplexed websocket endpoint /mux/{client_name}"""
+
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.dependencies import get_manager
+from app.main import app
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def test_hello_is_answered_as_on_ws(client):
+    with client.websocket_connect("/ws/hello-group/luke") as websocket:
+        websocket.receive_text()  # presence snapshot
+        websocket.send_text("Hello")
+        assert websocket.receive_text() == "Hello Client #luke"
+    with client.websocket_connect("/mux/gm") as websocket:
+        websocket.send_text("Hello")
+        # answered in order, an unanswered hello would make the subscription answer the first frame
+        websocket.send_text("subscribe hello-group")
+        assert websocket.receive_text() == "Hello Client #gm"
+
+
+def test_subscribe_sends_the_group_snapshot(client):
+    with client.websocket_connect("/mux/gm") as websocket:
+        websocket.send_text("subscribe mux-group")
+        message_types = [json.loads(websocket.receive_text())["message_type"] for _ in range(2)]
+        assert message_types == ["PresenceSnapshotMessage", "GroupSnapshotMessage"]
+
+
+def test_rejected_subscription_is_a_json_rejection(client, monkeypatch):
+    monkeypatch.setattr(get_manager().admission, "max_subscriptions", 1)
+    with client.websocket_connect("/mux/gm") as websocket:
+        websocket.send_text("subscribe first-group")
+        for _ in range(2):
+            websocket.receive_text()
+        websocket.send_text("subscribe second-group")
+        rejection = json.loads(websocket.receive_text())
+        assert rejection["message_type"] == "RequestRejectedMessage"
+        assert rejection["group_name"] == "second-group"
+        assert rejection["reason"] == "subscribe: max_subscriptions"